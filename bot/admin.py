@@ -6,8 +6,14 @@ from typing import Any, Dict, Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
+from bans import bans
+from catalog import catalog_written, set_cat_pools
 from config import OWNER_ID
-from db import open_db, set_config, get_config
+from config_cache import config_cache
+from db import connect, set_config
+from feedplay import is_deadline_config_key, refresh_deadlines, schedule_deadline_refresh
+from logsink import log_economy
+from passive import apply_passive, adjust_passive_rate, cat_passive_rate, is_rate_config_key, schedule_rate_rebuild
 
 RARITIES = ["Common", "Uncommon", "Rare", "Epic", "Legendary", "Mythic", "Divine"]
 MEDIA_TYPES = ["photo", "video"]
@@ -34,13 +40,10 @@ def _is_owner(user_id: int) -> bool:
 async def is_admin(user_id: int) -> bool:
     if _is_owner(user_id):
         return True
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT role FROM admin_roles WHERE user_id=?", (int(user_id),))
         r = await cur.fetchone()
         return r is not None
-    finally:
-        await db.close()
 
 
 def admin_menu_keyboard() -> InlineKeyboardMarkup:
@@ -53,6 +56,7 @@ def admin_menu_keyboard() -> InlineKeyboardMarkup:
             [InlineKeyboardButton("Set Config (Key/Value)", callback_data="admin:setcfg")],
             [InlineKeyboardButton("Grant/Take", callback_data="admin:grant")],
             [InlineKeyboardButton("Ban/Unban", callback_data="admin:ban")],
+            [InlineKeyboardButton("Rebuild Passive Rates", callback_data="admin:rates")],
             [InlineKeyboardButton("View Logs", callback_data="admin:logs:0")],
             [InlineKeyboardButton("Back", callback_data="nav:home")],
         ]
@@ -174,9 +178,9 @@ async def admin_addcat_confirm(user_id: int, context: ContextTypes.DEFAULT_TYPE)
     data = st.get("data", {})
     now = _now()
 
-    db = await open_db()
-    try:
-        await db.execute(
+    async with connect() as db:
+        # pools_enabled is still written for older builds; cat_pools is what the bot reads
+        cur = await db.execute(
             """
             INSERT INTO cats_catalog(
               name, description, rarity, base_passive_rate,
@@ -195,13 +199,14 @@ async def admin_addcat_confirm(user_id: int, context: ContextTypes.DEFAULT_TYPE)
                 now,
             ),
         )
+        await set_cat_pools(db, int(cur.lastrowid), data["pools_enabled"].split(","))
         await db.execute(
             "INSERT INTO admin_logs(admin_id, action, meta_json, ts) VALUES(?,?,?,?)",
             (int(user_id), "add_cat", json.dumps(data, ensure_ascii=False), int(now)),
         )
         await db.commit()
-    finally:
-        await db.close()
+
+    catalog_written()
 
     context.user_data.pop("admin_addcat", None)
     return "ثبت شد."
@@ -283,15 +288,12 @@ async def admin_setgroup_confirm(user_id: int, context: ContextTypes.DEFAULT_TYP
     await set_config("required_group_invite_link", str(data.get("required_group_invite_link", "")))
 
     now = _now()
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute(
             "INSERT INTO admin_logs(admin_id, action, meta_json, ts) VALUES(?,?,?,?)",
             (int(user_id), "set_required_group", json.dumps(data, ensure_ascii=False), int(now)),
         )
         await db.commit()
-    finally:
-        await db.close()
 
     context.user_data.pop("admin_setgroup", None)
     return "ثبت شد.", admin_menu_keyboard()
@@ -364,15 +366,20 @@ async def admin_setcfg_confirm(user_id: int, context: ContextTypes.DEFAULT_TYPE)
     await set_config(str(data["key"]), str(data["value"]))
 
     now = _now()
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute(
             "INSERT INTO admin_logs(admin_id, action, meta_json, ts) VALUES(?,?,?,?)",
             (int(user_id), "set_config", json.dumps({"key": data["key"]}, ensure_ascii=False), int(now)),
         )
         await db.commit()
-    finally:
-        await db.close()
+
+    key = str(data["key"])
+    if is_deadline_config_key(key):
+        # ددلاین همه گربه‌های این rarity در پس‌زمینه و تکه‌تکه، بعد از commit
+        schedule_deadline_refresh(key.split("_days_", 1)[1])
+    if is_rate_config_key(key):
+        # همه نرخ‌های ذخیره‌شده با مقدار جدید دوباره محاسبه شوند (در پس‌زمینه، بعد از commit)
+        schedule_rate_rebuild()
 
     context.user_data.pop("admin_setcfg", None)
     return "ثبت شد.", admin_menu_keyboard()
@@ -537,40 +544,36 @@ async def _grant_cat_dup_logic(db, target_user_id: int, cat_id: int) -> dict:
     )
     await db.execute("INSERT OR IGNORE INTO resources(user_id, essence) VALUES(?,0)", (int(target_user_id),))
 
-    cur = await db.execute("SELECT rarity FROM cats_catalog WHERE cat_id=?", (int(cat_id),))
+    cur = await db.execute("SELECT rarity, base_passive_rate FROM cats_catalog WHERE cat_id=?", (int(cat_id),))
     cr = await cur.fetchone()
     if cr is None:
         return {"ok": False, "reason": "cat_not_found"}
     rarity = str(cr["rarity"] or "Common")
+    base_rate = float(cr["base_passive_rate"] or 0.0)
 
     cur = await db.execute(
-        "SELECT id, level, dup_counter FROM user_cats WHERE user_id=? AND cat_id=? ORDER BY id LIMIT 1",
+        "SELECT id, level, dup_counter, status FROM user_cats WHERE user_id=? AND cat_id=? ORDER BY id LIMIT 1",
         (int(target_user_id), int(cat_id)),
     )
     owned = await cur.fetchone()
 
     if owned is None:
-        await db.execute(
+        cur = await db.execute(
             """
-            INSERT INTO user_cats(user_id, cat_id, level, dup_counter, status, last_feed_at, last_play_at, obtained_at)
-            VALUES(?, ?, 1, 0, 'active', ?, ?, ?)
+            INSERT INTO user_cats(user_id, cat_id, level, dup_counter, status, last_feed_at, last_play_at, obtained_at, rarity_rank)
+            VALUES(?, ?, 1, 0, 'active', ?, ?, ?, (SELECT rarity_rank FROM cats_catalog WHERE cat_id=?2))
             """,
             (int(target_user_id), int(cat_id), int(now), int(now), int(now)),
         )
+        await refresh_deadlines(db, user_cat_id=cur.lastrowid, rarity=rarity)
+        await adjust_passive_rate(db, target_user_id, await cat_passive_rate(rarity, base_rate, 1))
         return {"ok": True, "type": "new"}
 
     # duplicate (basic)
     level = int(owned["level"] or 1)
     dup = int(owned["dup_counter"] or 0)
 
-    max_level = 20
-    try:
-        cur2 = await db.execute("SELECT value FROM config WHERE key='max_level'")
-        rr = await cur2.fetchone()
-        if rr is not None:
-            max_level = int(rr["value"])
-    except Exception:
-        max_level = 20
+    max_level = await config_cache.get_int("max_level", 20)
 
     if level >= max_level:
         return {"ok": True, "type": "dup_max", "level": level}
@@ -584,6 +587,9 @@ async def _grant_cat_dup_logic(db, target_user_id: int, cat_id: int) -> dict:
         level_up = True
 
     await db.execute("UPDATE user_cats SET level=?, dup_counter=? WHERE id=?", (int(level), int(dup), int(owned["id"])))
+    if level_up and str(owned["status"] or "active") == "active":
+        delta = await cat_passive_rate(rarity, base_rate, level) - await cat_passive_rate(rarity, base_rate, level - 1)
+        await adjust_passive_rate(db, target_user_id, delta)
     return {"ok": True, "type": "dup", "level": level, "level_up": level_up}
 
 
@@ -599,35 +605,26 @@ async def admin_grant_confirm(admin_id: int, context: ContextTypes.DEFAULT_TYPE)
     tu = int(data.get("target_user_id", 0))
     now = _now()
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         if kind == "mp":
             amt = int(data.get("amount", 0))
             await _grant_mp(db, tu, amt)
-            await db.execute(
-                "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                (tu, "admin_mp_adjust", int(amt), json.dumps({"by": int(admin_id)}, ensure_ascii=False), int(now)),
-            )
+            await log_economy(db, tu, "admin_mp_adjust", amt, {"by": int(admin_id)}, ts=now, audit=True)
 
         elif kind == "ess":
             amt = int(data.get("amount", 0))
             await _grant_ess(db, tu, amt)
-            await db.execute(
-                "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                (tu, "admin_ess_adjust", int(amt), json.dumps({"by": int(admin_id)}, ensure_ascii=False), int(now)),
-            )
+            await log_economy(db, tu, "admin_ess_adjust", amt, {"by": int(admin_id)}, ts=now, audit=True)
 
         elif kind == "item":
             item_id = int(data.get("arg1", 0))
             qty = int(data.get("qty", 0))
             await _grant_item(db, tu, item_id, qty)
-            await db.execute(
-                "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                (tu, "admin_item_adjust", int(qty), json.dumps({"by": int(admin_id), "item_id": item_id}, ensure_ascii=False), int(now)),
-            )
+            await log_economy(db, tu, "admin_item_adjust", qty, {"by": int(admin_id), "item_id": item_id}, ts=now, audit=True)
 
         elif kind == "cat":
             cat_id = int(data.get("arg1", 0))
+            await apply_passive(tu, force=True)
             out = await _grant_cat_dup_logic(db, tu, cat_id)
             if not out.get("ok"):
                 return "cat_id نامعتبر است.", admin_menu_keyboard()
@@ -643,8 +640,6 @@ async def admin_grant_confirm(admin_id: int, context: ContextTypes.DEFAULT_TYPE)
             (int(admin_id), "admin_grant", json.dumps(data, ensure_ascii=False), int(now)),
         )
         await db.commit()
-    finally:
-        await db.close()
 
     context.user_data.pop("admin_grant", None)
     return "انجام شد.", admin_menu_keyboard()
@@ -653,10 +648,6 @@ async def admin_grant_confirm(admin_id: int, context: ContextTypes.DEFAULT_TYPE)
 # ----------------------------
 # Ban/Unban
 # ----------------------------
-def _ban_key(user_id: int) -> str:
-    return f"ban:user:{int(user_id)}"
-
-
 def admin_ban_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -758,36 +749,43 @@ async def admin_ban_confirm(admin_id: int, context: ContextTypes.DEFAULT_TYPE) -
     tu = int(data.get("target_user_id", 0))
     now = _now()
 
-    if mode == "do":
-        payload = {"reason": data.get("reason", ""), "ts": int(now)}
-        await set_config(_ban_key(tu), json.dumps(payload, ensure_ascii=False))
-        action = "ban"
-    else:
-        db = await open_db()
-        try:
-            await db.execute("DELETE FROM config WHERE key=?", (_ban_key(tu),))
-            await db.commit()
-        finally:
-            await db.close()
-        action = "unban"
-
-    db = await open_db()
-    try:
+    async with connect() as db:
+        if mode == "do":
+            await bans.ban(db, tu, data.get("reason", ""), banned_by=admin_id)
+            action = "ban"
+        else:
+            await bans.unban(db, tu)
+            action = "unban"
         await db.execute(
             "INSERT INTO admin_logs(admin_id, action, meta_json, ts) VALUES(?,?,?,?)",
             (int(admin_id), f"admin_{action}", json.dumps({"target": tu}, ensure_ascii=False), int(now)),
         )
         await db.commit()
-    finally:
-        await db.close()
 
     context.user_data.pop("admin_ban", None)
     return "انجام شد.", admin_menu_keyboard()
 
 
 async def is_banned(user_id: int) -> bool:
-    v = await get_config(_ban_key(user_id))
-    return v is not None
+    return await bans.is_banned(user_id)
+
+
+# ----------------------------
+# Passive rates
+# ----------------------------
+async def admin_rebuild_rates(admin_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    if not _is_owner(admin_id):
+        return "دسترسی ندارید.", admin_menu_keyboard()
+
+    async with connect() as db:
+        await db.execute(
+            "INSERT INTO admin_logs(admin_id, action, meta_json, ts) VALUES(?,?,?,?)",
+            (int(admin_id), "rebuild_passive_rates", "{}", _now()),
+        )
+        await db.commit()
+    schedule_rate_rebuild()
+
+    return "بازسازی نرخ‌ها در پس‌زمینه شروع شد.", admin_menu_keyboard()
 
 
 # ----------------------------
@@ -798,15 +796,12 @@ async def admin_logs_page(page: int = 0) -> tuple[str, InlineKeyboardMarkup]:
     limit = 15
     offset = page * limit
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             "SELECT admin_id, action, ts, meta_json FROM admin_logs ORDER BY id DESC LIMIT ? OFFSET ?",
             (int(limit), int(offset)),
         )
         rows = await cur.fetchall()
-    finally:
-        await db.close()
 
     if not rows and page == 0:
         return "Logs\n\n(هیچ)", InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="nav:admin")]])
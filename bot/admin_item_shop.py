@@ -5,7 +5,7 @@ from typing import Optional, Tuple, List
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from db import open_db
+from db import connect, config_written
 
 
 WZ_OFFER_KEY = "admin_ishop_addoffer"
@@ -120,12 +120,9 @@ async def add_offer_handle_message(
         except Exception:
             return ("item_id نامعتبر است.", None)
 
-        db = await open_db()
-        try:
+        async with connect() as db:
             cur = await db.execute("SELECT item_id FROM items_catalog WHERE item_id=?", (item_id,))
             row = await cur.fetchone()
-        finally:
-            await db.close()
 
         if row is None:
             return ("item_id یافت نشد.", None)
@@ -160,8 +157,7 @@ async def add_offer_confirm(admin_id: int, context: ContextTypes.DEFAULT_TYPE) -
     if _offer_next(d) != "done":
         return ("Wizard کامل نیست.", None)
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT item_id FROM items_catalog WHERE item_id=?", (int(d.item_id),))
         row = await cur.fetchone()
         if row is None:
@@ -187,8 +183,6 @@ async def add_offer_confirm(admin_id: int, context: ContextTypes.DEFAULT_TYPE) -
         await db.commit()
         _offer_clear(context)
         return (f"Offer added.\n\noffer_id: {offer_id}", ishop_admin_menu_kb())
-    finally:
-        await db.close()
 
 
 async def list_offers(page: int) -> Tuple[str, InlineKeyboardMarkup]:
@@ -196,8 +190,7 @@ async def list_offers(page: int) -> Tuple[str, InlineKeyboardMarkup]:
     page_size = 7
     offset = page * page_size
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             """
             SELECT o.offer_id, o.item_id, o.price, o.active, c.name
@@ -209,8 +202,6 @@ async def list_offers(page: int) -> Tuple[str, InlineKeyboardMarkup]:
             (page_size + 1, offset),
         )
         rows = await cur.fetchall()
-    finally:
-        await db.close()
 
     has_next = len(rows) > page_size
     rows = rows[:page_size]
@@ -239,8 +230,7 @@ async def list_offers(page: int) -> Tuple[str, InlineKeyboardMarkup]:
 
 
 async def offer_detail(offer_id: int) -> Tuple[str, InlineKeyboardMarkup]:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             """
             SELECT o.offer_id, o.item_id, o.price, o.active, c.name, c.type
@@ -251,8 +241,6 @@ async def offer_detail(offer_id: int) -> Tuple[str, InlineKeyboardMarkup]:
             (int(offer_id),),
         )
         r = await cur.fetchone()
-    finally:
-        await db.close()
 
     if r is None:
         return ("Not found.", ishop_admin_menu_kb())
@@ -280,8 +268,7 @@ async def offer_detail(offer_id: int) -> Tuple[str, InlineKeyboardMarkup]:
 
 
 async def offer_toggle(admin_id: int, offer_id: int) -> Tuple[str, InlineKeyboardMarkup]:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT active FROM item_shop_offers WHERE offer_id=?", (int(offer_id),))
         r = await cur.fetchone()
         if r is None:
@@ -301,8 +288,6 @@ async def offer_toggle(admin_id: int, offer_id: int) -> Tuple[str, InlineKeyboar
             ),
         )
         await db.commit()
-    finally:
-        await db.close()
 
     return await offer_detail(int(offer_id))
 
@@ -328,10 +313,10 @@ async def set_weekly_cap_handle_message(
     except Exception:
         return ("عدد نامعتبر است.", None)
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute(
-            "INSERT INTO config(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            "INSERT INTO config(key,value,updated_at) VALUES(?,?,strftime('%s','now')) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
             ("item_shop_weekly_cap", str(cap)),
         )
         await db.execute(
@@ -339,8 +324,7 @@ async def set_weekly_cap_handle_message(
             (int(admin_id), "item_shop_set_weekly_cap", json.dumps({"cap": cap}, ensure_ascii=False)),
         )
         await db.commit()
-    finally:
-        await db.close()
+    config_written()
 
     _cap_set_running(context, False)
     return (f"Saved.\n\nitem_shop_weekly_cap = {cap}", ishop_admin_menu_kb())
@@ -6,8 +6,9 @@ from typing import Optional, Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
+from catalog import catalog_written
 from config import OWNER_ID
-from db import open_db
+from db import connect
 
 
 WZ_KEY = "admin_additem"
@@ -187,8 +188,7 @@ async def admin_additem_confirm(user_id: int, context: ContextTypes.DEFAULT_TYPE
         return ("Wizard کامل نیست.", None)
 
     now = _now()
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             """
             INSERT INTO items_catalog(name, type, effect_json, durability_rules_json, tradable, active)
@@ -224,8 +224,8 @@ async def admin_additem_confirm(user_id: int, context: ContextTypes.DEFAULT_TYPE
             ),
         )
         await db.commit()
-    finally:
-        await db.close()
+
+    catalog_written()
 
     _draft_clear(context)
     return (f"ثبت شد.\n\nitem_id: {item_id}", None)
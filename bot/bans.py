@@ -0,0 +1,64 @@
+import time
+from typing import Optional, Set
+
+from config import CONFIG_CACHE_TTL_SEC
+from db import connect, current_session
+from reloadable import Reloadable
+
+
+class BanList:
+    """
+    Banned user ids kept in memory, so the join gate does not query the DB on
+    every update. Loaded from user_bans on first use (or by load() at
+    startup) and changed by ban()/unban(), which write through the caller's
+    connection and update the set once it commits; ttl_sec works as in
+    Reloadable.
+    """
+
+    def __init__(self, ttl_sec: int = 0) -> None:
+        self._ids: Reloadable[Set[int]] = Reloadable(self._read, ttl_sec)
+
+    async def _read(self) -> Set[int]:
+        async with connect() as db:
+            cur = await db.execute("SELECT user_id FROM user_bans")
+            return {int(r["user_id"]) for r in await cur.fetchall()}
+
+    async def load(self) -> Set[int]:
+        return await self._ids.reload()
+
+    async def is_banned(self, user_id: int) -> bool:
+        return int(user_id) in await self._ids.get()
+
+    def _apply(self, user_id: int, banned: bool) -> None:
+        self._ids.update(lambda ids: ids.add(int(user_id)) if banned else ids.discard(int(user_id)))
+
+    def _after_commit(self, user_id: int, banned: bool) -> None:
+        session = current_session()
+        if session is not None:
+            session.on_commit(lambda: self._apply(user_id, banned))
+            # a reload inside the unit of work may have seen the uncommitted row
+            session.on_rollback(self._ids.invalidate)
+        else:
+            self._apply(user_id, banned)
+
+    async def ban(self, db, user_id: int, reason: str = "", banned_by: Optional[int] = None) -> None:
+        """Caller commits db; outside a unit of work the set changes right away."""
+        await db.execute(
+            """
+            INSERT INTO user_bans(user_id, reason, banned_by, banned_at)
+            VALUES(?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+              reason=excluded.reason,
+              banned_by=excluded.banned_by,
+              banned_at=excluded.banned_at
+            """,
+            (int(user_id), str(reason or ""), None if banned_by is None else int(banned_by), int(time.time())),
+        )
+        self._after_commit(user_id, True)
+
+    async def unban(self, db, user_id: int) -> None:
+        await db.execute("DELETE FROM user_bans WHERE user_id=?", (int(user_id),))
+        self._after_commit(user_id, False)
+
+
+bans = BanList(CONFIG_CACHE_TTL_SEC)
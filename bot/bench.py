@@ -0,0 +1,314 @@
+# bot/bench.py
+"""
+Load simulation for the bot handlers, without Telegram.
+
+Builds the real Application (main.build_application) around a fake Bot that
+answers every API call in memory, seeds a temporary SQLite file and replays
+synthetic updates from N simulated users: meow spam, box openings, My Cats
+paging, home refreshes and owner grants. Reports updates/sec, p50/p95/p99
+latency per callback prefix and SQL statements per update.
+
+    python bot/bench.py --users 50 --updates 40
+    python bot/bench.py --users 200 --updates 20 --net-ms 30 --mix meow=5,box=2,cats=2,home=1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+GROUP_CHAT_ID = -100123
+OWNER = 1
+BOT_USER = {"id": 999, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+DEFAULT_MIX = "meow=4,box=3,cats=2,home=1"
+
+
+def _parse_args(argv: List[str]) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    p.add_argument("--users", type=int, default=50, help="simulated users (user 1 is the owner)")
+    p.add_argument("--updates", type=int, default=40, help="updates sent by each user")
+    p.add_argument("--mix", default=DEFAULT_MIX, help=f"scenario weights (default {DEFAULT_MIX})")
+    p.add_argument("--grants", type=int, default=10, help="admin grant flows run by the owner")
+    p.add_argument("--concurrency", type=int, default=0, help="UPDATE_CONCURRENCY override")
+    p.add_argument("--net-ms", type=float, default=0.0, help="simulated Telegram round trip per API call")
+    p.add_argument("--cats", type=int, default=60, help="catalog size")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--db", default="", help="SQLite file (default: a fresh temp file)")
+    return p.parse_args(argv)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(q * (len(s) - 1)))))
+    return s[k]
+
+
+def _message(chat_id: int, message_id: int, text: str = "", sender: dict | None = None) -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": sender or BOT_USER,
+        "text": text,
+    }
+
+
+def _make_fake_bot(net_ms: float):
+    from telegram import Bot
+
+    class FakeBot(Bot):
+        """Answers Bot API calls in memory; counts them per endpoint."""
+
+        def __init__(self) -> None:
+            super().__init__(token="0:bench")
+            # telegram objects are frozen after __init__
+            with self._unfrozen():
+                self.calls: Dict[str, int] = defaultdict(int)
+                self._next_id = 1000
+
+        async def _do_post(self, endpoint: str, data: Dict[str, Any], **_kwargs) -> Any:
+            self.calls[endpoint] += 1
+            if net_ms > 0:
+                await asyncio.sleep(net_ms / 1000.0)
+            self._next_id += 1
+            chat_id = int(data.get("chat_id") or 0)
+            if endpoint == "getMe":
+                return dict(BOT_USER)
+            if endpoint == "getChatMember":
+                return {"status": "member", "user": {"id": int(data["user_id"]), "is_bot": False, "first_name": "u"}}
+            if endpoint in ("sendMessage", "editMessageText", "sendPhoto", "sendVideo"):
+                return _message(chat_id, int(data.get("message_id") or self._next_id), str(data.get("text") or ""))
+            if endpoint == "sendMediaGroup":
+                media = data.get("media") or []
+                return [_message(chat_id, self._next_id + i) for i in range(max(1, len(media)))]
+            return True
+
+    return FakeBot()
+
+
+class Driver:
+    def __init__(self, app, bot) -> None:
+        from telegram import Update
+
+        self._update_cls = Update
+        self.app = app
+        self.bot = bot
+        self._update_id = 0
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.statements: Dict[str, List[int]] = defaultdict(list)
+        self.end_to_end: List[float] = []
+
+    def _next(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+    def callback(self, uid: int, data: str):
+        raw = {
+            "update_id": self._next(),
+            "callback_query": {
+                "id": str(self._update_id),
+                "from": self._user(uid),
+                "chat_instance": f"ci{uid}",
+                "data": data,
+                "message": _message(uid, 1),
+            },
+        }
+        return self._update_cls.de_json(raw, self.bot)
+
+    def text(self, uid: int, text: str):
+        msg = _message(uid, self._next(), text, sender=self._user(uid))
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._update_cls.de_json({"update_id": self._update_id, "message": msg}, self.bot)
+
+    @staticmethod
+    def prefix(update) -> str:
+        if update.callback_query:
+            parts = str(update.callback_query.data or "").split(":")
+            return ":".join(parts[:3]) if parts[0] in ("shop", "admin") else parts[0]
+        text = update.message.text if update.message else ""
+        return text.split()[0] if text.startswith("/") else "message"
+
+    async def send(self, update) -> None:
+        from db import current_session, statement_count
+
+        key = self.prefix(update)
+        seen: Dict[str, Any] = {}
+
+        async def measured() -> None:
+            session = current_session()
+            seen["session"] = session
+            seen["before"] = statement_count(session.conn) if session else 0
+            t0 = time.perf_counter()
+            await self.app.process_update(update)
+            self.latency[key].append((time.perf_counter() - t0) * 1000.0)
+
+        t_submit = time.perf_counter()
+        await self.app.update_processor.process_update(update, measured())
+        self.end_to_end.append((time.perf_counter() - t_submit) * 1000.0)
+        session = seen.get("session")
+        if session is not None:
+            # read after the unit of work ends so its COMMIT is included
+            self.statements[key].append(statement_count(session.conn) - seen["before"])
+
+
+async def _seed(n_users: int, n_cats: int, rnd: random.Random) -> None:
+    from db import connect
+
+    now = int(time.time())
+    rarities = ["Common", "Uncommon", "Rare", "Epic", "Legendary", "Mythic"]
+    async with connect() as db:
+        pools = ["Standard", "Premium", "Shop"]
+        for i in range(n_cats):
+            rarity = rarities[i % len(rarities)]
+            cur = await db.execute(
+                "INSERT INTO cats_catalog(name, description, rarity, base_passive_rate, media_type, media_file_id, "
+                "active, pools_enabled, created_at) VALUES(?,?,?,?,?,?,1,?,?)",
+                (f"cat{i}", "bench", rarity, 1.0 + rnd.random() * 5, "photo", f"file{i}", ",".join(pools), now),
+            )
+            await db.executemany("INSERT INTO cat_pools(cat_id, pool) VALUES(?, ?)", [(cur.lastrowid, p) for p in pools])
+        await db.execute(
+            "INSERT INTO config(key, value, updated_at) VALUES('required_group_chat_id', ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (str(GROUP_CHAT_ID), now),
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO users(user_id, mp_balance, last_passive_ts, shelter_level, created_at) VALUES(?,?,?,1,?)",
+            [(uid, 10**7, now, now) for uid in range(1, n_users + 1)],
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO resources(user_id, essence) VALUES(?, 0)",
+            [(uid,) for uid in range(1, n_users + 1)],
+        )
+        await db.commit()
+
+
+def _scenario(name: str, d: Driver, uid: int, rnd: random.Random) -> list:
+    if name == "meow":
+        return [d.text(uid, "/meow") if rnd.random() < 0.3 else d.callback(uid, "act:meow")]
+    if name == "box":
+        return [d.callback(uid, "shop:prem" if rnd.random() < 0.15 else "shop:std")]
+    if name == "box10":
+        return [d.callback(uid, "shop:prem:x10" if rnd.random() < 0.15 else "shop:std:x10")]
+    if name == "cats":
+        return [d.callback(uid, f"cat:list:{p}") for p in range(rnd.randint(1, 4))]
+    if name == "home":
+        return [d.callback(uid, "nav:home")]
+    raise SystemExit(f"unknown scenario: {name}")
+
+
+async def _run_user(d: Driver, uid: int, n: int, mix: List[Tuple[str, float]], rnd: random.Random) -> None:
+    names = [m[0] for m in mix]
+    weights = [m[1] for m in mix]
+    sent = 0
+    while sent < n:
+        for update in _scenario(rnd.choices(names, weights)[0], d, uid, rnd):
+            await d.send(update)
+            sent += 1
+
+
+async def _run_grants(d: Driver, n: int, n_users: int, rnd: random.Random) -> None:
+    for _ in range(n):
+        target = rnd.randint(1, n_users)
+        for update in (
+            d.callback(OWNER, "admin:grant"),
+            d.callback(OWNER, "admin:grant:mp"),
+            d.text(OWNER, str(target)),
+            d.text(OWNER, str(rnd.randint(1, 500))),
+            d.callback(OWNER, "admin:grant:confirm"),
+        ):
+            await d.send(update)
+
+
+def _report(d: Driver, elapsed: float) -> str:
+    total = sum(len(v) for v in d.latency.values())
+    lines = [
+        f"updates: {total}  elapsed: {elapsed:.2f}s  throughput: {total / elapsed if elapsed else 0:.1f} updates/s",
+        f"end-to-end (incl. queueing): p50 {_percentile(d.end_to_end, 0.5):.2f}ms  "
+        f"p95 {_percentile(d.end_to_end, 0.95):.2f}ms  p99 {_percentile(d.end_to_end, 0.99):.2f}ms",
+        "",
+        f"{'prefix':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sql/upd':>10}",
+    ]
+    all_stmts: List[int] = []
+    for key in sorted(d.latency, key=lambda k: -len(d.latency[k])):
+        lat = d.latency[key]
+        stmts = d.statements.get(key, [])
+        all_stmts.extend(stmts)
+        avg = sum(stmts) / len(stmts) if stmts else 0.0
+        lines.append(
+            f"{key:<16}{len(lat):>7}{_percentile(lat, 0.5):>10.2f}{_percentile(lat, 0.95):>10.2f}"
+            f"{_percentile(lat, 0.99):>10.2f}{avg:>10.1f}"
+        )
+    if all_stmts:
+        lines.append("")
+        lines.append(f"sql statements per update: {sum(all_stmts) / len(all_stmts):.1f}")
+    lines.append("bot api calls: " + json.dumps(dict(sorted(d.bot.calls.items()))))
+    return "\n".join(lines)
+
+
+async def _bench(args: argparse.Namespace) -> str:
+    # imported here: config reads the environment prepared in main()
+    import db
+    from logsink import start_log_sink, stop_log_sink
+    from main import build_application
+
+    rnd = random.Random(args.seed)
+    mix = []
+    for part in args.mix.split(","):
+        name, _, w = part.partition("=")
+        mix.append((name.strip(), float(w or 1)))
+
+    db.count_statements(True)
+    await db.init_db()
+    try:
+        await _seed(args.users, args.cats, rnd)
+
+        bot = _make_fake_bot(args.net_ms)
+        app = build_application(bot)
+        await app.initialize()
+        # run_polling is never called, so start what _post_init would
+        start_log_sink()
+        d = Driver(app, bot)
+        try:
+            t0 = time.perf_counter()
+            jobs = [_run_user(d, uid, args.updates, mix, random.Random(rnd.random())) for uid in range(1, args.users + 1)]
+            jobs.append(_run_grants(d, args.grants, args.users, random.Random(rnd.random())))
+            await asyncio.gather(*jobs)
+            elapsed = time.perf_counter() - t0
+        finally:
+            await stop_log_sink()
+            await app.shutdown()
+    finally:
+        # pooled connections are threads; leaving them open keeps the process alive
+        await db.close_pool()
+    return _report(d, elapsed)
+
+
+def main(argv: List[str] | None = None) -> None:
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="meowland-bench-"), "bench.db")
+    os.environ["DB_PATH"] = path
+    os.environ["OWNER_ID"] = str(OWNER)
+    os.environ["REQUIRED_GROUP_CHAT_ID"] = str(GROUP_CHAT_ID)
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    if args.concurrency > 0:
+        os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    print(f"db: {path}")
+    print(asyncio.run(_bench(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import CONFIG_CACHE_TTL_SEC
+from db import connect, current_session
+from reloadable import Reloadable
+
+
+@dataclass(frozen=True)
+class CatalogCat:
+    cat_id: int
+    name: str
+    description: str
+    rarity: str
+    base_passive_rate: float
+    media_type: str
+    media_file_id: str
+    active: int
+    available_from: Optional[int]
+    available_until: Optional[int]
+    # from cat_pools, as written
+    pools: Tuple[str, ...]
+
+    def in_pool(self, pool: str) -> bool:
+        # pool names match case-insensitively (cat_pools.pool is NOCASE)
+        return pool.lower() in (p.lower() for p in self.pools)
+
+    def available(self, now: int) -> bool:
+        if self.available_from is not None and self.available_from > now:
+            return False
+        return self.available_until is None or self.available_until >= now
+
+
+@dataclass(frozen=True)
+class CatalogItem:
+    item_id: int
+    name: str
+    type: str
+    effect_json: str
+    durability_rules_json: str
+    tradable: int
+    active: int
+
+
+@dataclass
+class _Catalog:
+    version: int
+    cats: Dict[int, CatalogCat]
+    items: Dict[int, CatalogItem]
+    # active cats only, in cat_id order; pools lower-cased
+    by_pool: Dict[str, List[CatalogCat]]
+    by_rarity: Dict[str, List[CatalogCat]]
+    # active cats with available_from or available_until set, in the events list order
+    windowed: List[CatalogCat]
+
+
+def _opt_int(v) -> Optional[int]:
+    return None if v is None else int(v)
+
+
+def _event_order(c: CatalogCat) -> tuple:
+    # cats with a start first, then by start, end (no end first, as in SQL), newest cat
+    return (
+        c.available_from is None,
+        -1 if c.available_from is None else c.available_from,
+        -1 if c.available_until is None else c.available_until,
+        -c.cat_id,
+    )
+
+
+class CatalogStore:
+    """
+    In-memory copy of cats_catalog and items_catalog.
+
+    Both tables only change through admin edits, so they are read whole on
+    first use (or by load() at startup) and indexed by id, pool, rarity and
+    time window; lookups after that run no SQL. catalog_written() drops the
+    copy after an edit; ttl_sec works as in Reloadable.
+    """
+
+    def __init__(self, ttl_sec: int = 0) -> None:
+        self._catalog: Reloadable[_Catalog] = Reloadable(self._read, ttl_sec)
+
+    def invalidate(self) -> None:
+        self._catalog.invalidate()
+
+    async def load(self) -> _Catalog:
+        return await self._catalog.reload()
+
+    async def _read(self) -> _Catalog:
+        gen = self._catalog.gen
+        async with connect() as db:
+            cur = await db.execute(
+                """
+                SELECT cat_id, name, description, rarity, base_passive_rate, media_type, media_file_id,
+                       active, available_from, available_until
+                FROM cats_catalog
+                ORDER BY cat_id
+                """
+            )
+            cat_rows = await cur.fetchall()
+            cur = await db.execute("SELECT cat_id, pool FROM cat_pools ORDER BY cat_id, pool")
+            pool_rows = await cur.fetchall()
+            cur = await db.execute(
+                """
+                SELECT item_id, name, type, effect_json, durability_rules_json, tradable, active
+                FROM items_catalog
+                ORDER BY item_id
+                """
+            )
+            item_rows = await cur.fetchall()
+
+        pools: Dict[int, List[str]] = {}
+        for r in pool_rows:
+            pools.setdefault(int(r["cat_id"]), []).append(str(r["pool"]))
+
+        cats: Dict[int, CatalogCat] = {}
+        by_pool: Dict[str, List[CatalogCat]] = {}
+        by_rarity: Dict[str, List[CatalogCat]] = {}
+        windowed: List[CatalogCat] = []
+        for r in cat_rows:
+            c = CatalogCat(
+                cat_id=int(r["cat_id"]),
+                name=str(r["name"]),
+                description=str(r["description"] or ""),
+                rarity=str(r["rarity"]),
+                base_passive_rate=float(r["base_passive_rate"] or 0.0),
+                media_type=str(r["media_type"] or ""),
+                media_file_id=str(r["media_file_id"] or ""),
+                active=int(r["active"] or 0),
+                available_from=_opt_int(r["available_from"]),
+                available_until=_opt_int(r["available_until"]),
+                pools=tuple(pools.get(int(r["cat_id"]), ())),
+            )
+            cats[c.cat_id] = c
+            if not c.active:
+                continue
+            for p in {p.lower() for p in c.pools}:
+                by_pool.setdefault(p, []).append(c)
+            by_rarity.setdefault(c.rarity, []).append(c)
+            if c.available_from is not None or c.available_until is not None:
+                windowed.append(c)
+        windowed.sort(key=_event_order)
+
+        items = {
+            int(r["item_id"]): CatalogItem(
+                item_id=int(r["item_id"]),
+                name=str(r["name"]),
+                type=str(r["type"] or ""),
+                effect_json=str(r["effect_json"] or ""),
+                durability_rules_json=str(r["durability_rules_json"] or ""),
+                tradable=int(r["tradable"] or 0),
+                active=1 if r["active"] is None else int(r["active"]),
+            )
+            for r in item_rows
+        }
+
+        return _Catalog(
+            version=gen,
+            cats=cats,
+            items=items,
+            by_pool=by_pool,
+            by_rarity=by_rarity,
+            windowed=windowed,
+        )
+
+    async def current(self) -> _Catalog:
+        return await self._catalog.get()
+
+    async def cat(self, cat_id: int, active_only: bool = True) -> Optional[CatalogCat]:
+        c = (await self.current()).cats.get(int(cat_id))
+        if c is None or (active_only and not c.active):
+            return None
+        return c
+
+    async def item(self, item_id: int, active_only: bool = True) -> Optional[CatalogItem]:
+        it = (await self.current()).items.get(int(item_id))
+        if it is None or (active_only and not it.active):
+            return None
+        return it
+
+    async def pool_cats(self, pool: str, now: int, rarity: Optional[str] = None) -> List[CatalogCat]:
+        """Active cats enabled in `pool` and available at `now`, optionally of one rarity."""
+        current = await self.current()
+        if rarity is None:
+            return [c for c in current.by_pool.get(pool.lower(), []) if c.available(now)]
+        return [c for c in current.by_rarity.get(rarity, []) if c.in_pool(pool) and c.available(now)]
+
+    async def event_cats(self, now: int) -> List[CatalogCat]:
+        """Active scheduled cats that have not ended yet, upcoming ones included."""
+        return [
+            c
+            for c in (await self.current()).windowed
+            if c.available_until is None or c.available_until >= now
+        ]
+
+
+catalog = CatalogStore(CONFIG_CACHE_TTL_SEC)
+
+
+async def set_cat_pools(db, cat_id: int, pools: Iterable[str]) -> None:
+    """Replaces the cat's cat_pools rows; caller commits db and calls catalog_written()."""
+    names = [p for p in pools if p]
+    await db.execute("DELETE FROM cat_pools WHERE cat_id=?", (int(cat_id),))
+    await db.executemany(
+        "INSERT OR IGNORE INTO cat_pools(cat_id, pool) VALUES(?, ?)",
+        [(int(cat_id), p) for p in names],
+    )
+
+_catalog_listeners: List[Callable[[], None]] = []
+
+
+def on_catalog_write(fn: Callable[[], None]) -> None:
+    _catalog_listeners.append(fn)
+
+
+def _notify_catalog_listeners() -> None:
+    catalog.invalidate()
+    for fn in _catalog_listeners:
+        fn()
+
+
+def catalog_written() -> None:
+    """Call after writing cats_catalog or items_catalog; mirrors db.config_written."""
+    _notify_catalog_listeners()
+    # other tasks may reload the old rows until our unit of work commits, and
+    # we may reload our own uncommitted rows before it rolls back
+    session = current_session()
+    if session is not None:
+        session.on_commit(_notify_catalog_listeners)
+        session.on_rollback(_notify_catalog_listeners)
@@ -1,10 +1,14 @@
-import json
-import random
 import time
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
-from db import open_db
+from catalog import CatalogCat
+from config_cache import config_cache
+from db import connect
+from gacha import gacha
+from logsink import log_economy_many, log_row
+from passive import apply_passive, adjust_passive_rate, cat_passive_rate
+from feedplay import refresh_deadlines
 
 RARITIES = ["Common", "Uncommon", "Rare", "Epic", "Legendary", "Mythic", "Divine"]
 
@@ -29,146 +33,38 @@ DEFAULT_ESSENCE_FROM_DUP = {
 }
 
 
-@dataclass
-class CatalogCat:
-    cat_id: int
-    name: str
-    description: str
-    rarity: str
-    base_passive_rate: float
-    media_type: str
-    media_file_id: str
-
-
 def _now() -> int:
     return int(time.time())
 
 
-async def catalog_list(pool: str) -> List[CatalogCat]:
-    now = _now()
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT cat_id, name, description, rarity, base_passive_rate, media_type, media_file_id
-            FROM cats_catalog
-            WHERE active=1
-              AND rarity != 'Divine'
-              AND (
-                available_from IS NULL OR available_from <= ?
-              )
-              AND (
-                available_until IS NULL OR available_until >= ?
-              )
-              AND (
-                ',' || pools_enabled || ',' LIKE '%,' || ? || ',%'
-              )
-            """,
-            (now, now, pool),
-        )
-        rows = await cur.fetchall()
-        return [
-            CatalogCat(
-                cat_id=int(r["cat_id"]),
-                name=str(r["name"]),
-                description=str(r["description"]),
-                rarity=str(r["rarity"]),
-                base_passive_rate=float(r["base_passive_rate"]),
-                media_type=str(r["media_type"]),
-                media_file_id=str(r["media_file_id"]),
-            )
-            for r in rows
-        ]
-    finally:
-        await db.close()
-
-
-def _weighted_choice(items, weights) -> int:
-    total = sum(weights)
-    r = random.random() * total
-    upto = 0.0
-    for i, w in enumerate(weights):
-        upto += w
-        if upto >= r:
-            return i
-    return len(items) - 1
-
-
-async def _get_cfg_json(key: str) -> Optional[dict]:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-        row = await cur.fetchone()
-        if row is None:
-            return None
-        try:
-            return json.loads(row["value"])
-        except Exception:
-            return None
-    finally:
-        await db.close()
-
-
-async def _get_pity(user_id: int, key: str) -> int:
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            "SELECT value FROM config WHERE key=?",
-            (f"pity_{key}_{user_id}",),
-        )
-        row = await cur.fetchone()
-        if row is None:
-            return 0
-        try:
-            return int(row["value"])
-        except Exception:
-            return 0
-    finally:
-        await db.close()
+async def _get_pity(db, user_id: int, pool: str) -> int:
+    cur = await db.execute(
+        "SELECT counter FROM user_pity WHERE user_id=? AND pool=?",
+        (user_id, pool),
+    )
+    row = await cur.fetchone()
+    return 0 if row is None else int(row["counter"] or 0)
 
 
-async def _set_pity(user_id: int, key: str, v: int) -> None:
-    now = _now()
-    db = await open_db()
-    try:
-        await db.execute(
-            "INSERT INTO config(key, value, updated_at) VALUES(?,?,?) "
-            "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
-            (f"pity_{key}_{user_id}", str(int(v)), now),
-        )
-        await db.commit()
-    finally:
-        await db.close()
+async def _set_pity(db, user_id: int, pool: str, counter: int, now: int) -> None:
+    await db.execute(
+        """
+        INSERT INTO user_pity(user_id, pool, counter, updated_at)
+        VALUES(?,?,?,?)
+        ON CONFLICT(user_id, pool) DO UPDATE SET
+          counter=excluded.counter,
+          updated_at=excluded.updated_at
+        """,
+        (user_id, pool, int(counter), now),
+    )
 
 
 async def _max_level() -> int:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key='max_level'")
-        row = await cur.fetchone()
-        if row is None:
-            return 20
-        try:
-            return int(row["value"])
-        except Exception:
-            return 20
-    finally:
-        await db.close()
-
-
-async def _cfg_json_in_db(db, key: str) -> Optional[dict]:
-    cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-    row = await cur.fetchone()
-    if row is None:
-        return None
-    try:
-        return json.loads(row["value"])
-    except Exception:
-        return None
+    return await config_cache.get_int("max_level", 20)
 
 
-async def _essence_for_rarity(db, rarity: str) -> int:
-    cfg = await _cfg_json_in_db(db, "essence_from_dup")
+async def _essence_for_rarity(rarity: str) -> int:
+    cfg = await config_cache.get_json("essence_from_dup")
     if isinstance(cfg, dict) and rarity in cfg:
         try:
             return max(0, int(cfg[rarity]))
@@ -177,96 +73,93 @@ async def _essence_for_rarity(db, rarity: str) -> int:
     return max(0, int(DEFAULT_ESSENCE_FROM_DUP.get(rarity, 0)))
 
 
-async def _add_or_dup(user_id: int, cat: CatalogCat) -> dict:
-    now = _now()
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            "SELECT id, level, dup_counter, status FROM user_cats WHERE user_id=? AND cat_id=? ORDER BY id LIMIT 1",
-            (user_id, cat.cat_id),
-        )
-        owned = await cur.fetchone()
-
-        if owned is None:
-            await db.execute(
-                """
-                INSERT INTO user_cats(user_id, cat_id, level, dup_counter, status, last_feed_at, last_play_at, obtained_at)
-                VALUES(?, ?, 1, 0, 'active', ?, ?, ?)
-                """,
-                (user_id, cat.cat_id, now, now, now),
-            )
-            await db.commit()
-            return {"type": "new", "level_up": False, "level": 1}
-
-        level = int(owned["level"] or 1)
-        dup = int(owned["dup_counter"] or 0)
-        prev_status = str(owned["status"] or "active")
-        status = "active" if prev_status != "active" else prev_status
-
-        max_level = await _max_level()
+async def _apply_pulls(db, user_id: int, cat: CatalogCat, k: int, now: int) -> List[dict]:
+    """
+    Applies k copies of one cat to the user's collection with one read and
+    one write: the first copy of an unowned cat is new, the rest count as
+    duplicates (level ups, or essence at max level), exactly as k separate
+    pulls would. Returns one outcome per copy. The caller commits.
+    """
+    cur = await db.execute(
+        "SELECT id, level, dup_counter, status FROM user_cats WHERE user_id=? AND cat_id=? ORDER BY id LIMIT 1",
+        (user_id, cat.cat_id),
+    )
+    owned = await cur.fetchone()
+
+    max_level = await _max_level()
+    th = DUP_THRESHOLDS.get(cat.rarity, 25)
+    start_status = None if owned is None else str(owned["status"] or "active")
+    level = 1 if owned is None else int(owned["level"] or 1)
+    dup = 0 if owned is None else int(owned["dup_counter"] or 0)
+    status = start_status
+
+    outcomes: List[dict] = []
+    logs = []
+    essence_total = 0
+    rate_delta = 0.0
+    for _ in range(max(1, int(k))):
+        if status is None:
+            status = "active"
+            rate_delta += await cat_passive_rate(cat.rarity, cat.base_passive_rate, 1)
+            outcomes.append({"type": "new", "level_up": False, "level": 1})
+            continue
+
+        prev_status = status
+        status = "active"
 
         if level >= max_level:
-            essence = await _essence_for_rarity(db, cat.rarity)
-
-            if status != prev_status:
-                await db.execute(
-                    "UPDATE user_cats SET status=? WHERE id=?",
-                    (status, int(owned["id"])),
-                )
-
+            essence = await _essence_for_rarity(cat.rarity)
+            if prev_status != "active":
+                rate_delta += await cat_passive_rate(cat.rarity, cat.base_passive_rate, level)
             if essence > 0:
-                await db.execute(
-                    "INSERT OR IGNORE INTO resources(user_id, essence) VALUES(?, 0)",
-                    (int(user_id),),
-                )
-                await db.execute(
-                    "UPDATE resources SET essence = essence + ? WHERE user_id=?",
-                    (int(essence), int(user_id)),
-                )
-                await db.execute(
-                    "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                    (
-                        int(user_id),
-                        "dup_to_essence",
-                        int(essence),
-                        json.dumps(
-                            {"cat_id": int(cat.cat_id), "rarity": str(cat.rarity), "essence": int(essence)},
-                            ensure_ascii=False,
-                        ),
-                        int(now),
-                    ),
-                )
+                essence_total += essence
+                meta = {"cat_id": int(cat.cat_id), "rarity": str(cat.rarity), "essence": int(essence)}
+                logs.append(log_row(user_id, "dup_to_essence", int(essence), meta, now))
             else:
-                await db.execute(
-                    "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                    (
-                        int(user_id),
-                        "dup_at_max_level",
-                        0,
-                        json.dumps({"cat_id": int(cat.cat_id), "rarity": str(cat.rarity)}, ensure_ascii=False),
-                        int(now),
-                    ),
-                )
-
-            await db.commit()
-            return {"type": "dup_max", "level_up": False, "level": level, "essence": int(essence)}
+                logs.append(log_row(user_id, "dup_at_max_level", 0, {"cat_id": int(cat.cat_id), "rarity": str(cat.rarity)}, now))
+            outcomes.append({"type": "dup_max", "level_up": False, "level": level, "essence": int(essence)})
+            continue
 
+        old_rate = await cat_passive_rate(cat.rarity, cat.base_passive_rate, level) if prev_status == "active" else 0.0
         dup += 1
-        th = DUP_THRESHOLDS.get(cat.rarity, 25)
         level_up = False
         if dup >= th:
             level = level + 1
             dup = 0
             level_up = True
+        rate_delta += await cat_passive_rate(cat.rarity, cat.base_passive_rate, level) - old_rate
+        outcomes.append({"type": "dup", "level_up": level_up, "level": level, "dup": dup, "threshold": th})
 
+    if owned is None:
+        cur = await db.execute(
+            """
+            INSERT INTO user_cats(user_id, cat_id, level, dup_counter, status, last_feed_at, last_play_at, obtained_at, rarity_rank)
+            VALUES(?, ?, ?, ?, 'active', ?, ?, ?, (SELECT rarity_rank FROM cats_catalog WHERE cat_id=?2))
+            """,
+            (user_id, cat.cat_id, level, dup, now, now, now),
+        )
+        await refresh_deadlines(db, user_cat_id=cur.lastrowid, rarity=cat.rarity)
+    elif (level, dup, status) != (int(owned["level"] or 1), int(owned["dup_counter"] or 0), start_status):
         await db.execute(
             "UPDATE user_cats SET level=?, dup_counter=?, status=? WHERE id=?",
             (level, dup, status, int(owned["id"])),
         )
-        await db.commit()
-        return {"type": "dup", "level_up": level_up, "level": level, "dup": dup, "threshold": th}
-    finally:
-        await db.close()
+        if status != start_status:
+            await refresh_deadlines(db, user_cat_id=int(owned["id"]), rarity=cat.rarity)
+
+    if essence_total > 0:
+        await db.execute(
+            "INSERT OR IGNORE INTO resources(user_id, essence) VALUES(?, 0)",
+            (int(user_id),),
+        )
+        await db.execute(
+            "UPDATE resources SET essence = essence + ? WHERE user_id=?",
+            (int(essence_total), int(user_id)),
+        )
+    if rate_delta:
+        await adjust_passive_rate(db, user_id, rate_delta)
+    await log_economy_many(db, logs)
+    return outcomes
 
 
 @dataclass
@@ -277,113 +170,129 @@ class BoxResult:
     outcome: Optional[dict] = None
 
 
-async def open_standard_box(user_id: int, price: int = 10) -> BoxResult:
-    probs = await _get_cfg_json("standard_probs") or {
-        "Common": 0.60,
-        "Uncommon": 0.22,
-        "Rare": 0.13,
-        "Epic": 0.05,
-    }
-    pity_n = int((await _get_cfg_json("standard_pity") or {}).get("n", 30))
-    pity_counter = await _get_pity(user_id, "standard")
-
-    cats = await catalog_list("Standard")
-    if not cats:
-        return BoxResult(False, "empty_pool")
-
-    buckets = {}
-    for c in cats:
-        if c.rarity in probs:
-            buckets.setdefault(c.rarity, []).append(c)
-
-    rarities = list(probs.keys())
-    weights = [float(probs[r]) for r in rarities]
-
-    forced_epic = False
-    pity_counter += 1
-    if pity_counter >= pity_n:
-        forced_epic = True
-
-    chosen_rarity = "Epic" if forced_epic else rarities[_weighted_choice(rarities, weights)]
-    if chosen_rarity not in buckets:
-        chosen_rarity = next(iter(buckets.keys()))
-
-    cat = random.choice(buckets[chosen_rarity])
-
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT mp_balance FROM users WHERE user_id=?", (user_id,))
-        u = await cur.fetchone()
-        mp = 0 if u is None else int(u["mp_balance"] or 0)
-        if mp < price:
-            return BoxResult(False, "no_mp")
-        await db.execute("UPDATE users SET mp_balance = mp_balance - ? WHERE user_id=?", (price, user_id))
-        await db.commit()
-    finally:
-        await db.close()
+@dataclass
+class MultiBoxResult:
+    ok: bool
+    reason: str = ""
+    # (cat, outcome) per pull, in draw order
+    pulls: List[Tuple[CatalogCat, dict]] = field(default_factory=list)
+    mp_spent: int = 0
 
-    outcome = await _add_or_dup(user_id, cat)
 
-    if chosen_rarity == "Epic":
-        pity_counter = 0
-    await _set_pity(user_id, "standard", pity_counter)
+@dataclass
+class BoxSpec:
+    pool: str
+    probs_key: str
+    default_probs: Dict[str, float]
+    pity_key: str
+    pity_default_n: int
+    # pity forces a draw among these rarities; drawing any of them resets the counter
+    pity_rarities: Tuple[str, ...]
+    price: int
+
+
+BOXES = {
+    "standard": BoxSpec(
+        pool="Standard",
+        probs_key="standard_probs",
+        default_probs={
+            "Common": 0.60,
+            "Uncommon": 0.22,
+            "Rare": 0.13,
+            "Epic": 0.05,
+        },
+        pity_key="standard",
+        pity_default_n=30,
+        pity_rarities=("Epic",),
+        price=10,
+    ),
+    "premium": BoxSpec(
+        pool="Premium",
+        probs_key="premium_probs",
+        default_probs={
+            "Common": 0.45,
+            "Uncommon": 0.23,
+            "Rare": 0.15,
+            "Epic": 0.10,
+            "Legendary": 0.065,
+            "Mythic": 0.005,
+        },
+        pity_key="premium",
+        pity_default_n=10,
+        pity_rarities=("Epic", "Legendary", "Mythic"),
+        price=250,
+    ),
+}
 
-    return BoxResult(True, cat=cat, outcome=outcome)
+MAX_MULTI_PULL = 10
 
 
-async def open_premium_box(user_id: int, price: int = 250) -> BoxResult:
-    probs = await _get_cfg_json("premium_probs") or {
-        "Common": 0.45,
-        "Uncommon": 0.23,
-        "Rare": 0.15,
-        "Epic": 0.10,
-        "Legendary": 0.065,
-        "Mythic": 0.005,
-    }
-    pity_n = int((await _get_cfg_json("premium_pity") or {}).get("n", 10))
-    pity_counter = await _get_pity(user_id, "premium")
-
-    cats = await catalog_list("Premium")
-    if not cats:
-        return BoxResult(False, "empty_pool")
-
-    buckets = {}
-    for c in cats:
-        if c.rarity in probs:
-            buckets.setdefault(c.rarity, []).append(c)
-
-    rarities = list(probs.keys())
-    weights = [float(probs[r]) for r in rarities]
-
-    pity_counter += 1
-    if pity_counter >= pity_n:
-        eligible = [r for r in rarities if r in ("Epic", "Legendary", "Mythic")]
-        elig_w = [probs[r] for r in eligible]
-        chosen_rarity = eligible[_weighted_choice(eligible, elig_w)]
-    else:
-        chosen_rarity = rarities[_weighted_choice(rarities, weights)]
-
-    if chosen_rarity not in buckets:
-        chosen_rarity = next(iter(buckets.keys()))
-
-    cat = random.choice(buckets[chosen_rarity])
-
-    db = await open_db()
-    try:
+async def open_boxes(user_id: int, box: str, n: int, price: Optional[int] = None) -> MultiBoxResult:
+    """
+    Opens n boxes of one kind as a single purchase: in one transaction the MP
+    for all of them is taken, all results are drawn (pity applied pull by
+    pull), every cat is applied and the pity counter is stored. Not enough
+    MP for all n means nothing is opened and pity is left as it was.
+    """
+    spec = BOXES[box]
+    n = max(1, min(MAX_MULTI_PULL, int(n)))
+    price = spec.price if price is None else int(price)
+
+    pool = await gacha.pool(spec.pool, spec.probs_key, spec.default_probs)
+    pity_n = int((await config_cache.get_json(f"{spec.pity_key}_pity") or {}).get("n", spec.pity_default_n))
+
+    if pool.empty:
+        return MultiBoxResult(False, "empty_pool")
+
+    total = price * n
+    now = _now()
+    await apply_passive(user_id, force=True)
+    async with connect() as db:
         cur = await db.execute("SELECT mp_balance FROM users WHERE user_id=?", (user_id,))
         u = await cur.fetchone()
         mp = 0 if u is None else int(u["mp_balance"] or 0)
-        if mp < price:
-            return BoxResult(False, "no_mp")
-        await db.execute("UPDATE users SET mp_balance = mp_balance - ? WHERE user_id=?", (price, user_id))
+        if mp < total:
+            return MultiBoxResult(False, "no_mp")
+        await db.execute("UPDATE users SET mp_balance = mp_balance - ? WHERE user_id=?", (total, user_id))
+
+        pity_counter = await _get_pity(db, user_id, spec.pity_key)
+        draws: List[CatalogCat] = []
+        for _ in range(n):
+            pity_counter += 1
+            if pity_counter >= pity_n:
+                chosen_rarity, cat = pool.pick(pool.draw_rarity(only=spec.pity_rarities))
+            else:
+                chosen_rarity, cat = pool.pick(pool.draw_rarity())
+            if chosen_rarity in spec.pity_rarities:
+                pity_counter = 0
+            draws.append(cat)
+        await _set_pity(db, user_id, spec.pity_key, pity_counter, now)
+
+        # same cat drawn several times: one read/write for all its copies
+        by_cat: Dict[int, List[int]] = {}
+        for i, cat in enumerate(draws):
+            by_cat.setdefault(cat.cat_id, []).append(i)
+        outcomes: List[Optional[dict]] = [None] * n
+        for idxs in by_cat.values():
+            cat = draws[idxs[0]]
+            for i, outcome in zip(idxs, await _apply_pulls(db, user_id, cat, len(idxs), now)):
+                outcomes[i] = outcome
         await db.commit()
-    finally:
-        await db.close()
 
-    outcome = await _add_or_dup(user_id, cat)
+    return MultiBoxResult(True, pulls=list(zip(draws, outcomes)), mp_spent=total)
 
-    if chosen_rarity in ("Epic", "Legendary", "Mythic"):
-        pity_counter = 0
-    await _set_pity(user_id, "premium", pity_counter)
 
+async def open_standard_box(user_id: int, price: int = 10) -> BoxResult:
+    res = await open_boxes(user_id, "standard", 1, price)
+    if not res.ok:
+        return BoxResult(False, res.reason)
+    cat, outcome = res.pulls[0]
+    return BoxResult(True, cat=cat, outcome=outcome)
+
+
+async def open_premium_box(user_id: int, price: int = 250) -> BoxResult:
+    res = await open_boxes(user_id, "premium", 1, price)
+    if not res.ok:
+        return BoxResult(False, res.reason)
+    cat, outcome = res.pulls[0]
     return BoxResult(True, cat=cat, outcome=outcome)
@@ -3,7 +3,8 @@ from typing import List, Tuple, Optional, Dict, Any
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from db import open_db
+from db import connect
+from paging import nav_row
 
 
 PAGE_SIZE = 6
@@ -21,13 +22,18 @@ def cats_list_keyboard(rows: List[tuple], page: int, has_prev: bool, has_next: b
             ]
         )
 
-    nav = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("Prev", callback_data=f"cat:list:{page-1}"))
-    nav.append(InlineKeyboardButton("Back", callback_data="nav:home"))
-    if has_next:
-        nav.append(InlineKeyboardButton("Next", callback_data=f"cat:list:{page+1}"))
-    buttons.append(nav)
+    # cursors: p<first id> pages back from the first row, n<last id> forward from the last
+    buttons.append(
+        nav_row(
+            "cat:list",
+            page,
+            has_prev and bool(rows),
+            has_next and bool(rows),
+            InlineKeyboardButton("Back", callback_data="nav:home"),
+            prev_cursor=f"p{rows[0][0]}" if rows else None,
+            next_cursor=f"n{rows[-1][0]}" if rows else None,
+        )
+    )
 
     return InlineKeyboardMarkup(buttons)
 
@@ -48,61 +54,142 @@ def cat_details_keyboard(user_cat_id: int) -> InlineKeyboardMarkup:
     )
 
 
-async def fetch_user_cats_page(user_id: int, page: int) -> Tuple[List[tuple], bool, bool]:
-    offset = max(0, page) * PAGE_SIZE
+# My Cats order: rarity_rank, level DESC, name, id. idx_user_cats_list serves it up to the
+# name tie-break. A cursor page reads the rest of the cursor's rarity first (seek on
+# rarity_rank = ? and level), then the following rarities (seek on rarity_rank > ? / < ?).
+_LIST_OFFSET_SQL = """
+SELECT uc.id AS user_cat_id, cc.name AS name, cc.rarity AS rarity, uc.level AS level
+FROM user_cats uc
+JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+WHERE uc.user_id=? AND uc.status='active'
+ORDER BY uc.rarity_rank ASC, uc.level DESC, cc.name ASC, uc.id ASC
+LIMIT ? OFFSET ?
+"""
 
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT
-              uc.id AS user_cat_id,
-              cc.name AS name,
-              cc.rarity AS rarity,
-              uc.level AS level
-            FROM user_cats uc
-            JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
-            WHERE uc.user_id=? AND uc.status='active'
-            ORDER BY
-              CASE LOWER(cc.rarity)
-                WHEN 'common' THEN 1
-                WHEN 'uncommon' THEN 2
-                WHEN 'rare' THEN 3
-                WHEN 'epic' THEN 4
-                WHEN 'legendary' THEN 5
-                WHEN 'mythic' THEN 6
-                WHEN 'divine' THEN 7
-                ELSE 99
-              END ASC,
-              uc.level DESC,
-              cc.name ASC
-            LIMIT ? OFFSET ?
-            """,
-            (user_id, PAGE_SIZE + 1, offset),
-        )
-        rows = await cur.fetchall()
+_LIST_AFTER_SAME_RANK_SQL = """
+SELECT uc.id AS user_cat_id, cc.name AS name, cc.rarity AS rarity, uc.level AS level
+FROM user_cats uc
+JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+WHERE uc.user_id=? AND uc.status='active' AND uc.rarity_rank = ? AND uc.level <= ?
+  AND (-uc.level, cc.name, uc.id) > (?, ?, ?)
+ORDER BY uc.level DESC, cc.name ASC, uc.id ASC
+LIMIT ?
+"""
+
+_LIST_AFTER_RANK_SQL = """
+SELECT uc.id AS user_cat_id, cc.name AS name, cc.rarity AS rarity, uc.level AS level
+FROM user_cats uc
+JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+WHERE uc.user_id=? AND uc.status='active' AND uc.rarity_rank > ?
+ORDER BY uc.rarity_rank ASC, uc.level DESC, cc.name ASC, uc.id ASC
+LIMIT ?
+"""
+
+_LIST_BEFORE_SAME_RANK_SQL = """
+SELECT uc.id AS user_cat_id, cc.name AS name, cc.rarity AS rarity, uc.level AS level
+FROM user_cats uc
+JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+WHERE uc.user_id=? AND uc.status='active' AND uc.rarity_rank = ? AND uc.level >= ?
+  AND (-uc.level, cc.name, uc.id) < (?, ?, ?)
+ORDER BY uc.level ASC, cc.name DESC, uc.id DESC
+LIMIT ?
+"""
+
+_LIST_BEFORE_RANK_SQL = """
+SELECT uc.id AS user_cat_id, cc.name AS name, cc.rarity AS rarity, uc.level AS level
+FROM user_cats uc
+JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+WHERE uc.user_id=? AND uc.status='active' AND uc.rarity_rank < ?
+ORDER BY uc.rarity_rank DESC, uc.level ASC, cc.name DESC, uc.id DESC
+LIMIT ?
+"""
+
+
+async def _seek_rows(db, user_id: int, key: tuple, forward: bool, limit: int) -> list:
+    # up to `limit` rows past the cursor key, nearest first
+    rank, neg_level, name, uc_id = key
+    same_sql, rest_sql = (
+        (_LIST_AFTER_SAME_RANK_SQL, _LIST_AFTER_RANK_SQL)
+        if forward
+        else (_LIST_BEFORE_SAME_RANK_SQL, _LIST_BEFORE_RANK_SQL)
+    )
+    cur = await db.execute(same_sql, (user_id, rank, -neg_level, neg_level, name, uc_id, limit))
+    rows = list(await cur.fetchall())
+    if len(rows) < limit:
+        cur = await db.execute(rest_sql, (user_id, rank, limit - len(rows)))
+        rows.extend(await cur.fetchall())
+    return rows
+
+
+async def _cursor_key(db, user_id: int, user_cat_id: int) -> Optional[tuple]:
+    cur = await db.execute(
+        """
+        SELECT uc.rarity_rank, uc.level, cc.name
+        FROM user_cats uc
+        JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+        WHERE uc.user_id=? AND uc.id=?
+        """,
+        (user_id, user_cat_id),
+    )
+    r = await cur.fetchone()
+    if r is None:
+        return None
+    return (int(r["rarity_rank"]), -int(r["level"]), str(r["name"]), int(user_cat_id))
+
+
+async def fetch_user_cats_page(
+    user_id: int,
+    page: int,
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+) -> Tuple[List[tuple], bool, bool]:
+    """
+    One page of My Cats. after/before are user_cat ids from the previous
+    page (its last / first row): the page resumes from that row's sort key
+    instead of skipping `page` pages with OFFSET. Without a cursor, or when
+    the cursor cat is gone, `page` is used as an offset (old buttons).
+    """
+    async with connect() as db:
+        cursor = after if after is not None else before
+        key = None if cursor is None else await _cursor_key(db, user_id, int(cursor))
+        rows = None
 
-        has_next = len(rows) > PAGE_SIZE
-        rows = rows[:PAGE_SIZE]
+        if key is not None:
+            forward = after is not None
+            # (rank, -level, name, id) increases along the list
+            rows = await _seek_rows(db, user_id, key, forward, PAGE_SIZE + 1)
+            more = len(rows) > PAGE_SIZE
+            rows = rows[:PAGE_SIZE]
+            if forward:
+                has_prev, has_next = True, more
+            elif more:
+                rows.reverse()
+                has_prev, has_next = True, True
+            else:
+                # back at the start: show a full first page
+                rows, page = None, 0
 
-        has_prev = page > 0
+        if rows is None:
+            cur = await db.execute(_LIST_OFFSET_SQL, (user_id, PAGE_SIZE + 1, max(0, page) * PAGE_SIZE))
+            rows = await cur.fetchall()
+            has_next = len(rows) > PAGE_SIZE
+            rows = rows[:PAGE_SIZE]
+            has_prev = page > 0
 
         out = [(int(r["user_cat_id"]), str(r["name"]), str(r["rarity"]), int(r["level"])) for r in rows]
         return out, has_prev, has_next
-    finally:
-        await db.close()
 
 
-async def render_user_cats_page_text(user_id: int, page: int) -> str:
-    rows, _, _ = await fetch_user_cats_page(user_id, page)
+async def render_user_cats_page_text(user_id: int, page: int, rows: Optional[List[tuple]] = None) -> str:
+    if rows is None:
+        rows, _, _ = await fetch_user_cats_page(user_id, page)
     if not rows:
         return "My Cats\n\nهیچ گربه فعالی ندارید."
     return f"My Cats\n\nPage: {page + 1}"
 
 
 async def fetch_cat_media(user_id: int, user_cat_id: int) -> Optional[Dict[str, str]]:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             """
             SELECT cc.media_type, cc.media_file_id
@@ -120,14 +207,11 @@ async def fetch_cat_media(user_id: int, user_cat_id: int) -> Optional[Dict[str,
         if not mt or not mf:
             return None
         return {"media_type": mt, "media_file_id": mf}
-    finally:
-        await db.close()
 
 
 async def render_cat_details(user_id: int, user_cat_id: int) -> str:
     now = int(time.time())
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             """
             SELECT
@@ -182,5 +266,3 @@ async def render_cat_details(user_id: int, user_cat_id: int) -> str:
             f"Last Play: {lp_txt}\n\n"
             f"{r['description']}"
         )
-    finally:
-        await db.close()
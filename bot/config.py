@@ -3,12 +3,71 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _env_int(name: str) -> int | None:
+    v = os.getenv(name, "").strip()
+    return int(v) if v else None
+
+
+def _beside_db(path: str) -> str:
+    # relative paths are taken from the database's directory, not the working directory
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), path)
+
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 DB_PATH = os.getenv("DB_PATH", "meowland.db").strip()
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Updates handled at the same time (different users only; one user's updates run in order).
+# Each running update holds a pooled connection, so the pool grows to at least this + 1.
+# Reads overlap; writes still go one unit of work at a time (see db.Session).
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+
+# Storage profile (legacy | wal | durable); the overrides below are optional
+DB_PROFILE = os.getenv("DB_PROFILE", "wal").strip().lower()
+DB_MMAP_SIZE = _env_int("DB_MMAP_SIZE")
+DB_CACHE_SIZE_KB = _env_int("DB_CACHE_SIZE_KB")
+DB_BUSY_TIMEOUT_MS = _env_int("DB_BUSY_TIMEOUT_MS")
+
+# Schema migrations (db.migrate): backfills move this many rows per transaction and sleep between chunks
+MIGRATION_BATCH_ROWS = int(os.getenv("MIGRATION_BATCH_ROWS", "2000"))
+MIGRATION_PAUSE_MS = int(os.getenv("MIGRATION_PAUSE_MS", "0"))
+
+# Config table cache; 0 keeps rows until a local write (set >0 when several processes share the DB)
+CONFIG_CACHE_TTL_SEC = int(os.getenv("CONFIG_CACHE_TTL_SEC", "0"))
+
+# Background survival sweep (dead/runaway transitions and purges)
+SWEEP_INTERVAL_SEC = int(os.getenv("SWEEP_INTERVAL_SEC", "60"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))
+SWEEP_MAX_RUN_MS = int(os.getenv("SWEEP_MAX_RUN_MS", "2000"))
+
+# economy_logs writer: batches every LOG_SINK_FLUSH_MS or LOG_SINK_BATCH_ROWS rows, buffers at most
+# LOG_SINK_MAX_ROWS; strict keeps audit rows (purchases, admin adjustments) in the caller's transaction
+LOG_SINK_FLUSH_MS = int(os.getenv("LOG_SINK_FLUSH_MS", "500"))
+LOG_SINK_BATCH_ROWS = int(os.getenv("LOG_SINK_BATCH_ROWS", "200"))
+LOG_SINK_MAX_ROWS = int(os.getenv("LOG_SINK_MAX_ROWS", "5000"))
+LOG_SINK_STRICT = os.getenv("LOG_SINK_STRICT", "1").strip().lower() in ("1", "true", "yes")
+
+# economy_logs retention, run by the sweeper (interval 0 disables it): raw rows older than
+# LOG_RETENTION_DAYS are rolled up into economy_daily, archived (gzip NDJSON per month, when
+# LOG_ARCHIVE_DIR is set; relative to DB_PATH's directory) and deleted in batches.
+# LOG_RETENTION_RULES overrides per action: "action=rollup|drop|keep[:days]", "*" and
+# "prefix_*" allowed. Audit actions (retention.AUDIT_ACTIONS) are kept unless a rule names them.
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "30"))
+LOG_RETENTION_RULES = os.getenv("LOG_RETENTION_RULES", "").strip()
+LOG_ARCHIVE_DIR = _beside_db(os.getenv("LOG_ARCHIVE_DIR", "log_archive").strip())
+LOG_RETENTION_BATCH = int(os.getenv("LOG_RETENTION_BATCH", "2000"))
+LOG_RETENTION_INTERVAL_SEC = int(os.getenv("LOG_RETENTION_INTERVAL_SEC", "3600"))
 
 # Join Gate
 REQUIRED_GROUP_CHAT_ID = int(os.getenv("REQUIRED_GROUP_CHAT_ID", "0"))
 REQUIRED_GROUP_INVITE_LINK = os.getenv("REQUIRED_GROUP_INVITE_LINK", "").strip()
+# Membership cache for the join gate; chat_member updates keep it fresh (the bot must be a group admin to get them)
+MEMBERSHIP_TTL_SEC = int(os.getenv("MEMBERSHIP_TTL_SEC", "600"))
+MEMBERSHIP_NEGATIVE_TTL_SEC = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL_SEC", "30"))
+MEMBERSHIP_PERSIST = os.getenv("MEMBERSHIP_PERSIST", "0").strip().lower() in ("1", "true", "yes")
 
 # Admin
 OWNER_ID = int(os.getenv("OWNER_ID", "0"))
@@ -0,0 +1,69 @@
+import json
+from typing import Any, Dict, Optional
+
+from config import CONFIG_CACHE_TTL_SEC
+from db import connect, on_config_write
+from reloadable import Reloadable
+
+
+class ConfigCache:
+    """
+    In-memory copy of the config table.
+
+    The whole table is loaded on first use and served from memory until
+    invalidate() is called (db.set_config does this) or, when ttl_sec > 0,
+    until the copy is older than ttl_sec. The TTL is only needed when another
+    process writes to the same database.
+    """
+
+    def __init__(self, ttl_sec: int = 0) -> None:
+        self._values: Reloadable[Dict[str, str]] = Reloadable(self._load, ttl_sec)
+
+    def invalidate(self) -> None:
+        self._values.invalidate()
+
+    async def _load(self) -> Dict[str, str]:
+        async with connect() as db:
+            cur = await db.execute("SELECT key, value FROM config")
+            rows = await cur.fetchall()
+        return {str(r["key"]): str(r["value"]) for r in rows}
+
+    async def values(self) -> Dict[str, str]:
+        return await self._values.get()
+
+    async def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return (await self.values()).get(key, default)
+
+    async def get_int(self, key: str, default: int) -> int:
+        v = await self.get(key)
+        if v is None:
+            return int(default)
+        try:
+            return int(float(v))
+        except Exception:
+            return int(default)
+
+    async def get_float(self, key: str, default: float) -> float:
+        v = await self.get(key)
+        if v is None:
+            return float(default)
+        try:
+            return float(v)
+        except Exception:
+            return float(default)
+
+    async def get_json(self, key: str) -> Optional[Any]:
+        v = await self.get(key)
+        if v is None:
+            return None
+        try:
+            return json.loads(v)
+        except Exception:
+            return None
+
+    async def get_prefix(self, prefix: str) -> Dict[str, str]:
+        return {k: v for k, v in (await self.values()).items() if k.startswith(prefix)}
+
+
+config_cache = ConfigCache(CONFIG_CACHE_TTL_SEC)
+on_config_write(config_cache.invalidate)
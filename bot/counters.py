@@ -0,0 +1,54 @@
+import time
+from typing import Iterable, List, Optional
+
+
+def day_key(ts: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(int(ts)))
+
+
+def last_days(ts: int, days: int) -> List[str]:
+    # window keys for the last `days` UTC days, today included
+    return [day_key(int(ts) - i * 86400) for i in range(max(1, int(days)))]
+
+
+async def counter_total(db, user_id: int, counter_key: str, windows: Iterable[str]) -> int:
+    keys = list(windows)
+    if not keys:
+        return 0
+    marks = ",".join("?" * len(keys))
+    cur = await db.execute(
+        f"""
+        SELECT COALESCE(SUM(count), 0) AS c
+        FROM purchase_counters
+        WHERE user_id=? AND counter_key=? AND window_key IN ({marks})
+        """,
+        (int(user_id), counter_key, *keys),
+    )
+    r = await cur.fetchone()
+    return 0 if r is None else int(r["c"] or 0)
+
+
+async def bump_counter(db, user_id: int, counter_key: str, window_key: str, cap: Optional[int] = None, n: int = 1) -> bool:
+    """
+    Adds n to one window inside the caller's transaction. With cap, the
+    increment only happens while the window stays within it; returns False
+    when that would exceed the cap.
+    """
+    now = int(time.time())
+    if cap is not None and n > cap:
+        return False
+    guard = "" if cap is None else " WHERE purchase_counters.count + excluded.count <= ?"
+    args = [int(user_id), counter_key, window_key, int(n), now]
+    if cap is not None:
+        args.append(int(cap))
+    cur = await db.execute(
+        f"""
+        INSERT INTO purchase_counters(user_id, counter_key, window_key, count, updated_at)
+        VALUES(?,?,?,?,?)
+        ON CONFLICT(user_id, counter_key, window_key) DO UPDATE
+          SET count = purchase_counters.count + excluded.count, updated_at = excluded.updated_at{guard}
+        RETURNING count
+        """,
+        args,
+    )
+    return await cur.fetchone() is not None
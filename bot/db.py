@@ -1,6 +1,23 @@
+import asyncio
+import json
 import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
 import aiosqlite
-from config import DB_PATH
+from config import (
+  DB_PATH,
+  DB_POOL_SIZE,
+  DB_PROFILE,
+  DB_MMAP_SIZE,
+  DB_CACHE_SIZE_KB,
+  DB_BUSY_TIMEOUT_MS,
+  UPDATE_CONCURRENCY,
+  MIGRATION_BATCH_ROWS,
+  MIGRATION_PAUSE_MS,
+)
 
 SCHEMA_SQL = """
 PRAGMA foreign_keys = ON;
@@ -17,6 +34,7 @@ CREATE TABLE IF NOT EXISTS users (
   last_passive_ts INTEGER,
   shelter_level INTEGER NOT NULL DEFAULT 1,
   passive_cap_hours INTEGER,
+  passive_rate_cached REAL,
   created_at INTEGER NOT NULL
 );
 
@@ -59,6 +77,8 @@ CREATE TABLE IF NOT EXISTS user_cats (
   last_play_at INTEGER,
   equipped_items_json TEXT NOT NULL DEFAULT '{}',
   obtained_at INTEGER NOT NULL,
+  feed_deadline_at INTEGER,
+  play_deadline_at INTEGER,
   FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
   FOREIGN KEY (cat_id) REFERENCES cats_catalog(cat_id)
 );
@@ -114,6 +134,18 @@ CREATE TABLE IF NOT EXISTS admin_logs (
 
 CREATE INDEX IF NOT EXISTS idx_user_cats_user ON user_cats(user_id);
 CREATE INDEX IF NOT EXISTS idx_economy_logs_user_ts ON economy_logs(user_id, ts);
+-- retention walks old rows action by action
+CREATE INDEX IF NOT EXISTS idx_economy_logs_action_ts ON economy_logs(action, ts);
+
+-- economy_logs rolled up by retention.py; day is a UTC YYYY-MM-DD like counters.day_key
+CREATE TABLE IF NOT EXISTS economy_daily (
+  user_id INTEGER NOT NULL,
+  day TEXT NOT NULL,
+  action TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  sum_amount INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, day, action)
+);
 
 CREATE TABLE IF NOT EXISTS item_shop_offers (
   offer_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -127,40 +159,941 @@ CREATE TABLE IF NOT EXISTS item_shop_offers (
 
 CREATE INDEX IF NOT EXISTS idx_item_shop_offers_active ON item_shop_offers(active);
 CREATE INDEX IF NOT EXISTS idx_item_shop_offers_item ON item_shop_offers(item_id);
+
+CREATE TABLE IF NOT EXISTS group_members (
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  status TEXT NOT NULL,
+  checked_at INTEGER NOT NULL,
+  PRIMARY KEY (chat_id, user_id)
+);
 """
 
+# cache_size is in KiB (negative form), mmap_size in bytes, busy_timeout in ms
+STORAGE_PROFILES = {
+  "legacy": {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "mmap_size": 0,
+    "cache_size": -2000,
+    "temp_store": "DEFAULT",
+    "busy_timeout": 5000,
+  },
+  "wal": {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+  },
+  "durable": {
+    "journal_mode": "WAL",
+    "synchronous": "FULL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 10000,
+  },
+}
+
+def storage_profile() -> dict:
+  if DB_PROFILE not in STORAGE_PROFILES:
+    raise ValueError(f"unknown DB_PROFILE {DB_PROFILE!r}, expected one of {', '.join(STORAGE_PROFILES)}")
+  prof = dict(STORAGE_PROFILES[DB_PROFILE])
+  if DB_MMAP_SIZE is not None:
+    prof["mmap_size"] = max(0, int(DB_MMAP_SIZE))
+  if DB_CACHE_SIZE_KB is not None:
+    prof["cache_size"] = -max(0, int(DB_CACHE_SIZE_KB))
+  if DB_BUSY_TIMEOUT_MS is not None:
+    prof["busy_timeout"] = max(0, int(DB_BUSY_TIMEOUT_MS))
+  return prof
+
+async def _apply_connection_pragmas(db: aiosqlite.Connection, prof: dict) -> None:
+  # journal_mode is persistent and is set once by init_db
+  await db.execute(f"PRAGMA synchronous = {prof['synchronous']};")
+  await db.execute(f"PRAGMA cache_size = {int(prof['cache_size'])};")
+  await db.execute(f"PRAGMA mmap_size = {int(prof['mmap_size'])};")
+  await db.execute(f"PRAGMA temp_store = {prof['temp_store']};")
+  await db.execute(f"PRAGMA busy_timeout = {int(prof['busy_timeout'])};")
+
+# per-connection statement counting, switched on by tools such as bench.py
+_count_statements = False
+
+def count_statements(enabled: bool = True) -> None:
+  global _count_statements
+  _count_statements = bool(enabled)
+
+def statement_count(db) -> int:
+  return int(getattr(db, "statements", 0))
+
+async def _install_statement_counter(db: aiosqlite.Connection) -> None:
+  db.statements = 0
+
+  def _trace(_sql: str) -> None:
+    db.statements += 1
+
+  await db.set_trace_callback(_trace)
+
 async def open_db() -> aiosqlite.Connection:
+  prof = storage_profile()
   db = await aiosqlite.connect(DB_PATH)
-  await db.execute("PRAGMA foreign_keys = ON;")
+  try:
+    await db.execute("PRAGMA foreign_keys = ON;")
+    await _apply_connection_pragmas(db, prof)
+    if _count_statements:
+      await _install_statement_counter(db)
+  except BaseException:
+    await db.close()
+    raise
   db.row_factory = aiosqlite.Row
   return db
 
-async def init_db() -> None:
-  db = await open_db()
+class _Block:
+  """
+  What connect() yields inside a unit of work. Each block keeps its writes
+  only up to its last commit(); anything written after that is rolled back
+  when the block exits, just like closing an uncommitted connection used to.
+  The real COMMIT happens once, when the unit of work ends.
+
+  Every block is a savepoint, so exiting one only undoes what was written
+  since the last commit(). commit() in a nested block keeps the enclosing
+  blocks' writes too, as it did when they shared one connection. A block
+  opened before the first write gets its savepoint when that write begins
+  the transaction (see Session.before); only the unit of work ever issues
+  a real ROLLBACK.
+  """
+
+  def __init__(self, session: "Session") -> None:
+    self._session = session
+    self._sp: Optional[str] = None
+    # written since the last commit(); see Session._scope
+    self._dirty = False
+    # callbacks registered since this block's last commit(); see Session.on_commit
+    self._on_commit: List[Callable[[], None]] = []
+    self._on_rollback: List[Callable[[], None]] = []
+
+  @property
+  def in_transaction(self) -> bool:
+    return self._session.conn.in_transaction
+
+  async def execute(self, sql: str, parameters=None):
+    await self._session.before(sql)
+    return await self._session.conn.execute(sql, parameters)
+
+  async def executemany(self, sql: str, parameters):
+    await self._session.before(sql)
+    return await self._session.conn.executemany(sql, parameters)
+
+  async def _mark(self) -> None:
+    if self._session.conn.in_transaction:
+      await self._savepoint()
+    else:
+      self._sp = None
+
+  async def _savepoint(self) -> None:
+    self._sp = self._session.savepoint_name()
+    await self._session.conn.execute(f"SAVEPOINT {self._sp}")
+
+  async def commit(self) -> None:
+    await self._session.commit_blocks()
+
+  async def rollback(self) -> None:
+    # no savepoint means nothing was written since this block's last commit
+    if self._sp is not None:
+      await self._session.conn.execute(f"ROLLBACK TO {self._sp}")
+    self._dirty = False
+    self._on_commit = []
+    fns, self._on_rollback = self._on_rollback, []
+    for fn in fns:
+      fn()
+
+  async def _close(self) -> None:
+    await self.rollback()
+    if self._sp is not None:
+      await self._session.conn.execute(f"RELEASE {self._sp}")
+
+
+# statements that make sqlite3 open a write transaction
+_WRITE_VERBS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+def _is_write(sql: str) -> bool:
+  return sql.lstrip()[:7].upper().startswith(_WRITE_VERBS)
+
+class Session:
+  """
+  One pooled connection and one transaction for the lifetime of a unit of work.
+
+  Sessions read in parallel but write one at a time: the first write takes
+  the pool's writer lock and the commit (flush() or the end of the unit of
+  work) gives it back. Waiting here is cheaper than having several
+  transactions spin on SQLite's busy_timeout for the same database lock.
+  """
+
+  def __init__(self, conn: aiosqlite.Connection, writer: Optional[asyncio.Lock] = None) -> None:
+    self.conn = conn
+    self.failed = False
+    # open blocks, outermost first
+    self._blocks: List[_Block] = []
+    self._seq = 0
+    self._on_commit: List[Callable[[], None]] = []
+    self._on_rollback: List[Callable[[], None]] = []
+    self._writer = writer
+    self._writing = False
+
+  async def before(self, sql: str) -> None:
+    if not _is_write(sql):
+      return
+    # every open block's savepoint now covers this write
+    for blk in self._blocks:
+      blk._dirty = True
+    if self.conn.in_transaction:
+      return
+    if self._writer is not None and not self._writing:
+      await self._writer.acquire()
+      self._writing = True
+    # begin here rather than implicitly, so blocks opened before this write can mark their start
+    await self.conn.execute("BEGIN")
+    for blk in self._blocks:
+      if blk._sp is None:
+        await blk._savepoint()
+
+  def end_write(self) -> None:
+    if self._writing:
+      self._writing = False
+      self._writer.release()
+
+  def savepoint_name(self) -> str:
+    self._seq += 1
+    return f"uow_{self._seq}"
+
+  def _scope(self):
+    # callbacks follow the innermost block with uncommitted writes, so they are dropped with
+    # those writes; with none they belong to work that is already kept
+    for blk in reversed(self._blocks):
+      if blk._dirty:
+        return blk
+    return self
+
+  def on_commit(self, fn: Callable[[], None]) -> None:
+    self._scope()._on_commit.append(fn)
+
+  def on_rollback(self, fn: Callable[[], None]) -> None:
+    self._scope()._on_rollback.append(fn)
+
+  async def commit_blocks(self) -> None:
+    # what a COMMIT on a shared connection used to do: keep everything written so far
+    marked = [blk for blk in self._blocks if blk._sp is not None]
+    if marked:
+      await self.conn.execute(f"RELEASE {marked[0]._sp}")
+    for blk in self._blocks:
+      self._on_commit.extend(blk._on_commit)
+      self._on_rollback.extend(blk._on_rollback)
+      blk._on_commit, blk._on_rollback = [], []
+      blk._dirty = False
+      await blk._mark()
+
+  @asynccontextmanager
+  async def block(self) -> AsyncIterator[_Block]:
+    blk = _Block(self)
+    await blk._mark()
+    self._blocks.append(blk)
+    try:
+      yield blk
+    finally:
+      self._blocks.pop()
+      await blk._close()
+
+  async def flush(self) -> None:
+    if self.failed or self._blocks or not self.conn.in_transaction:
+      return
+    try:
+      await self._commit()
+    finally:
+      self.end_write()
+    self._run_on_commit()
+
+  async def finish(self) -> None:
+    try:
+      if self.failed:
+        if self.conn.in_transaction:
+          await self.conn.rollback()
+        self._run_on_rollback()
+        return
+      if self.conn.in_transaction:
+        await self._commit()
+    finally:
+      self.end_write()
+    self._run_on_commit()
+
+  async def _commit(self) -> None:
+    try:
+      await self.conn.commit()
+    except BaseException:
+      self._run_on_rollback()
+      raise
+
+  def _run_on_commit(self) -> None:
+    self._on_rollback = []
+    fns, self._on_commit = self._on_commit, []
+    for fn in fns:
+      fn()
+
+  def _run_on_rollback(self) -> None:
+    self._on_commit = []
+    fns, self._on_rollback = self._on_rollback, []
+    for fn in fns:
+      fn()
+
+
+# connection (or unit-of-work session) held by the current task; nested connect() calls reuse it
+_held: ContextVar[Optional[object]] = ContextVar("meowland_db_held", default=None)
+
+def current_session() -> Optional[Session]:
+  held = _held.get()
+  return held if isinstance(held, Session) else None
+
+class ConnectionPool:
+  """
+  Keeps up to `size` warm aiosqlite connections open and hands them out.
+  acquire() waits while all connections are busy; release() rolls back any
+  transaction left open by the caller before the connection is reused.
+  """
+
+  def __init__(self, size: int) -> None:
+    self.size = max(1, int(size))
+    self._idle: List[aiosqlite.Connection] = []
+    self._sem: Optional[asyncio.Semaphore] = None
+    self._writer: Optional[asyncio.Lock] = None
+    self._closed = False
+
+  @property
+  def writer(self) -> asyncio.Lock:
+    # shared by every unit of work on this pool; see Session
+    if self._writer is None:
+      self._writer = asyncio.Lock()
+    return self._writer
+
+  async def acquire(self) -> aiosqlite.Connection:
+    if self._closed:
+      raise RuntimeError("connection pool is closed")
+    if self._sem is None:
+      self._sem = asyncio.Semaphore(self.size)
+    await self._sem.acquire()
+    try:
+      if self._idle:
+        return self._idle.pop()
+      return await open_db()
+    except BaseException:
+      self._sem.release()
+      raise
+
+  async def release(self, db: aiosqlite.Connection) -> None:
+    try:
+      if db.in_transaction:
+        await db.rollback()
+      if self._closed:
+        await db.close()
+      else:
+        self._idle.append(db)
+    except Exception:
+      try:
+        await db.close()
+      except Exception:
+        pass
+    finally:
+      if self._sem is not None:
+        self._sem.release()
+
+  @asynccontextmanager
+  async def connection(self) -> AsyncIterator[aiosqlite.Connection]:
+    held = _held.get()
+    if isinstance(held, Session):
+      async with held.block() as blk:
+        yield blk
+      return
+    if held is not None:
+      yield held
+      return
+
+    db = await self.acquire()
+    token = _held.set(db)
+    try:
+      yield db
+    finally:
+      _held.reset(token)
+      await self.release(db)
+
+  async def close(self) -> None:
+    self._closed = True
+    idle, self._idle = self._idle, []
+    for db in idle:
+      try:
+        await db.close()
+      except Exception:
+        pass
+
+_pool: Optional[ConnectionPool] = None
+
+def get_pool() -> ConnectionPool:
+  global _pool
+  if _pool is None:
+    # every running update holds a connection for its unit of work; +1 for the sweeper
+    _pool = ConnectionPool(max(DB_POOL_SIZE, UPDATE_CONCURRENCY + 1))
+  return _pool
+
+def connect():
+  return get_pool().connection()
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[Session]:
+  """
+  Runs everything inside on one connection and one transaction. connect()
+  calls made in the same task join the session instead of taking their own
+  connection, and the transaction is committed once on exit (rolled back if
+  the body raised or abort_unit_of_work() was called).
+  """
+  current = current_session()
+  if current is not None:
+    yield current
+    return
+
+  pool = get_pool()
+  conn = await pool.acquire()
+  session = Session(conn, pool.writer)
+  token = _held.set(session)
   try:
-    await db.executescript(SCHEMA_SQL)
+    yield session
+  except BaseException:
+    session.failed = True
+    raise
+  finally:
+    _held.reset(token)
+    try:
+      await session.finish()
+    finally:
+      await pool.release(conn)
+
+async def flush() -> None:
+  # commit what the current unit of work has done so far, so no write lock
+  # is held while we wait on the network
+  session = current_session()
+  if session is not None:
+    await session.flush()
+
+def abort_unit_of_work() -> None:
+  session = current_session()
+  if session is not None:
+    session.failed = True
+
+async def close_pool() -> None:
+  global _pool
+  pool, _pool = _pool, None
+  if pool is not None:
+    await pool.close()
+
+async def describe_storage(db: aiosqlite.Connection) -> dict:
+  out = {"profile": DB_PROFILE}
+  for name in ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout"):
+    cur = await db.execute(f"PRAGMA {name};")
+    row = await cur.fetchone()
+    out[name] = None if row is None else row[0]
+  return out
+
+async def _ensure_column(db: aiosqlite.Connection, table: str, column: str, decl: str) -> None:
+  # CREATE TABLE IF NOT EXISTS does not touch tables from older databases
+  # table_xinfo also lists generated columns
+  cur = await db.execute(f"PRAGMA table_xinfo({table});")
+  cols = {r["name"] for r in await cur.fetchall()}
+  if column not in cols:
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
+
+async def _table_exists(db: aiosqlite.Connection, name: str) -> bool:
+  cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,))
+  return await cur.fetchone() is not None
+
+# counts that used to be derived from economy_logs; window keys match counters.py
+PURCHASE_COUNTERS_SQL = """
+CREATE TABLE IF NOT EXISTS purchase_counters (
+  user_id INTEGER NOT NULL,
+  counter_key TEXT NOT NULL,
+  window_key TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  updated_at INTEGER NOT NULL,
+  PRIMARY KEY (user_id, counter_key, window_key),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+"""
+
+async def _count(db: aiosqlite.Connection, table: str, sql: str, params: tuple = ()) -> int:
+  # estimates run before the step, so its tables may not exist yet
+  if not await _table_exists(db, table):
+    return 0
+  cur = await db.execute(sql, params)
+  row = await cur.fetchone()
+  return 0 if row is None else int(row[0] or 0)
+
+async def _create_purchase_counters(db: aiosqlite.Connection) -> None:
+  await db.executescript(PURCHASE_COUNTERS_SQL)
+
+async def _estimate_purchase_counters(db: aiosqlite.Connection) -> int:
+  return await _count(
+    db,
+    "economy_logs",
+    "SELECT COUNT(1) FROM economy_logs WHERE action IN ('direct_buy', 'buy_item') AND ts >= ?",
+    (int(time.time()) - 8 * 86400,),
+  )
+
+async def _backfill_purchase_counters(db: aiosqlite.Connection, after: Optional[int], batch: int) -> Tuple[int, Optional[int]]:
+  # users in user_id order, `batch` per call; OR IGNORE keeps counters that already exist
+  cur = await db.execute(
+    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+    (-(2**63) if after is None else int(after), int(batch)),
+  )
+  ids = [int(r["user_id"]) for r in await cur.fetchall()]
+  if not ids:
+    return 0, None
+  since = int(time.time()) - 8 * 86400
+  users = json.dumps(ids)
+  touched = 0
+  cur = await db.execute(
+    """
+    INSERT OR IGNORE INTO purchase_counters(user_id, counter_key, window_key, count, updated_at)
+    SELECT user_id, 'direct_buy', json_extract(meta_json, '$.week'), COUNT(1), MAX(ts)
+    FROM economy_logs
+    WHERE user_id IN (SELECT value FROM json_each(?)) AND ts >= ?
+      AND action='direct_buy' AND json_extract(meta_json, '$.week') IS NOT NULL
+    GROUP BY user_id, json_extract(meta_json, '$.week')
+    """,
+    (users, since),
+  )
+  touched += max(0, cur.rowcount)
+  cur = await db.execute(
+    """
+    INSERT OR IGNORE INTO purchase_counters(user_id, counter_key, window_key, count, updated_at)
+    SELECT user_id, 'buy_item', strftime('%Y-%m-%d', ts, 'unixepoch'), COUNT(1), MAX(ts)
+    FROM economy_logs
+    WHERE user_id IN (SELECT value FROM json_each(?)) AND ts >= ?
+      AND action='buy_item'
+    GROUP BY user_id, strftime('%Y-%m-%d', ts, 'unixepoch')
+    """,
+    (users, since),
+  )
+  touched += max(0, cur.rowcount)
+  return touched, (ids[-1] if len(ids) == batch else None)
+
+async def _config_keys(db: aiosqlite.Connection, where: str, after: Optional[str], batch: int) -> List[str]:
+  cur = await db.execute(
+    f"SELECT key FROM config WHERE ({where}) AND key > ? ORDER BY key LIMIT ?",
+    ("" if after is None else after, int(batch)),
+  )
+  return [str(r["key"]) for r in await cur.fetchall()]
+
+PITY_KEYS = "key LIKE 'pity\\_%' ESCAPE '\\'"
+SETTINGS_KEYS = "key LIKE 'user\\_settings:%' ESCAPE '\\' AND substr(key, 15) GLOB '[0-9]*'"
+BAN_KEYS = "key LIKE 'ban:user:%' AND substr(key, 10) GLOB '[0-9]*'"
+
+async def _create_user_pity(db: aiosqlite.Connection) -> None:
+  await db.execute(
+    """
+    CREATE TABLE IF NOT EXISTS user_pity (
+      user_id INTEGER NOT NULL,
+      pool TEXT NOT NULL,
+      counter INTEGER NOT NULL DEFAULT 0,
+      updated_at INTEGER NOT NULL,
+      PRIMARY KEY (user_id, pool),
+      FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    )
+    """
+  )
+
+async def _move_pity_rows(db: aiosqlite.Connection, after: Optional[str], batch: int) -> Tuple[int, Optional[str]]:
+  # pity used to live in config as pity_{pool}_{user_id}; rows of unknown users are dropped
+  keys = await _config_keys(db, PITY_KEYS, after, batch)
+  if not keys:
+    return 0, None
+  cur = await db.execute(
+    "SELECT key, value, updated_at FROM config WHERE key IN (SELECT value FROM json_each(?))",
+    (json.dumps(keys),),
+  )
+  moved = []
+  for r in await cur.fetchall():
+    pool, _, uid = str(r["key"])[len("pity_"):].rpartition("_")
+    if not pool or not uid.lstrip("-").isdigit():
+      continue
+    try:
+      counter = int(r["value"])
+    except (TypeError, ValueError):
+      counter = 0
+    moved.append((int(uid), pool, counter, int(r["updated_at"] or 0), str(r["key"])))
+  await db.executemany(
+    """
+    INSERT INTO user_pity(user_id, pool, counter, updated_at)
+    SELECT ?, ?, ?, ?
+    WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?1)
+    ON CONFLICT(user_id, pool) DO NOTHING
+    """,
+    [m[:4] for m in moved],
+  )
+  await db.executemany("DELETE FROM config WHERE key=?", [(m[4],) for m in moved])
+  return len(moved), (keys[-1] if len(keys) == batch else None)
+
+async def _create_user_settings(db: aiosqlite.Connection) -> None:
+  await db.execute(
+    """
+    CREATE TABLE IF NOT EXISTS user_settings (
+      user_id INTEGER PRIMARY KEY,
+      notify INTEGER NOT NULL DEFAULT 1,
+      public_profile INTEGER NOT NULL DEFAULT 1,
+      lang TEXT NOT NULL DEFAULT 'fa',
+      updated_at INTEGER NOT NULL
+    )
+    """
+  )
+
+async def _move_settings_rows(db: aiosqlite.Connection, after: Optional[str], batch: int) -> Tuple[int, Optional[str]]:
+  # settings used to live in config as user_settings:{user_id} -> JSON; bad JSON gives the defaults
+  keys = await _config_keys(db, SETTINGS_KEYS, after, batch)
+  if not keys:
+    return 0, None
+  await db.execute(
+    """
+    INSERT INTO user_settings(user_id, notify, public_profile, lang, updated_at)
+    SELECT CAST(substr(key, 15) AS INTEGER),
+           CASE WHEN CAST(COALESCE(j.notify, 1) AS INTEGER) THEN 1 ELSE 0 END,
+           CASE WHEN CAST(COALESCE(j.public_profile, 1) AS INTEGER) THEN 1 ELSE 0 END,
+           CASE WHEN lower(trim(j.lang)) = 'en' THEN 'en' ELSE 'fa' END,
+           updated_at
+    FROM (
+      SELECT key, updated_at,
+             CASE WHEN json_valid(value) THEN json_extract(value, '$.notify') END AS notify,
+             CASE WHEN json_valid(value) THEN json_extract(value, '$.public_profile') END AS public_profile,
+             CASE WHEN json_valid(value) THEN json_extract(value, '$.lang') END AS lang
+      FROM config
+      WHERE key IN (SELECT value FROM json_each(?))
+    ) AS j
+    WHERE true
+    ON CONFLICT(user_id) DO NOTHING
+    """,
+    (json.dumps(keys),),
+  )
+  await db.execute("DELETE FROM config WHERE key IN (SELECT value FROM json_each(?))", (json.dumps(keys),))
+  return len(keys), (keys[-1] if len(keys) == batch else None)
+
+async def _create_user_bans(db: aiosqlite.Connection) -> None:
+  # no FK to users: admins can ban ids that never started the bot
+  await db.execute(
+    """
+    CREATE TABLE IF NOT EXISTS user_bans (
+      user_id INTEGER PRIMARY KEY,
+      reason TEXT NOT NULL DEFAULT '',
+      banned_by INTEGER,
+      banned_at INTEGER NOT NULL
+    )
+    """
+  )
+
+async def _move_ban_rows(db: aiosqlite.Connection, after: Optional[str], batch: int) -> Tuple[int, Optional[str]]:
+  # bans used to live in config as ban:user:{user_id} -> {"reason", "ts"}
+  keys = await _config_keys(db, BAN_KEYS, after, batch)
+  if not keys:
+    return 0, None
+  await db.execute(
+    """
+    INSERT INTO user_bans(user_id, reason, banned_by, banned_at)
+    SELECT CAST(substr(key, 10) AS INTEGER),
+           COALESCE(CASE WHEN json_valid(value) THEN json_extract(value, '$.reason') END, ''),
+           NULL,
+           COALESCE(CASE WHEN json_valid(value) THEN json_extract(value, '$.ts') END, updated_at)
+    FROM config
+    WHERE key IN (SELECT value FROM json_each(?))
+    ON CONFLICT(user_id) DO NOTHING
+    """,
+    (json.dumps(keys),),
+  )
+  await db.execute("DELETE FROM config WHERE key IN (SELECT value FROM json_each(?))", (json.dumps(keys),))
+  return len(keys), (keys[-1] if len(keys) == batch else None)
+
+def _config_rows(where: str) -> Callable[[aiosqlite.Connection], Awaitable[int]]:
+  async def estimate(db: aiosqlite.Connection) -> int:
+    return await _count(db, "config", f"SELECT COUNT(1) FROM config WHERE {where}")
+  return estimate
+
+async def _baseline(db: aiosqlite.Connection) -> None:
+  await db.executescript(SCHEMA_SQL)
+
+async def _users_passive_rate_column(db: aiosqlite.Connection) -> None:
+  await _ensure_column(db, "users", "passive_rate_cached", "REAL")
+
+async def _user_cats_deadlines(db: aiosqlite.Connection) -> None:
+  await _ensure_column(db, "user_cats", "feed_deadline_at", "INTEGER")
+  await _ensure_column(db, "user_cats", "play_deadline_at", "INTEGER")
+  # created here rather than in SCHEMA_SQL so older user_cats tables have the columns first
+  await db.execute("CREATE INDEX IF NOT EXISTS idx_user_cats_feed_deadline ON user_cats(status, feed_deadline_at);")
+  await db.execute("CREATE INDEX IF NOT EXISTS idx_user_cats_play_deadline ON user_cats(status, play_deadline_at);")
+
+async def _backfill_deadlines(db: aiosqlite.Connection, after: Optional[int], batch: int) -> Tuple[int, Optional[int]]:
+  # imported here: feedplay imports db
+  from feedplay import deadline_limits
+
+  cur = await db.execute(
+    "SELECT key, value FROM config WHERE key GLOB 'feed_deadline_days_*' OR key GLOB 'play_deadline_days_*'"
+  )
+  values = {str(r["key"]): str(r["value"]) for r in await cur.fetchall()}
+  cur = await db.execute(
+    "SELECT id FROM user_cats WHERE id > ? ORDER BY id LIMIT ?",
+    (0 if after is None else int(after), int(batch)),
+  )
+  ids = [int(r["id"]) for r in await cur.fetchall()]
+  if not ids:
+    return 0, None
+  cur = await db.execute("SELECT DISTINCT rarity FROM cats_catalog")
+  for r in await cur.fetchall():
+    feed_limit, play_limit = deadline_limits(str(r["rarity"]), values)
+    if feed_limit is None and play_limit is None:
+      # never expires: NULL deadlines are the final value
+      continue
+    await db.execute(
+      """
+      UPDATE user_cats
+      SET feed_deadline_at = COALESCE(NULLIF(last_feed_at, 0), obtained_at) + ?,
+          play_deadline_at = COALESCE(NULLIF(last_play_at, 0), obtained_at) + ?
+      WHERE id BETWEEN ? AND ?
+        AND (feed_deadline_at IS NULL OR play_deadline_at IS NULL)
+        AND cat_id IN (SELECT cat_id FROM cats_catalog WHERE rarity=?)
+      """,
+      (feed_limit, play_limit, ids[0], ids[-1], str(r["rarity"])),
+    )
+  return len(ids), (ids[-1] if len(ids) == batch else None)
+
+async def _user_cats_composite_indexes(db: aiosqlite.Connection) -> None:
+  # active cats of a user (passive rate, My Cats, feed/play all), covering up to the catalog join
+  await db.execute("CREATE INDEX IF NOT EXISTS idx_user_cats_user_status ON user_cats(user_id, status, cat_id, level);")
+  # one user's copy of a catalog cat (box pulls, direct buy, grants); rowid order gives ORDER BY id
+  await db.execute("CREATE INDEX IF NOT EXISTS idx_user_cats_user_cat ON user_cats(user_id, cat_id);")
+  # both start with user_id
+  await db.execute("DROP INDEX IF EXISTS idx_user_cats_user;")
+
+# My Cats order; unknown rarities sort last
+RARITY_RANK_SQL = """
+CASE lower(rarity)
+  WHEN 'common' THEN 1
+  WHEN 'uncommon' THEN 2
+  WHEN 'rare' THEN 3
+  WHEN 'epic' THEN 4
+  WHEN 'legendary' THEN 5
+  WHEN 'mythic' THEN 6
+  WHEN 'divine' THEN 7
+  ELSE 99
+END
+"""
+
+async def _rarity_rank_columns(db: aiosqlite.Connection) -> None:
+  # catalog rarity is never edited, so user_cats keeps a copy taken at insert time for its index
+  await _ensure_column(db, "cats_catalog", "rarity_rank", f"INTEGER GENERATED ALWAYS AS ({RARITY_RANK_SQL}) VIRTUAL")
+  await _ensure_column(db, "user_cats", "rarity_rank", "INTEGER NOT NULL DEFAULT 99")
+
+async def _backfill_rarity_rank(db: aiosqlite.Connection, after: Optional[int], batch: int) -> Tuple[int, Optional[int]]:
+  cur = await db.execute(
+    "SELECT id FROM user_cats WHERE id > ? ORDER BY id LIMIT ?",
+    (0 if after is None else int(after), int(batch)),
+  )
+  ids = [int(r["id"]) for r in await cur.fetchall()]
+  await db.execute(
+    """
+    UPDATE user_cats
+    SET rarity_rank = COALESCE((SELECT cc.rarity_rank FROM cats_catalog cc WHERE cc.cat_id = user_cats.cat_id), 99)
+    WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    (json.dumps(ids),),
+  )
+  if len(ids) < batch:
+    # built after the backfill so it is written once; replaces the (user_id, status, ...) index
+    await db.execute(
+      "CREATE INDEX IF NOT EXISTS idx_user_cats_list ON user_cats(user_id, status, rarity_rank, level DESC, cat_id);"
+    )
+    await db.execute("DROP INDEX IF EXISTS idx_user_cats_user_status;")
+    return len(ids), None
+  return len(ids), ids[-1]
+
+async def _create_cat_pools(db: aiosqlite.Connection) -> None:
+  # one row per pool a catalog cat drops from; NOCASE because pools_enabled was matched with LIKE
+  await db.execute(
+    """
+    CREATE TABLE IF NOT EXISTS cat_pools (
+      cat_id INTEGER NOT NULL,
+      pool TEXT NOT NULL COLLATE NOCASE,
+      PRIMARY KEY (cat_id, pool),
+      FOREIGN KEY (cat_id) REFERENCES cats_catalog(cat_id) ON DELETE CASCADE
+    )
+    """
+  )
+  await db.execute("CREATE INDEX IF NOT EXISTS idx_cat_pools_pool ON cat_pools(pool, cat_id);")
+
+async def _backfill_cat_pools(db: aiosqlite.Connection, after: Optional[int], batch: int) -> Tuple[int, Optional[int]]:
+  cur = await db.execute(
+    "SELECT cat_id, pools_enabled FROM cats_catalog WHERE cat_id > ? ORDER BY cat_id LIMIT ?",
+    (0 if after is None else int(after), int(batch)),
+  )
+  rows = await cur.fetchall()
+  await db.executemany(
+    "INSERT OR IGNORE INTO cat_pools(cat_id, pool) VALUES(?, ?)",
+    [(int(r["cat_id"]), p) for r in rows for p in str(r["pools_enabled"] or "").split(",") if p],
+  )
+  return len(rows), (int(rows[-1]["cat_id"]) if len(rows) == batch else None)
+
+def _table_rows(table: str) -> Callable[[aiosqlite.Connection], Awaitable[int]]:
+  # rows an index build has to read
+  async def estimate(db: aiosqlite.Connection) -> int:
+    return await _count(db, table, f"SELECT COUNT(1) FROM {table}")
+  return estimate
+
+@dataclass
+class Migration:
+  version: int
+  name: str
+  # schema change, run in the step's transaction
+  apply: Callable[[aiosqlite.Connection], Awaitable[None]]
+  # chunked data move: (db, cursor, batch) -> (rows touched, next cursor or None when done);
+  # every chunk commits on its own, so it must be safe to repeat after a crash
+  backfill: Optional[Callable[[aiosqlite.Connection, Any, int], Awaitable[Tuple[int, Any]]]] = None
+  # rows the step will touch, for dry runs
+  estimate: Optional[Callable[[aiosqlite.Connection], Awaitable[int]]] = None
+
+@dataclass
+class MigrationReport:
+  version: int
+  name: str
+  rows: int
+  applied: bool
+  seconds: float = 0.0
+
+# Append new steps; never edit or renumber applied ones. Databases from before schema_version
+# replay every step, so each one must also work on a schema that already has its change.
+MIGRATIONS: List[Migration] = [
+  Migration(1, "baseline", _baseline),
+  Migration(2, "users_passive_rate_cached", _users_passive_rate_column),
+  Migration(3, "user_cats_deadlines", _user_cats_deadlines, _backfill_deadlines, _table_rows("user_cats")),
+  Migration(4, "purchase_counters", _create_purchase_counters, _backfill_purchase_counters, _estimate_purchase_counters),
+  Migration(5, "user_pity", _create_user_pity, _move_pity_rows, _config_rows(PITY_KEYS)),
+  Migration(6, "user_settings", _create_user_settings, _move_settings_rows, _config_rows(SETTINGS_KEYS)),
+  Migration(7, "user_bans", _create_user_bans, _move_ban_rows, _config_rows(BAN_KEYS)),
+  Migration(8, "user_cats_composite_indexes", _user_cats_composite_indexes, estimate=_table_rows("user_cats")),
+  Migration(9, "rarity_rank", _rarity_rank_columns, _backfill_rarity_rank, _table_rows("user_cats")),
+  Migration(10, "cat_pools", _create_cat_pools, _backfill_cat_pools, _table_rows("cats_catalog")),
+]
+
+SCHEMA_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied_at INTEGER NOT NULL
+);
+"""
+
+async def schema_version(db: aiosqlite.Connection) -> int:
+  if not await _table_exists(db, "schema_version"):
+    return 0
+  cur = await db.execute("SELECT MAX(version) FROM schema_version")
+  row = await cur.fetchone()
+  return 0 if row is None or row[0] is None else int(row[0])
+
+async def migrate(
+  db: aiosqlite.Connection,
+  dry_run: bool = False,
+  target: Optional[int] = None,
+  batch: int = MIGRATION_BATCH_ROWS,
+  pause_ms: int = MIGRATION_PAUSE_MS,
+) -> List[MigrationReport]:
+  """
+  Applies the pending MIGRATIONS in order, up to `target`. Steps are
+  re-runnable rather than atomic: sqlite3 runs their DDL outside a
+  transaction, and the schema_version row is written only after the step
+  (and its backfill) finished. A step interrupted halfway runs again on the
+  next start, so every apply must be idempotent (IF NOT EXISTS,
+  _ensure_column) and every backfill must skip rows it already did.
+  Backfills run `batch` rows per transaction and yield (pause_ms) between
+  chunks so other connections get the write lock. dry_run only estimates
+  the rows each pending step would touch and writes nothing.
+  """
+  current = await schema_version(db)
+  pending = [m for m in MIGRATIONS if m.version > current and (target is None or m.version <= target)]
+  reports: List[MigrationReport] = []
+  if dry_run:
+    for m in pending:
+      rows = await m.estimate(db) if m.estimate is not None else 0
+      reports.append(MigrationReport(m.version, m.name, rows, applied=False))
+    return reports
+
+  await db.executescript(SCHEMA_VERSION_SQL)
+  batch = max(1, int(batch))
+  for m in pending:
+    started = time.monotonic()
+    rows = 0
+    if m.backfill is not None:
+      # the table has to exist before chunks can commit into it
+      await m.apply(db)
+      await db.commit()
+      cursor: Any = None
+      while True:
+        n, cursor = await m.backfill(db, cursor, batch)
+        await db.commit()
+        rows += n
+        if cursor is None:
+          break
+        await asyncio.sleep(max(0, int(pause_ms)) / 1000.0)
+    else:
+      await m.apply(db)
+    await db.execute(
+      "INSERT OR REPLACE INTO schema_version(version, name, applied_at) VALUES(?,?,?)",
+      (m.version, m.name, int(time.time())),
+    )
     await db.commit()
+    reports.append(MigrationReport(m.version, m.name, rows, applied=True, seconds=time.monotonic() - started))
+  return reports
+
+async def init_db() -> dict:
+  db = await open_db()
+  try:
+    await db.execute(f"PRAGMA journal_mode = {storage_profile()['journal_mode']};")
+    await migrate(db)
+    out = await describe_storage(db)
+    out["schema_version"] = await schema_version(db)
+    return out
   finally:
     await db.close()
 
+_config_listeners: List[Callable[[], None]] = []
+
+def on_config_write(fn: Callable[[], None]) -> None:
+  _config_listeners.append(fn)
+
+def _notify_config_listeners() -> None:
+  for fn in _config_listeners:
+    fn()
+
+def config_written() -> None:
+  _notify_config_listeners()
+  # other tasks may reload the old rows until our unit of work commits, and
+  # we may reload our own uncommitted rows before it rolls back
+  session = current_session()
+  if session is not None:
+    session.on_commit(_notify_config_listeners)
+    session.on_rollback(_notify_config_listeners)
+
 async def set_config(key: str, value: str) -> None:
   now = int(time.time())
-  db = await open_db()
-  try:
+  async with connect() as db:
     await db.execute(
       "INSERT INTO config(key, value, updated_at) VALUES(?,?,?) "
       "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
       (key, value, now),
     )
     await db.commit()
-  finally:
-    await db.close()
+  config_written()
 
 async def get_config(key: str) -> str | None:
-  db = await open_db()
-  try:
+  async with connect() as db:
     cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
     row = await cur.fetchone()
     return None if row is None else row["value"]
-  finally:
-    await db.close()
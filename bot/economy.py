@@ -1,11 +1,12 @@
-import json
 import time
 from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
 from zoneinfo import ZoneInfo
 from datetime import datetime
 
 from config import MEOW_REWARD, MEOW_COOLDOWN_SEC, MEOW_DAILY_LIMIT
-from db import open_db
+from db import connect, current_session
+from logsink import log_economy
 
 TZ = ZoneInfo("Europe/Amsterdam")
 
@@ -24,77 +25,106 @@ class MeowResult:
     mp_balance: int = 0
 
 
-async def _log(user_id: int, action: str, amount: int, meta: dict) -> None:
-    db = await open_db()
-    try:
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (user_id, action, amount, json.dumps(meta, ensure_ascii=False), int(time.time())),
-        )
-        await db.commit()
-    finally:
-        await db.close()
+class _MeowFront:
+    """
+    In-memory copy of each user's rate_limits 'meow' row (window_key, count,
+    last_ts), updated from what the database returns. Taps that this copy
+    already rejects (cooldown or daily limit) are answered without SQLite;
+    everything else goes to the conditional upsert in meow_try, which
+    re-checks the same rules against the real row.
+    """
+
+    def __init__(self, max_entries: int = 100000) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self._state: Dict[int, Tuple[str, int, Optional[int]]] = {}
+
+    def check(self, user_id: int, now: int, today: str) -> Optional[MeowResult]:
+        st = self._state.get(int(user_id))
+        if st is None or st[0] != today:
+            return None
+        _, count, last_ts = st
+        if last_ts is not None and now - int(last_ts) < MEOW_COOLDOWN_SEC:
+            wait_sec = MEOW_COOLDOWN_SEC - (now - int(last_ts))
+            return MeowResult(ok=False, reason="cooldown", wait_sec=wait_sec, remaining_today=max(0, MEOW_DAILY_LIMIT - count))
+        if count >= MEOW_DAILY_LIMIT:
+            return MeowResult(ok=False, reason="daily_limit", remaining_today=0)
+        return None
+
+    def remember(self, user_id: int, window_key: str, count: int, last_ts: Optional[int]) -> None:
+        if len(self._state) >= self.max_entries:
+            # yesterday's entries can't reject anything any more
+            today = _day_key(int(time.time()))
+            self._state = {k: v for k, v in self._state.items() if v[0] == today}
+            if len(self._state) >= self.max_entries:
+                self._state.clear()
+        self._state[int(user_id)] = (str(window_key), int(count), None if last_ts is None else int(last_ts))
+
+    def forget(self, user_id: int) -> None:
+        self._state.pop(int(user_id), None)
+
+
+_front = _MeowFront()
 
 
 async def meow_try(user_id: int) -> MeowResult:
     now = int(time.time())
     today = _day_key(now)
 
-    db = await open_db()
-    try:
+    rejected = _front.check(user_id, now, today)
+    if rejected is not None:
+        return rejected
+
+    async with connect() as db:
+        # one statement decides and counts: a new day resets the window (and the
+        # cooldown); otherwise the cooldown and the daily limit must both allow it
         cur = await db.execute(
-            "SELECT window_key, count, last_ts FROM rate_limits WHERE user_id=? AND key='meow'",
-            (user_id,),
+            """
+            INSERT INTO rate_limits(user_id, key, window_key, count, last_ts)
+            VALUES(?, 'meow', ?, 1, ?)
+            ON CONFLICT(user_id, key) DO UPDATE SET
+              count = CASE WHEN rate_limits.window_key = excluded.window_key THEN rate_limits.count + 1 ELSE 1 END,
+              window_key = excluded.window_key,
+              last_ts = excluded.last_ts
+            WHERE rate_limits.window_key <> excluded.window_key
+               OR ((rate_limits.last_ts IS NULL OR excluded.last_ts - rate_limits.last_ts >= ?)
+                   AND rate_limits.count < ?)
+            RETURNING count
+            """,
+            (int(user_id), today, now, int(MEOW_COOLDOWN_SEC), int(MEOW_DAILY_LIMIT)),
         )
         row = await cur.fetchone()
 
-        window_key = today
-        count = 0
-        last_ts = None
-
-        if row:
-            window_key = row["window_key"]
-            count = int(row["count"] or 0)
-            last_ts = row["last_ts"]
-
-        if window_key != today:
-            count = 0
-            last_ts = None
-            window_key = today
+        if row is None:
+            # the database knew better than the front (restart, another process)
+            cur = await db.execute(
+                "SELECT window_key, count, last_ts FROM rate_limits WHERE user_id=? AND key='meow'",
+                (int(user_id),),
+            )
+            rl = await cur.fetchone()
+            if rl is not None:
+                _front.remember(user_id, rl["window_key"], int(rl["count"] or 0), rl["last_ts"])
+            rejected = _front.check(user_id, now, today)
+            if rejected is not None:
+                return rejected
+            _front.forget(user_id)
+            return MeowResult(ok=False, reason="cooldown", wait_sec=1, remaining_today=0)
+
+        count = int(row["count"])
 
-        if last_ts is not None:
-            diff = now - int(last_ts)
-            if diff < MEOW_COOLDOWN_SEC:
-                wait_sec = MEOW_COOLDOWN_SEC - diff
-                await _log(user_id, "meow_reject_cooldown", 0, {"wait_sec": wait_sec})
-                return MeowResult(ok=False, reason="cooldown", wait_sec=wait_sec, remaining_today=max(0, MEOW_DAILY_LIMIT - count))
-
-        if count >= MEOW_DAILY_LIMIT:
-            await _log(user_id, "meow_reject_daily_limit", 0, {"limit": MEOW_DAILY_LIMIT})
-            return MeowResult(ok=False, reason="daily_limit", remaining_today=0)
-
-        count += 1
-        last_ts = now
-
-        await db.execute(
-            "INSERT INTO rate_limits(user_id, key, window_key, count, last_ts) VALUES(?,?,?,?,?) "
-            "ON CONFLICT(user_id, key) DO UPDATE SET window_key=excluded.window_key, count=excluded.count, last_ts=excluded.last_ts",
-            (user_id, "meow", window_key, count, last_ts),
-        )
-
-        await db.execute(
-            "UPDATE users SET mp_balance = mp_balance + ? WHERE user_id=?",
-            (MEOW_REWARD, user_id),
+        cur = await db.execute(
+            "UPDATE users SET mp_balance = mp_balance + ? WHERE user_id=? RETURNING mp_balance",
+            (MEOW_REWARD, int(user_id)),
         )
-
-        cur = await db.execute("SELECT mp_balance FROM users WHERE user_id=?", (user_id,))
         u = await cur.fetchone()
         mp = 0 if u is None else int(u["mp_balance"] or 0)
 
+        await log_economy(db, user_id, "meow", MEOW_REWARD, {"count_today": count, "limit": MEOW_DAILY_LIMIT}, ts=now)
         await db.commit()
 
-        await _log(user_id, "meow", MEOW_REWARD, {"count_today": count, "limit": MEOW_DAILY_LIMIT})
-
-        return MeowResult(ok=True, remaining_today=max(0, MEOW_DAILY_LIMIT - count), mp_balance=mp)
-    finally:
-        await db.close()
+    session = current_session()
+    if session is not None:
+        # the update can still be rolled back; only trust the new count once committed
+        session.on_commit(lambda: _front.remember(user_id, today, count, now))
+    else:
+        _front.remember(user_id, today, count, now)
+    return MeowResult(ok=True, remaining_today=max(0, MEOW_DAILY_LIMIT - count), mp_balance=mp)
@@ -3,7 +3,10 @@ import time
 from dataclasses import dataclass
 from typing import Dict, Any, Optional, List
 
-from db import open_db
+from catalog import catalog
+from config_cache import config_cache
+from db import connect
+from logsink import log_economy
 
 DEFAULT_ITEM_SLOTS = 1
 
@@ -12,20 +15,9 @@ def _now() -> int:
     return int(time.time())
 
 
-async def _cfg_int(db, key: str, default: int) -> int:
-    cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-    row = await cur.fetchone()
-    if row is None:
-        return default
-    try:
-        return int(row["value"])
-    except Exception:
-        return default
-
-
-async def _get_user_item_slots(db, user_id: int) -> int:
+async def _get_user_item_slots(user_id: int) -> int:
     # فعلاً از config می‌گیرد؛ بعداً با Shelter هماهنگ می‌شود
-    slots = await _cfg_int(db, "item_slots_default", DEFAULT_ITEM_SLOTS)
+    slots = await config_cache.get_int("item_slots_default", DEFAULT_ITEM_SLOTS)
     if slots <= 0:
         slots = 1
     return slots
@@ -57,8 +49,7 @@ class EquipResult:
 
 
 async def get_user_cat_equipped(user_id: int, user_cat_id: int) -> Optional[Dict[str, Any]]:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             "SELECT equipped_items_json FROM user_cats WHERE user_id=? AND id=?",
             (user_id, user_cat_id),
@@ -67,14 +58,15 @@ async def get_user_cat_equipped(user_id: int, user_cat_id: int) -> Optional[Dict
         if r is None:
             return None
         return _parse_equipped(r["equipped_items_json"])
-    finally:
-        await db.close()
 
 
 async def equip_item(user_id: int, user_cat_id: int, item_id: int) -> EquipResult:
     now = _now()
-    db = await open_db()
-    try:
+    # validate item exists + active
+    if await catalog.item(item_id) is None:
+        return EquipResult(False, "item_not_found")
+
+    async with connect() as db:
         # validate cat ownership
         cur = await db.execute(
             "SELECT equipped_items_json, status FROM user_cats WHERE user_id=? AND id=?",
@@ -86,15 +78,6 @@ async def equip_item(user_id: int, user_cat_id: int, item_id: int) -> EquipResul
         if str(uc["status"] or "active") != "active":
             return EquipResult(False, "cat_not_active")
 
-        # validate item exists + active
-        cur = await db.execute(
-            "SELECT item_id, name, type FROM items_catalog WHERE item_id=? AND COALESCE(active,1)=1",
-            (item_id,),
-        )
-        it = await cur.fetchone()
-        if it is None:
-            return EquipResult(False, "item_not_found")
-
         # validate user has item qty
         cur = await db.execute(
             "SELECT qty FROM user_items WHERE user_id=? AND item_id=?",
@@ -105,7 +88,7 @@ async def equip_item(user_id: int, user_cat_id: int, item_id: int) -> EquipResul
         if qty <= 0:
             return EquipResult(False, "no_item")
 
-        slots_cap = await _get_user_item_slots(db, user_id)
+        slots_cap = await _get_user_item_slots(user_id)
         equipped = _parse_equipped(uc["equipped_items_json"])
         slots: List[dict] = list(equipped.get("slots", []))
 
@@ -125,27 +108,15 @@ async def equip_item(user_id: int, user_cat_id: int, item_id: int) -> EquipResul
             (_dump_equipped(equipped), user_id, user_cat_id),
         )
 
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (
-                user_id,
-                "equip_item",
-                0,
-                json.dumps({"user_cat_id": int(user_cat_id), "item_id": int(item_id)}, ensure_ascii=False),
-                now,
-            ),
-        )
+        await log_economy(db, user_id, "equip_item", 0, {"user_cat_id": int(user_cat_id), "item_id": int(item_id)}, ts=now)
 
         await db.commit()
         return EquipResult(True, equipped=equipped)
-    finally:
-        await db.close()
 
 
 async def unequip_item(user_id: int, user_cat_id: int, item_id: int) -> EquipResult:
     now = _now()
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             "SELECT equipped_items_json FROM user_cats WHERE user_id=? AND id=?",
             (user_id, user_cat_id),
@@ -169,19 +140,8 @@ async def unequip_item(user_id: int, user_cat_id: int, item_id: int) -> EquipRes
             (_dump_equipped(equipped), user_id, user_cat_id),
         )
 
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (
-                user_id,
-                "unequip_item",
-                0,
-                json.dumps({"user_cat_id": int(user_cat_id), "item_id": int(item_id)}, ensure_ascii=False),
-                now,
-            ),
-        )
+        await log_economy(db, user_id, "unequip_item", 0, {"user_cat_id": int(user_cat_id), "item_id": int(item_id)}, ts=now)
 
         await db.commit()
         return EquipResult(True, equipped=equipped)
-    finally:
-        await db.close()
 
@@ -3,8 +3,9 @@ from typing import List, Tuple, Optional, Dict, Any
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from db import open_db
+from db import connect
 from equip import get_user_cat_equipped
+from paging import fetch_page, nav_row
 
 
 PAGE_SIZE = 6
@@ -25,11 +26,10 @@ async def _equipped_item_ids(user_id: int, user_cat_id: int) -> List[int]:
 
 async def fetch_equipable_items_page(user_id: int, user_cat_id: int, page: int) -> Tuple[List[dict], bool, bool]:
     equipped_ids = set(await _equipped_item_ids(user_id, user_cat_id))
-    page = max(0, int(page))
 
-    db = await open_db()
-    try:
-        cur = await db.execute(
+    async with connect() as db:
+        rows, has_prev, has_next = await fetch_page(
+            db,
             """
             SELECT ic.item_id, ic.name, ic.type, ui.qty
             FROM user_items ui
@@ -37,35 +37,26 @@ async def fetch_equipable_items_page(user_id: int, user_cat_id: int, page: int)
             WHERE ui.user_id=?
               AND ui.qty > 0
               AND COALESCE(ic.active,1)=1
-            ORDER BY ic.type ASC, ic.name ASC
+            ORDER BY ic.type ASC, ic.name ASC, ic.item_id ASC
             """,
             (user_id,),
+            page,
+            PAGE_SIZE,
         )
-        rows = await cur.fetchall()
 
-        all_items = []
-        for r in rows:
-            iid = int(r["item_id"])
-            all_items.append(
-                {
-                    "item_id": iid,
-                    "name": str(r["name"]),
-                    "type": str(r["type"] or ""),
-                    "qty": int(r["qty"] or 0),
-                    "equipped": iid in equipped_ids,
-                }
-            )
-
-        start = page * PAGE_SIZE
-        chunk = all_items[start : start + PAGE_SIZE + 1]
-
-        has_next = len(chunk) > PAGE_SIZE
-        chunk = chunk[:PAGE_SIZE]
-        has_prev = page > 0
-
-        return chunk, has_prev, has_next
-    finally:
-        await db.close()
+    items = []
+    for r in rows:
+        iid = int(r["item_id"])
+        items.append(
+            {
+                "item_id": iid,
+                "name": str(r["name"]),
+                "type": str(r["type"] or ""),
+                "qty": int(r["qty"] or 0),
+                "equipped": iid in equipped_ids,
+            }
+        )
+    return items, has_prev, has_next
 
 
 async def equipped_summary_text(user_id: int, user_cat_id: int) -> str:
@@ -101,12 +92,7 @@ def equip_list_kb(user_cat_id: int, items: List[dict], page: int, has_prev: bool
         else:
             rows.append([InlineKeyboardButton(label, callback_data=f"eq:eq:{user_cat_id}:{it['item_id']}")])
 
-    nav = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("Prev", callback_data=f"eq:list:{user_cat_id}:{page-1}"))
-    nav.append(InlineKeyboardButton("Back", callback_data=f"cat:open:{user_cat_id}"))
-    if has_next:
-        nav.append(InlineKeyboardButton("Next", callback_data=f"eq:list:{user_cat_id}:{page+1}"))
-    rows.append(nav)
+    back = InlineKeyboardButton("Back", callback_data=f"cat:open:{user_cat_id}")
+    rows.append(nav_row(f"eq:list:{user_cat_id}", page, has_prev, has_next, back))
 
     return InlineKeyboardMarkup(rows)
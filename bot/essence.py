@@ -1,9 +1,9 @@
-import json
 import time
 from dataclasses import dataclass
 from typing import Optional
 
-from db import open_db
+from db import connect
+from logsink import log_economy
 
 
 def _now() -> int:
@@ -11,23 +11,17 @@ def _now() -> int:
 
 
 async def _ensure(user_id: int) -> None:
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute("INSERT OR IGNORE INTO resources(user_id, essence) VALUES(?, 0)", (int(user_id),))
         await db.commit()
-    finally:
-        await db.close()
 
 
 async def get_essence(user_id: int) -> int:
     await _ensure(user_id)
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT essence FROM resources WHERE user_id=?", (int(user_id),))
         r = await cur.fetchone()
         return 0 if r is None else int(r["essence"] or 0)
-    finally:
-        await db.close()
 
 
 @dataclass
@@ -42,21 +36,15 @@ async def add_essence(user_id: int, amount: int, reason: str = "add_essence", me
     ts = _now()
     await _ensure(user_id)
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute("UPDATE resources SET essence = essence + ? WHERE user_id=?", (amt, int(user_id)))
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (int(user_id), reason, int(amt), json.dumps(meta or {}, ensure_ascii=False), int(ts)),
-        )
+        await log_economy(db, user_id, reason, amt, meta, ts=ts)
         await db.commit()
 
         cur = await db.execute("SELECT essence FROM resources WHERE user_id=?", (int(user_id),))
         r = await cur.fetchone()
         bal = 0 if r is None else int(r["essence"] or 0)
         return EssenceOpResult(True, new_balance=bal)
-    finally:
-        await db.close()
 
 
 async def spend_essence(user_id: int, amount: int, reason: str = "spend_essence", meta: dict | None = None) -> EssenceOpResult:
@@ -64,8 +52,7 @@ async def spend_essence(user_id: int, amount: int, reason: str = "spend_essence"
     ts = _now()
     await _ensure(user_id)
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT essence FROM resources WHERE user_id=?", (int(user_id),))
         r = await cur.fetchone()
         bal = 0 if r is None else int(r["essence"] or 0)
@@ -74,15 +61,10 @@ async def spend_essence(user_id: int, amount: int, reason: str = "spend_essence"
             return EssenceOpResult(False, "no_essence", new_balance=bal)
 
         await db.execute("UPDATE resources SET essence = essence - ? WHERE user_id=?", (amt, int(user_id)))
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (int(user_id), reason, -int(amt), json.dumps(meta or {}, ensure_ascii=False), int(ts)),
-        )
+        await log_economy(db, user_id, reason, -amt, meta, ts=ts, audit=True)
         await db.commit()
 
         cur2 = await db.execute("SELECT essence FROM resources WHERE user_id=?", (int(user_id),))
         r2 = await cur2.fetchone()
         bal2 = 0 if r2 is None else int(r2["essence"] or 0)
         return EssenceOpResult(True, new_balance=bal2)
-    finally:
-        await db.close()
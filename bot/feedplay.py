@@ -1,9 +1,19 @@
-import json
+import asyncio
+import contextvars
+import logging
 import time
 from dataclasses import dataclass
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Set, Tuple
 
-from db import open_db
+from catalog import CatalogCat, catalog
+from config_cache import config_cache
+from db import connect, current_session
+from logsink import log_economy, log_economy_many, log_row
+from passive import apply_passive, adjust_passive_rate, cat_passive_rate, settle_users
+
+log = logging.getLogger("meowland.feedplay")
+
+DEADLINE_REFRESH_BATCH = 500
 
 
 def _now() -> int:
@@ -31,20 +41,13 @@ FEED_DEADLINE_DAYS = {
 }
 
 
-async def _cfg_int(db, key: str, default: int) -> int:
-    cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-    row = await cur.fetchone()
-    if row is None:
-        return default
+def _cfg_days(values: Dict[str, str], key: str, default_days: int) -> int:
+    # same parsing as config_cache.get_int
     try:
-        return int(float(row["value"]))
+        v = int(float(values[key])) if key in values else int(default_days)
     except Exception:
-        return default
-
-
-async def _cfg_days(db, key: str, default_days: int) -> int:
-    v = await _cfg_int(db, key, default_days)
-    return max(0, int(v))
+        v = int(default_days)
+    return max(0, v)
 
 
 @dataclass
@@ -55,131 +58,301 @@ class FeedPlayResult:
     affected: int = 0
 
 
-async def apply_survival(user_id: int) -> None:
+@dataclass
+class SweepResult:
+    dead: int = 0
+    runaway: int = 0
+    purged: int = 0
+
+
+def deadline_limits(rarity: str, values: Dict[str, str]) -> Tuple[Optional[int], Optional[int]]:
     """
-    قوانین:
-    - اگر feed از deadline رد شود => dead
-    - اگر play از deadline رد شود => runaway
-    - runaway بعد از recover_window حذف می‌شود
-    - dead بعد از dead_archive_hours حذف می‌شود
-    نکته: برای ذخیره timestamp وضعیت‌ها، از last_play_at برای runaway_at و last_feed_at برای dead_at استفاده می‌کنیم.
+    (feed, play) in seconds for a rarity, from config `values`; None = بی‌نهایت (Divine).
+    Plain function so migrations can use it with the config rows they read themselves.
     """
-    now = _now()
+    play_days = _cfg_days(values, f"play_deadline_days_{rarity}", PLAY_DEADLINE_DAYS.get(rarity, 2))
+    feed_days = _cfg_days(values, f"feed_deadline_days_{rarity}", FEED_DEADLINE_DAYS.get(rarity, 2))
+    feed_limit = int(feed_days) * 86400 if feed_days < 10**8 else None
+    play_limit = int(play_days) * 86400 if play_days < 10**8 else None
+    return feed_limit, play_limit
 
-    db = await open_db()
-    try:
-        runaway_hours = await _cfg_int(db, "runaway_recover_window_hours", 24)
-        dead_archive_hours = await _cfg_int(db, "dead_archive_hours", 12)
 
-        runaway_seconds = max(0, int(runaway_hours)) * 3600
-        dead_seconds = max(0, int(dead_archive_hours)) * 3600
+async def _deadline_limits(rarity: str) -> Tuple[Optional[int], Optional[int]]:
+    return deadline_limits(rarity, await config_cache.values())
 
-        # 1) پاکسازی runaway های قدیمی
-        cur = await db.execute(
-            """
-            SELECT id, last_play_at
-            FROM user_cats
-            WHERE user_id=? AND status='runaway'
-            """,
-            (int(user_id),),
-        )
-        rows = await cur.fetchall()
-        for r in rows:
-            ts = int(r["last_play_at"] or 0)
-            if runaway_seconds > 0 and ts > 0 and (now - ts) > runaway_seconds:
-                await db.execute("DELETE FROM user_cats WHERE user_id=? AND id=?", (int(user_id), int(r["id"])))
 
-        # 2) پاکسازی dead های قدیمی
+def is_deadline_config_key(key: str) -> bool:
+    return key.startswith("feed_deadline_days_") or key.startswith("play_deadline_days_")
+
+
+async def refresh_deadlines(
+    db,
+    user_id: Optional[int] = None,
+    user_cat_id: Optional[int] = None,
+    rarity: Optional[str] = None,
+) -> None:
+    """
+    Recomputes feed_deadline_at / play_deadline_at from last_feed_at /
+    last_play_at for one user's cats or one cat. Call it on the same
+    connection after writing those columns or inserting a cat; does not
+    commit. A deadline config change goes through schedule_deadline_refresh().
+    """
+    if user_id is None and user_cat_id is None:
+        raise ValueError("refresh_deadlines needs a user_id or user_cat_id")
+    if rarity is not None:
+        rarities = [rarity]
+    elif user_cat_id is not None:
         cur = await db.execute(
-            """
-            SELECT id, last_feed_at
-            FROM user_cats
-            WHERE user_id=? AND status='dead'
+            "SELECT cc.rarity FROM user_cats uc JOIN cats_catalog cc ON cc.cat_id = uc.cat_id WHERE uc.id=?",
+            (int(user_cat_id),),
+        )
+        r = await cur.fetchone()
+        if r is None:
+            return
+        rarities = [str(r["rarity"])]
+    else:
+        cur = await db.execute("SELECT DISTINCT rarity FROM cats_catalog")
+        rarities = [str(r["rarity"]) for r in await cur.fetchall()]
+
+    where = ""
+    extra: List[Any] = []
+    if user_id is not None:
+        where += " AND user_id=?"
+        extra.append(int(user_id))
+    if user_cat_id is not None:
+        where += " AND id=?"
+        extra.append(int(user_cat_id))
+
+    for rar in rarities:
+        feed_limit, play_limit = await _deadline_limits(rar)
+        await db.execute(
+            f"""
+            UPDATE user_cats
+            SET feed_deadline_at = COALESCE(NULLIF(last_feed_at, 0), obtained_at) + ?,
+                play_deadline_at = COALESCE(NULLIF(last_play_at, 0), obtained_at) + ?
+            WHERE cat_id IN (SELECT cat_id FROM cats_catalog WHERE rarity=?){where}
             """,
-            (int(user_id),),
+            [feed_limit, play_limit, rar, *extra],
         )
-        rows = await cur.fetchall()
-        for r in rows:
-            ts = int(r["last_feed_at"] or 0)
-            if dead_seconds > 0 and ts > 0 and (now - ts) > dead_seconds:
-                await db.execute("DELETE FROM user_cats WHERE user_id=? AND id=?", (int(user_id), int(r["id"])))
 
-        # 3) بررسی active ها
-        cur = await db.execute(
-            """
-            SELECT uc.id, uc.cat_id, uc.last_feed_at, uc.last_play_at, uc.obtained_at, cc.rarity
-            FROM user_cats uc
-            JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
-            WHERE uc.user_id=? AND uc.status='active'
-            """,
-            (int(user_id),),
+
+async def refresh_rarity_deadlines(rarity: str, batch: int = DEADLINE_REFRESH_BATCH) -> int:
+    """
+    Recomputes the deadlines of every cat of one rarity, `batch` cats per
+    committed chunk in id order, so other writers get the lock between
+    chunks; run it outside a unit of work (schedule_deadline_refresh()).
+    Returns the number of cats updated.
+    """
+    feed_limit, play_limit = await _deadline_limits(rarity)
+    batch = max(1, int(batch))
+    done = 0
+    after = 0
+    while True:
+        async with connect() as db:
+            cur = await db.execute(
+                """
+                UPDATE user_cats
+                SET feed_deadline_at = COALESCE(NULLIF(last_feed_at, 0), obtained_at) + ?,
+                    play_deadline_at = COALESCE(NULLIF(last_play_at, 0), obtained_at) + ?
+                WHERE id IN (
+                  SELECT id FROM user_cats
+                  WHERE id > ? AND cat_id IN (SELECT cat_id FROM cats_catalog WHERE rarity=?)
+                  ORDER BY id
+                  LIMIT ?
+                )
+                RETURNING id
+                """,
+                (feed_limit, play_limit, after, rarity, batch),
+            )
+            ids = [int(r["id"]) for r in await cur.fetchall()]
+            await db.commit()
+        done += len(ids)
+        if len(ids) < batch:
+            return done
+        after = max(ids)
+        await asyncio.sleep(0)
+
+
+_refresh_task: Optional[asyncio.Task] = None
+_refresh_pending: Set[str] = set()
+
+
+async def _refresh_loop() -> None:
+    while _refresh_pending:
+        rarity = _refresh_pending.pop()
+        try:
+            n = await refresh_rarity_deadlines(rarity)
+            log.info("deadline refresh: rarity=%s cats=%s", rarity, n)
+        except Exception:
+            log.exception("deadline refresh for %s failed", rarity)
+
+
+def _start_deadline_refresh(rarity: str) -> None:
+    global _refresh_task
+    # a rarity changed again mid-pass is simply queued once more
+    _refresh_pending.add(rarity)
+    if _refresh_task is not None and not _refresh_task.done():
+        return
+    # fresh context: never inherit the caller's unit of work
+    _refresh_task = asyncio.get_running_loop().create_task(
+        _refresh_loop(), name="deadline-refresh", context=contextvars.Context()
+    )
+
+
+def schedule_deadline_refresh(rarity: str) -> None:
+    """Runs refresh_rarity_deadlines(rarity) in the background once the caller's unit of work commits."""
+    session = current_session()
+    if session is not None:
+        session.on_commit(lambda: _start_deadline_refresh(rarity))
+    else:
+        _start_deadline_refresh(rarity)
+
+
+async def stop_deadline_refresh() -> None:
+    global _refresh_task
+    task, _refresh_task = _refresh_task, None
+    _refresh_pending.clear()
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+async def _transition(db, kind: str, now: int, budget: int, user_id) -> List[Any]:
+    """
+    Moves active cats whose deadline has passed; a range scan on
+    (status, *_deadline_at). Returns the rows that changed.
+    """
+    if budget <= 0:
+        return []
+    status, col, deadline = ("dead", "last_feed_at", "feed_deadline_at") if kind == "dead" else ("runaway", "last_play_at", "play_deadline_at")
+    user_sql = "" if user_id is None else " AND user_id=?"
+    args: List[Any] = [int(now), int(now)]
+    if user_id is not None:
+        args.append(int(user_id))
+    args.append(budget)
+    cur = await db.execute(
+        f"""
+        UPDATE user_cats SET status='{status}', {col}=?
+        WHERE id IN (
+          SELECT id FROM user_cats
+          WHERE status='active' AND {deadline} < ?{user_sql}
+          LIMIT ?
         )
-        active = await cur.fetchall()
+        RETURNING id, user_id, cat_id, level
+        """,
+        args,
+    )
+    return list(await cur.fetchall())
+
+
+async def _purge(db, status: str, col: str, max_age: int, now: int, budget: int, user_id) -> int:
+    if max_age <= 0 or budget <= 0:
+        return 0
+    user_sql = "" if user_id is None else " AND user_id=?"
+    args: List[Any] = [int(now) - max_age]
+    if user_id is not None:
+        args.append(int(user_id))
+    args.append(budget)
+    cur = await db.execute(
+        f"""
+        DELETE FROM user_cats
+        WHERE id IN (
+          SELECT id FROM user_cats
+          WHERE status='{status}' AND {col} > 0 AND {col} < ?{user_sql}
+          LIMIT ?
+        )
+        """,
+        args,
+    )
+    return max(0, int(cur.rowcount))
+
+
+async def _sweep_chunk(cats: Dict[int, CatalogCat], now: int, batch: int, user_id) -> SweepResult:
+    res = SweepResult()
+    async with connect() as db:
+        runaway_hours = await config_cache.get_int("runaway_recover_window_hours", 24)
+        dead_archive_hours = await config_cache.get_int("dead_archive_hours", 12)
+
+        # 1) پاکسازی runaway و dead های قدیمی
+        res.purged += await _purge(db, "runaway", "last_play_at", max(0, int(runaway_hours)) * 3600, now, batch, user_id)
+        res.purged += await _purge(db, "dead", "last_feed_at", max(0, int(dead_archive_hours)) * 3600, now, batch - res.purged, user_id)
+
+        # 2) active ها؛ مرگ اولویت بالاتر دارد
+        dead = await _transition(db, "dead", now, batch, user_id)
+        runaway = await _transition(db, "runaway", now, batch - len(dead), user_id)
+        res.dead, res.runaway = len(dead), len(runaway)
+
+        changed = [("cat_dead", r) for r in dead] + [("cat_runaway", r) for r in runaway]
+        if changed:
+            # درآمد تا این لحظه با نرخ قبلی حساب شود
+            await settle_users(db, (int(r["user_id"]) for _, r in changed), now)
+
+            lost: Dict[int, float] = {}
+            logs = []
+            for action, r in changed:
+                cat = cats.get(int(r["cat_id"]))
+                rarity = cat.rarity if cat else "Common"
+                base_rate = cat.base_passive_rate if cat else 0.0
+                uid = int(r["user_id"])
+                lost[uid] = lost.get(uid, 0.0) + await cat_passive_rate(rarity, base_rate, int(r["level"] or 1))
+                meta = {"user_cat_id": int(r["id"]), "cat_id": int(r["cat_id"]), "rarity": rarity}
+                logs.append(log_row(uid, action, 0, meta, now))
+
+            for uid, rate in lost.items():
+                await adjust_passive_rate(db, uid, -rate)
+            await log_economy_many(db, logs)
 
-        for r in active:
-            rarity = str(r["rarity"] or "Common")
-            obtained_at = int(r["obtained_at"] or now)
+        await db.commit()
+    return res
 
-            last_feed = int(r["last_feed_at"] or obtained_at)
-            last_play = int(r["last_play_at"] or obtained_at)
 
-            # override از config (اختیاری)
-            play_days = await _cfg_days(db, f"play_deadline_days_{rarity}", PLAY_DEADLINE_DAYS.get(rarity, 2))
-            feed_days = await _cfg_days(db, f"feed_deadline_days_{rarity}", FEED_DEADLINE_DAYS.get(rarity, 2))
+async def sweep_survival(user_id: Optional[int] = None, batch: int = 500, max_run_ms: int = 0) -> SweepResult:
+    """
+    قوانین:
+    - اگر feed از deadline رد شود => dead
+    - اگر play از deadline رد شود => runaway
+    - runaway بعد از recover_window حذف می‌شود
+    - dead بعد از dead_archive_hours حذف می‌شود
+    نکته: برای ذخیره timestamp وضعیت‌ها، از last_play_at برای runaway_at و last_feed_at برای dead_at استفاده می‌کنیم.
 
-            play_limit = int(play_days) * 86400
-            feed_limit = int(feed_days) * 86400
+    Works on all users (or one) with set-based statements, batch rows per
+    transaction, until nothing is left or max_run_ms (0 = no limit) passes.
+    """
+    started = time.monotonic()
+    now = _now()
+    batch = max(1, int(batch))
 
-            # Divine: بی‌نهایت
-            if play_days >= 10**8:
-                play_limit = 10**18
-            if feed_days >= 10**8:
-                feed_limit = 10**18
+    cats = (await catalog.current()).cats
 
-            # مرگ اولویت بالاتر دارد
-            if (now - last_feed) > feed_limit:
-                await db.execute(
-                    "UPDATE user_cats SET status='dead', last_feed_at=? WHERE user_id=? AND id=?",
-                    (int(now), int(user_id), int(r["id"])),
-                )
-                await db.execute(
-                    "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                    (
-                        int(user_id),
-                        "cat_dead",
-                        0,
-                        json.dumps({"user_cat_id": int(r["id"]), "cat_id": int(r["cat_id"]), "rarity": rarity}, ensure_ascii=False),
-                        int(now),
-                    ),
-                )
-                continue
+    total = SweepResult()
+    while True:
+        res = await _sweep_chunk(cats, now, batch, user_id)
+        total.dead += res.dead
+        total.runaway += res.runaway
+        total.purged += res.purged
+        if res.dead + res.runaway + res.purged < batch:
+            break
+        if max_run_ms > 0 and (time.monotonic() - started) * 1000 >= max_run_ms:
+            break
+    return total
 
-            if (now - last_play) > play_limit:
-                await db.execute(
-                    "UPDATE user_cats SET status='runaway', last_play_at=? WHERE user_id=? AND id=?",
-                    (int(now), int(user_id), int(r["id"])),
-                )
-                await db.execute(
-                    "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-                    (
-                        int(user_id),
-                        "cat_runaway",
-                        0,
-                        json.dumps({"user_cat_id": int(r["id"]), "cat_id": int(r["cat_id"]), "rarity": rarity}, ensure_ascii=False),
-                        int(now),
-                    ),
-                )
 
-        await db.commit()
-    finally:
-        await db.close()
+async def apply_survival(user_id: int) -> None:
+    """One user's overdue cats die / run away now instead of at the next sweep tick."""
+    await sweep_survival(user_id)
 
 
 async def feed_all(user_id: int) -> FeedPlayResult:
+    # an overdue cat must not be fed back to life before the sweeper reaches it
+    await apply_survival(user_id)
     now = _now()
-    db = await open_db()
-    try:
-        cost_per_cat = await _cfg_int(db, "feed_cost_per_cat_mp", 1)
+    await apply_passive(user_id, force=True)
+    async with connect() as db:
+        cost_per_cat = await config_cache.get_int("feed_cost_per_cat_mp", 1)
 
         cur = await db.execute(
             "SELECT COUNT(1) AS c FROM user_cats WHERE user_id=? AND status='active'",
@@ -204,29 +377,20 @@ async def feed_all(user_id: int) -> FeedPlayResult:
             "UPDATE user_cats SET last_feed_at=? WHERE user_id=? AND status='active'",
             (int(now), int(user_id)),
         )
+        await refresh_deadlines(db, user_id=user_id)
 
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (
-                int(user_id),
-                "feed_all",
-                -int(total_cost),
-                json.dumps({"count": int(cnt), "cost_per_cat": int(cost_per_cat)}, ensure_ascii=False),
-                int(now),
-            ),
-        )
+        await log_economy(db, user_id, "feed_all", -int(total_cost), {"count": int(cnt), "cost_per_cat": int(cost_per_cat)}, ts=now)
 
         await db.commit()
         return FeedPlayResult(True, mp_spent=int(total_cost), affected=int(cnt))
-    finally:
-        await db.close()
 
 
 async def play_all(user_id: int) -> FeedPlayResult:
+    await apply_survival(user_id)
     now = _now()
-    db = await open_db()
-    try:
-        cost_per_cat = await _cfg_int(db, "play_cost_per_cat_mp", 1)
+    await apply_passive(user_id, force=True)
+    async with connect() as db:
+        cost_per_cat = await config_cache.get_int("play_cost_per_cat_mp", 1)
 
         cur = await db.execute(
             "SELECT COUNT(1) AS c FROM user_cats WHERE user_id=? AND status='active'",
@@ -251,19 +415,9 @@ async def play_all(user_id: int) -> FeedPlayResult:
             "UPDATE user_cats SET last_play_at=? WHERE user_id=? AND status='active'",
             (int(now), int(user_id)),
         )
+        await refresh_deadlines(db, user_id=user_id)
 
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (
-                int(user_id),
-                "play_all",
-                -int(total_cost),
-                json.dumps({"count": int(cnt), "cost_per_cat": int(cost_per_cat)}, ensure_ascii=False),
-                int(now),
-            ),
-        )
+        await log_economy(db, user_id, "play_all", -int(total_cost), {"count": int(cnt), "cost_per_cat": int(cost_per_cat)}, ts=now)
 
         await db.commit()
         return FeedPlayResult(True, mp_spent=int(total_cost), affected=int(cnt))
-    finally:
-        await db.close()
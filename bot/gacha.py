@@ -0,0 +1,184 @@
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from catalog import CatalogCat, catalog, on_catalog_write
+from config import CONFIG_CACHE_TTL_SEC
+from config_cache import config_cache
+from reloadable import Reloadable
+
+# boxes never drop Divine cats
+GACHA_EXCLUDED_RARITIES = ("Divine",)
+
+
+class AliasTable:
+    """Walker's alias method: O(n) to build, O(1) per draw, same odds as the weights."""
+
+    __slots__ = ("prob", "alias")
+
+    def __init__(self, weights: Sequence[float]) -> None:
+        n = len(weights)
+        if n == 0:
+            raise ValueError("alias table needs at least one weight")
+        w = [max(0.0, float(x)) for x in weights]
+        total = sum(w)
+        if total <= 0:
+            # the old linear scan picked the first entry when every weight was 0
+            w = [1.0] + [0.0] * (n - 1)
+            total = 1.0
+        scaled = [x * n / total for x in w]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, x in enumerate(scaled) if x < 1.0]
+        large = [i for i, x in enumerate(scaled) if x >= 1.0]
+        while small and large:
+            s = small.pop()
+            g = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = g
+            scaled[g] = (scaled[g] + scaled[s]) - 1.0
+            (small if scaled[g] < 1.0 else large).append(g)
+        # leftovers are 1.0 up to float error
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self, rng: random.Random = random) -> int:
+        i = int(rng.random() * len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+@dataclass
+class GachaPool:
+    """One pool compiled against one probability table and one catalog snapshot."""
+
+    name: str
+    probs_src: Optional[str]
+    version: int
+    rarities: List[str]
+    weights: List[float]
+    table: AliasTable
+    buckets: Dict[str, List[CatalogCat]]
+    # first rarity present in the pool; used when the drawn rarity has no cats
+    fallback: Optional[str]
+    _subsets: Dict[Tuple[str, ...], Tuple[List[str], AliasTable]] = field(default_factory=dict)
+
+    @property
+    def empty(self) -> bool:
+        return not self.buckets
+
+    def draw_rarity(self, only: Optional[Sequence[str]] = None, rng: random.Random = random) -> str:
+        """Rarity by the pool's odds; `only` restricts the draw (pity) keeping relative odds."""
+        if only is None:
+            return self.rarities[self.table.sample(rng)]
+        key = tuple(only)
+        sub = self._subsets.get(key)
+        if sub is None:
+            names = [r for r in self.rarities if r in key]
+            if not names:
+                return self.draw_rarity(rng=rng)
+            sub = (names, AliasTable([self.weights[self.rarities.index(r)] for r in names]))
+            self._subsets[key] = sub
+        return sub[0][sub[1].sample(rng)]
+
+    def pick(self, rarity: str, rng: random.Random = random) -> Tuple[str, CatalogCat]:
+        if rarity not in self.buckets:
+            rarity = self.fallback
+        bucket = self.buckets[rarity]
+        return rarity, bucket[int(rng.random() * len(bucket))]
+
+
+@dataclass
+class _Snapshot:
+    version: int
+    # first available_from / available_until boundary after the load
+    valid_until: Optional[int]
+    # (cat, pools it is enabled in, lower-cased as cat_pools compares them)
+    cats: List[Tuple[CatalogCat, Tuple[str, ...]]]
+
+
+class GachaEngine:
+    """
+    Compiled box pools. The catalog store is read once into a snapshot; each
+    pool is compiled from it into an alias table over rarities plus per-rarity
+    cat lists, then reused until the catalog changes (catalog_written()), its
+    probability config value changes, or the next available_from/until
+    boundary passes. ttl_sec works as in Reloadable.
+    """
+
+    def __init__(self, ttl_sec: int = 0) -> None:
+        self._snapshot: Reloadable[_Snapshot] = Reloadable(self._load, ttl_sec, expired=self._expired)
+        # compiled from _pools_snapshot only; see pool()
+        self._pools: Dict[str, GachaPool] = {}
+        self._pools_snapshot: Optional[_Snapshot] = None
+
+    def invalidate(self) -> None:
+        self._snapshot.invalidate()
+        self._pools.clear()
+
+    @staticmethod
+    def _expired(snap: _Snapshot) -> bool:
+        return snap.valid_until is not None and int(time.time()) >= snap.valid_until
+
+    async def _load(self) -> _Snapshot:
+        gen = self._snapshot.gen
+        now = int(time.time())
+        rows = (await catalog.current()).cats.values()
+
+        cats: List[Tuple[CatalogCat, Tuple[str, ...]]] = []
+        valid_until: Optional[int] = None
+        for c in rows:
+            if not c.active or c.rarity in GACHA_EXCLUDED_RARITIES:
+                continue
+            af = c.available_from
+            au = c.available_until
+            if au is not None and au < now:
+                continue
+            if af is not None and af > now:
+                # not yet available: only its start matters
+                boundary = af
+            else:
+                # available; drops out once `until` has passed (until itself is inclusive)
+                boundary = None if au is None else au + 1
+                cats.append((c, tuple(p.lower() for p in c.pools)))
+            if boundary is not None and (valid_until is None or boundary < valid_until):
+                valid_until = boundary
+
+        return _Snapshot(version=gen, valid_until=valid_until, cats=cats)
+
+    async def pool(self, name: str, probs_key: str, default_probs: Dict[str, float]) -> GachaPool:
+        snap = await self._snapshot.get()
+        if snap is self._snapshot.peek() and snap is not self._pools_snapshot:
+            # a newer snapshot was kept; pools compiled from the old one are stale
+            self._pools.clear()
+            self._pools_snapshot = snap
+        probs_src = await config_cache.get(probs_key)
+        compiled = self._pools.get(name)
+        if compiled is not None and compiled.version == snap.version and compiled.probs_src == probs_src:
+            return compiled
+
+        probs = await config_cache.get_json(probs_key) or default_probs
+        rarities = list(probs.keys())
+        weights = [float(probs[r]) for r in rarities]
+        wanted = name.lower()
+        buckets: Dict[str, List[CatalogCat]] = {}
+        for cat, pools in snap.cats:
+            if wanted in pools and cat.rarity in probs:
+                buckets.setdefault(cat.rarity, []).append(cat)
+        compiled = GachaPool(
+            name=name,
+            probs_src=probs_src,
+            version=snap.version,
+            rarities=rarities,
+            weights=weights,
+            table=AliasTable(weights),
+            buckets=buckets,
+            fallback=next(iter(buckets), None),
+        )
+        if snap is self._pools_snapshot:
+            self._pools[name] = compiled
+        return compiled
+
+
+gacha = GachaEngine(CONFIG_CACHE_TTL_SEC)
+on_catalog_write(gacha.invalidate)
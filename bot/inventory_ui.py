@@ -2,23 +2,15 @@ from typing import List, Tuple
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from items import list_user_items
+from items import list_user_items_page
+from paging import nav_row
 
 
 PAGE_SIZE = 7
 
 
 async def fetch_inventory_page(user_id: int, page: int) -> Tuple[List[dict], bool, bool]:
-    all_items = await list_user_items(user_id)
-    page = max(0, int(page))
-
-    start = page * PAGE_SIZE
-    end = start + PAGE_SIZE + 1
-    chunk = all_items[start:end]
-
-    has_next = len(chunk) > PAGE_SIZE
-    chunk = chunk[:PAGE_SIZE]
-    has_prev = page > 0
+    chunk, has_prev, has_next = await list_user_items_page(user_id, page, PAGE_SIZE)
 
     rows = []
     for it in chunk:
@@ -49,13 +41,7 @@ def inventory_kb(items: List[dict], page: int, has_prev: bool, has_next: bool) -
             ]
         )
 
-    nav = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("Prev", callback_data=f"inv:list:{page-1}"))
-    nav.append(InlineKeyboardButton("Back", callback_data="nav:home"))
-    if has_next:
-        nav.append(InlineKeyboardButton("Next", callback_data=f"inv:list:{page+1}"))
-    rows.append(nav)
+    rows.append(nav_row("inv:list", page, has_prev, has_next, InlineKeyboardButton("Back", callback_data="nav:home")))
 
     return InlineKeyboardMarkup(rows)
 
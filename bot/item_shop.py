@@ -1,7 +1,13 @@
+import time
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
-from db import open_db
+from config_cache import config_cache
+from counters import bump_counter, counter_total, day_key, last_days
+from db import connect
+from logsink import log_economy
+from paging import fetch_page
+from passive import apply_passive
 
 
 @dataclass
@@ -21,34 +27,21 @@ class BuyItemResult:
     price: int | None = None
 
 
-async def _cfg_int(key: str, default: int) -> int:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-        row = await cur.fetchone()
-        if row is None:
-            return default
-        try:
-            return int(row["value"])
-        except Exception:
-            return default
-    finally:
-        await db.close()
-
-
-async def list_items_for_sale() -> List[ItemForSale]:
-    db = await open_db()
-    try:
-        cur = await db.execute(
+async def list_items_for_sale(page: int, page_size: int) -> Tuple[List[ItemForSale], bool, bool]:
+    async with connect() as db:
+        rows, has_prev, has_next = await fetch_page(
+            db,
             """
             SELECT o.offer_id, o.item_id, o.price, c.name, c.type
             FROM item_shop_offers o
             JOIN items_catalog c ON c.item_id=o.item_id
             WHERE o.active=1 AND c.active=1
             ORDER BY o.offer_id DESC
-            """
+            """,
+            (),
+            page,
+            page_size,
         )
-        rows = await cur.fetchall()
         out: List[ItemForSale] = []
         for r in rows:
             out.append(
@@ -60,14 +53,11 @@ async def list_items_for_sale() -> List[ItemForSale]:
                     price=int(r["price"]),
                 )
             )
-        return out
-    finally:
-        await db.close()
+        return out, has_prev, has_next
 
 
 async def get_item_for_sale(item_id: int) -> Optional[ItemForSale]:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             """
             SELECT o.offer_id, o.item_id, o.price, c.name, c.type
@@ -89,28 +79,19 @@ async def get_item_for_sale(item_id: int) -> Optional[ItemForSale]:
             type=str(r["type"]),
             price=int(r["price"]),
         )
-    finally:
-        await db.close()
+
+
+async def _weekly_used(db, user_id: int, now: int) -> int:
+    # purchases over the last 7 UTC days, from per-day counters
+    return await counter_total(db, user_id, "buy_item", last_days(now, 7))
 
 
 async def _weekly_cap_ok(user_id: int, cap: int) -> bool:
     if cap <= 0:
         return True
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT COUNT(1) AS c
-            FROM economy_logs
-            WHERE user_id=? AND action='buy_item' AND ts >= (strftime('%s','now') - 7*24*3600)
-            """,
-            (int(user_id),),
-        )
-        r = await cur.fetchone()
-        used = int(r["c"]) if r else 0
+    async with connect() as db:
+        used = await _weekly_used(db, user_id, int(time.time()))
         return used < cap
-    finally:
-        await db.close()
 
 
 async def buy_item(user_id: int, item_id: int, qty: int = 1) -> BuyItemResult:
@@ -121,14 +102,14 @@ async def buy_item(user_id: int, item_id: int, qty: int = 1) -> BuyItemResult:
     if offer is None:
         return BuyItemResult(ok=False, reason="not_found")
 
-    cap = await _cfg_int("item_shop_weekly_cap", 0)
+    cap = await config_cache.get_int("item_shop_weekly_cap", 0)
     if not await _weekly_cap_ok(user_id, cap):
         return BuyItemResult(ok=False, reason="weekly_cap")
 
     total_price = int(offer.price) * int(qty)
 
-    db = await open_db()
-    try:
+    await apply_passive(user_id, force=True)
+    async with connect() as db:
         cur = await db.execute("SELECT mp_balance FROM users WHERE user_id=?", (int(user_id),))
         u = await cur.fetchone()
         if u is None:
@@ -138,6 +119,11 @@ async def buy_item(user_id: int, item_id: int, qty: int = 1) -> BuyItemResult:
         if mp < total_price:
             return BuyItemResult(ok=False, reason="no_mp")
 
+        now = int(time.time())
+        if cap > 0 and await _weekly_used(db, user_id, now) >= cap:
+            return BuyItemResult(ok=False, reason="weekly_cap")
+        await bump_counter(db, user_id, "buy_item", day_key(now))
+
         await db.execute("UPDATE users SET mp_balance=mp_balance-? WHERE user_id=?", (total_price, int(user_id)))
 
         await db.execute(
@@ -149,20 +135,15 @@ async def buy_item(user_id: int, item_id: int, qty: int = 1) -> BuyItemResult:
             (int(user_id), int(offer.item_id), int(qty), "{}"),
         )
 
-        await db.execute(
-            """
-            INSERT INTO economy_logs(user_id, action, amount, meta_json, ts)
-            VALUES(?,?,?,?,strftime('%s','now'))
-            """,
-            (
-                int(user_id),
-                "buy_item",
-                -int(total_price),
-                f'{{"item_id":{int(offer.item_id)},"qty":{int(qty)},"price":{int(offer.price)}}}',
-            ),
+        await log_economy(
+            db,
+            user_id,
+            "buy_item",
+            -int(total_price),
+            {"item_id": int(offer.item_id), "qty": int(qty), "price": int(offer.price)},
+            ts=now,
+            audit=True,
         )
 
         await db.commit()
         return BuyItemResult(ok=True, name=offer.name, price=int(total_price))
-    finally:
-        await db.close()
@@ -3,6 +3,7 @@ from typing import List, Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from item_shop import list_items_for_sale, get_item_for_sale
+from paging import nav_row
 
 
 PAGE_SIZE = 7
@@ -22,16 +23,7 @@ async def item_shop_root_text() -> str:
 
 
 async def fetch_item_shop_page(page: int) -> Tuple[List[dict], bool, bool]:
-    all_items = await list_items_for_sale()
-    page = max(0, int(page))
-
-    start = page * PAGE_SIZE
-    end = start + PAGE_SIZE + 1
-    chunk = all_items[start:end]
-
-    has_next = len(chunk) > PAGE_SIZE
-    chunk = chunk[:PAGE_SIZE]
-    has_prev = page > 0
+    chunk, has_prev, has_next = await list_items_for_sale(page, PAGE_SIZE)
 
     rows = []
     for it in chunk:
@@ -62,13 +54,7 @@ def item_shop_list_kb(items: List[dict], page: int, has_prev: bool, has_next: bo
             ]
         )
 
-    nav = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("Prev", callback_data=f"ishop:list:{page-1}"))
-    nav.append(InlineKeyboardButton("Back", callback_data="ishop:root"))
-    if has_next:
-        nav.append(InlineKeyboardButton("Next", callback_data=f"ishop:list:{page+1}"))
-    rows.append(nav)
+    rows.append(nav_row("ishop:list", page, has_prev, has_next, InlineKeyboardButton("Back", callback_data="ishop:root")))
 
     return InlineKeyboardMarkup(rows)
 
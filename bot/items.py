@@ -1,7 +1,9 @@
 from dataclasses import dataclass
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 
-from db import open_db
+from catalog import catalog
+from db import connect
+from paging import fetch_page
 
 
 @dataclass
@@ -14,10 +16,21 @@ class UserItemRow:
     active: int
 
 
-async def list_user_items(user_id: int) -> List[UserItemRow]:
-    db = await open_db()
-    try:
-        cur = await db.execute(
+def _item_row(r) -> UserItemRow:
+    return UserItemRow(
+        item_id=int(r["item_id"]),
+        name=str(r["name"]),
+        type=str(r["type"] or ""),
+        qty=int(r["qty"] or 0),
+        tradable=int(r["tradable"] or 0),
+        active=int(r["active"] or 1),
+    )
+
+
+async def list_user_items_page(user_id: int, page: int, page_size: int) -> Tuple[List[UserItemRow], bool, bool]:
+    async with connect() as db:
+        rows, has_prev, has_next = await fetch_page(
+            db,
             """
             SELECT
               ic.item_id,
@@ -31,63 +44,35 @@ async def list_user_items(user_id: int) -> List[UserItemRow]:
             WHERE ui.user_id=?
               AND ui.qty > 0
               AND COALESCE(ic.active, 1)=1
-            ORDER BY ic.type ASC, ic.name ASC
+            ORDER BY ic.type ASC, ic.name ASC, ic.item_id ASC
             """,
             (user_id,),
+            page,
+            page_size,
         )
-        rows = await cur.fetchall()
-        out: List[UserItemRow] = []
-        for r in rows:
-            out.append(
-                UserItemRow(
-                    item_id=int(r["item_id"]),
-                    name=str(r["name"]),
-                    type=str(r["type"] or ""),
-                    qty=int(r["qty"] or 0),
-                    tradable=int(r["tradable"] or 0),
-                    active=int(r["active"] or 1),
-                )
-            )
-        return out
-    finally:
-        await db.close()
+    return [_item_row(r) for r in rows], has_prev, has_next
 
 
 async def get_item_basic(item_id: int) -> Optional[Dict[str, Any]]:
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT item_id, name, type, effect_json, durability_rules_json, tradable, active
-            FROM items_catalog
-            WHERE item_id=?
-            """,
-            (item_id,),
-        )
-        r = await cur.fetchone()
-        if r is None:
-            return None
-        return {
-            "item_id": int(r["item_id"]),
-            "name": str(r["name"]),
-            "type": str(r["type"] or ""),
-            "effect_json": str(r["effect_json"] or ""),
-            "durability_rules_json": str(r["durability_rules_json"] or ""),
-            "tradable": int(r["tradable"] or 0),
-            "active": int(r["active"] or 1),
-        }
-    finally:
-        await db.close()
+    it = await catalog.item(item_id, active_only=False)
+    if it is None:
+        return None
+    return {
+        "item_id": it.item_id,
+        "name": it.name,
+        "type": it.type,
+        "effect_json": it.effect_json,
+        "durability_rules_json": it.durability_rules_json,
+        "tradable": it.tradable,
+        "active": it.active,
+    }
 
 
 async def user_item_qty(user_id: int, item_id: int) -> int:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute(
             "SELECT qty FROM user_items WHERE user_id=? AND item_id=?",
             (user_id, item_id),
         )
         r = await cur.fetchone()
         return 0 if r is None else int(r["qty"] or 0)
-    finally:
-        await db.close()
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import LOG_SINK_FLUSH_MS, LOG_SINK_BATCH_ROWS, LOG_SINK_MAX_ROWS, LOG_SINK_STRICT
+from db import connect, current_session
+
+log = logging.getLogger("meowland.logsink")
+
+INSERT_SQL = "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)"
+
+# (user_id, action, amount, meta_json, ts)
+LogRow = Tuple[int, str, int, str, int]
+
+
+def log_row(user_id: int, action: str, amount: int, meta: Optional[Dict[str, Any]] = None, ts: Optional[int] = None) -> LogRow:
+    return (
+        int(user_id),
+        str(action),
+        int(amount),
+        json.dumps(meta or {}, ensure_ascii=False),
+        int(time.time()) if ts is None else int(ts),
+    )
+
+
+class EconomyLogSink:
+    """
+    Buffers economy_logs rows and writes them in batches from a background
+    task: after flush_ms, or as soon as batch_rows are waiting.
+
+    Rows logged inside a unit of work are buffered only when it commits, so a
+    rolled-back update leaves no log behind; rows of a connect() block that
+    exits without commit() are dropped with its writes. Their room is reserved when they
+    are logged, so the buffer never holds more than max_rows. write() never
+    waits, since its caller may be holding the write lock the writer needs:
+    when the buffer is full the rows go inline into the caller's
+    transaction. wait_for_room() is the backpressure point for callers that
+    are not in a transaction yet. Audit rows are written in the caller's
+    transaction when strict is on. Without a running sink everything is
+    written inline, as before.
+    """
+
+    def __init__(self, flush_ms: int, batch_rows: int, max_rows: int, strict: bool = True) -> None:
+        self.flush_ms = max(1, int(flush_ms))
+        self.batch_rows = max(1, int(batch_rows))
+        self.max_rows = max(self.batch_rows, int(max_rows))
+        self.strict = bool(strict)
+        self.dropped = 0
+        self._rows: List[LogRow] = []
+        # rows of uncommitted units of work that already have room in the buffer
+        self._reserved = 0
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._room: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done() and not self._stopping
+
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def _has_room(self, n: int) -> bool:
+        return len(self._rows) + self._reserved + n <= self.max_rows
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._room = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="economy-log-sink")
+
+    async def stop(self) -> None:
+        # writes out everything still buffered
+        task, self._task = self._task, None
+        if task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await task
+
+    def _put(self, rows: Sequence[LogRow]) -> None:
+        if not self.running:
+            # stopped between the caller's check and its commit; the rows are gone with it
+            self.dropped += len(rows)
+            log.error("log sink stopped, dropped %s economy_logs rows", len(rows))
+            return
+        was_empty = not self._rows
+        self._rows.extend(rows)
+        if was_empty or len(self._rows) >= self.batch_rows:
+            self._wake.set()
+
+    def _release(self, n: int) -> None:
+        self._reserved -= n
+        self._room.set()
+
+    async def wait_for_room(self, n: int = 1) -> None:
+        """
+        Waits (at most a few flush periods) until the buffer has room for n
+        more rows. Call it before opening a unit of work, never inside one.
+        """
+        if not self.running or self._has_room(n):
+            return
+        deadline = time.monotonic() + max(1.0, 4 * self.flush_ms / 1000.0)
+        while self.running and not self._has_room(n):
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            self._room.clear()
+            self._wake.set()
+            try:
+                await asyncio.wait_for(self._room.wait(), timeout=left)
+            except asyncio.TimeoutError:
+                return
+
+    async def _write(self, rows: List[LogRow]) -> None:
+        async with connect() as db:
+            for i in range(0, len(rows), self.batch_rows):
+                await db.executemany(INSERT_SQL, rows[i : i + self.batch_rows])
+            await db.commit()
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            if not self._rows:
+                if self._stopping:
+                    return
+                await self._wake.wait()
+                continue
+            if len(self._rows) < self.batch_rows and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.flush_ms / 1000.0)
+                except asyncio.TimeoutError:
+                    pass
+            rows, self._rows = self._rows, []
+            try:
+                await self._write(rows)
+            except Exception:
+                log.exception("economy_logs batch of %s rows failed", len(rows))
+                if not self._stopping and len(self._rows) + len(rows) <= self.max_rows:
+                    self._rows[:0] = rows
+                    await asyncio.sleep(1)
+                else:
+                    self.dropped += len(rows)
+            self._room.set()
+
+    async def write(self, db, rows: Sequence[LogRow], audit: bool = False) -> None:
+        if not rows:
+            return
+        rows = list(rows)
+        if (audit and self.strict) or not self.running or not self._has_room(len(rows)):
+            await db.executemany(INSERT_SQL, rows)
+            return
+        session = current_session()
+        if session is None:
+            self._put(rows)
+            return
+        n = len(rows)
+        self._reserved += n
+
+        def committed() -> None:
+            self._release(n)
+            self._put(rows)
+
+        session.on_commit(committed)
+        session.on_rollback(lambda: self._release(n))
+
+
+sink = EconomyLogSink(LOG_SINK_FLUSH_MS, LOG_SINK_BATCH_ROWS, LOG_SINK_MAX_ROWS, strict=LOG_SINK_STRICT)
+
+
+async def log_economy(
+    db,
+    user_id: int,
+    action: str,
+    amount: int,
+    meta: Optional[Dict[str, Any]] = None,
+    ts: Optional[int] = None,
+    audit: bool = False,
+) -> None:
+    """
+    Records one economy_logs row. audit=True (purchases, admin adjustments)
+    keeps it in db's transaction while the sink is strict; other rows are
+    buffered. Either way the caller still commits db as usual.
+    """
+    await sink.write(db, [log_row(user_id, action, amount, meta, ts)], audit=audit)
+
+
+async def log_economy_many(db, rows: Sequence[LogRow], audit: bool = False) -> None:
+    await sink.write(db, rows, audit=audit)
+
+
+async def wait_for_log_room() -> None:
+    await sink.wait_for_room()
+
+
+def start_log_sink() -> None:
+    sink.start()
+
+
+async def stop_log_sink() -> None:
+    await sink.stop()
@@ -2,11 +2,16 @@
 import asyncio
 import logging
 import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
 from telegram.error import TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -19,12 +24,17 @@ from config import (
     REQUIRED_GROUP_CHAT_ID,
     REQUIRED_GROUP_INVITE_LINK,
     OWNER_ID,
+    UPDATE_CONCURRENCY,
 )
-from db import init_db, open_db, get_config
+from db import init_db, connect, close_pool, unit_of_work, flush, abort_unit_of_work
+from config_cache import config_cache
+from membership import membership
+from bans import bans
+from catalog import catalog
 from ui import home_keyboard, back_home_keyboard, render_home_text
 from economy import meow_try
-from passive import apply_passive
-from cats import open_standard_box, open_premium_box
+from passive import apply_passive, stop_rate_rebuild
+from cats import open_standard_box, open_premium_box, open_boxes
 from cats_ui import (
     fetch_user_cats_page,
     cats_list_keyboard,
@@ -33,7 +43,10 @@ from cats_ui import (
     cat_details_keyboard,
     fetch_cat_media,
 )
-from feedplay import apply_survival, feed_all, play_all
+from feedplay import apply_survival, feed_all, play_all, refresh_deadlines, stop_deadline_refresh
+from sweeper import start_sweeper, stop_sweeper
+from logsink import start_log_sink, stop_log_sink, wait_for_log_room
+from paging import parse_page_cb
 
 from admin import (
     is_admin,
@@ -62,6 +75,7 @@ from admin import (
     admin_ban_handle_message,
     admin_ban_confirm,
     admin_ban_cancel,
+    admin_rebuild_rates,
     admin_logs_page,
 )
 from admin_items import (
@@ -150,29 +164,12 @@ def _user_id_from_update(update: Update) -> int | None:
     return None
 
 
-async def _cfg_int(key: str, default: int) -> int:
-    v = await get_config(key)
-    if v is None:
-        return int(default)
-    try:
-        return int(float(v))
-    except Exception:
-        return int(default)
-
-
-async def _cfg_str(key: str, default: str) -> str:
-    v = await get_config(key)
-    if v is None:
-        return default
-    return str(v)
-
-
 async def _required_group_chat_id() -> int:
-    return await _cfg_int("required_group_chat_id", int(REQUIRED_GROUP_CHAT_ID))
+    return await config_cache.get_int("required_group_chat_id", int(REQUIRED_GROUP_CHAT_ID))
 
 
 async def _required_group_invite_link() -> str:
-    return await _cfg_str("required_group_invite_link", str(REQUIRED_GROUP_INVITE_LINK or ""))
+    return str(await config_cache.get("required_group_invite_link", str(REQUIRED_GROUP_INVITE_LINK or "")))
 
 
 async def _join_keyboard() -> InlineKeyboardMarkup:
@@ -186,6 +183,7 @@ async def _join_keyboard() -> InlineKeyboardMarkup:
 
 async def _send_or_edit_join_gate(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
     kb = await _join_keyboard()
+    await flush()
     if update.callback_query and update.callback_query.message:
         try:
             await update.callback_query.message.edit_text(text, reply_markup=kb)
@@ -196,7 +194,7 @@ async def _send_or_edit_join_gate(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text(text, reply_markup=kb)
 
 
-async def _check_join_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+async def _check_join_gate(update: Update, context: ContextTypes.DEFAULT_TYPE, fresh: bool = False) -> bool:
     user_id = _user_id_from_update(update)
     if user_id is None:
         return False
@@ -211,9 +209,7 @@ async def _check_join_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return False
 
     try:
-        member = await context.bot.get_chat_member(int(gid), int(user_id))
-        status = getattr(member, "status", None)
-        ok = status in ("member", "administrator", "creator")
+        ok = await membership.is_member(context.bot, int(gid), int(user_id), fresh=fresh)
         if not ok:
             await _send_or_edit_join_gate(update, context, "برای استفاده باید عضو گروه باشید.")
         return ok
@@ -223,10 +219,28 @@ async def _check_join_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return False
 
 
+async def group_member_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # joins/leaves in the required group replace the cached join-gate answer
+    cmu = update.chat_member
+    if cmu is None:
+        return
+    gid = await _required_group_chat_id()
+    if int(gid) == 0 or int(cmu.chat.id) != int(gid):
+        return
+    new = cmu.new_chat_member
+    await membership.record(int(gid), int(new.user.id), new.status)
+
+
 async def _ensure_user(user_id: int) -> None:
     now = int(time.time())
-    db = await open_db()
-    try:
+    async with connect() as db:
+        # most updates come from known users; skip the write transaction for them
+        cur = await db.execute(
+            "SELECT 1 FROM users u JOIN resources r ON r.user_id = u.user_id WHERE u.user_id=?",
+            (int(user_id),),
+        )
+        if await cur.fetchone() is not None:
+            return
         await db.execute(
             "INSERT OR IGNORE INTO users(user_id, mp_balance, last_passive_ts, shelter_level, created_at) "
             "VALUES(?, 0, ?, 1, ?)",
@@ -234,16 +248,15 @@ async def _ensure_user(user_id: int) -> None:
         )
         await db.execute("INSERT OR IGNORE INTO resources(user_id, essence) VALUES(?, 0)", (int(user_id),))
         await db.commit()
-    finally:
-        await db.close()
 
 
 async def _touch_economy(user_id: int) -> None:
+    # survival (dead/runaway) is handled by the background sweeper
     await apply_passive(user_id)
-    await apply_survival(user_id)
 
 
 async def _edit_or_reply(update: Update, text: str, reply_markup: InlineKeyboardMarkup | None = None) -> None:
+    await flush()
     if update.callback_query and update.callback_query.message:
         try:
             await update.callback_query.message.edit_text(text, reply_markup=reply_markup)
@@ -259,25 +272,35 @@ async def _send_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, media: d
     fid = media.get("media_file_id")
     if not mt or not fid:
         return
+    await flush()
     if mt == "photo":
         await context.bot.send_photo(chat_id=chat_id, photo=fid)
     elif mt == "video":
         await context.bot.send_video(chat_id=chat_id, video=fid)
 
 
+async def _send_media_group(context: ContextTypes.DEFAULT_TYPE, chat_id: int, medias: List[dict]) -> None:
+    unique = []
+    for m in medias:
+        mt = m.get("media_type")
+        fid = m.get("media_file_id")
+        if mt in ("photo", "video") and fid and all(fid != u[1] for u in unique):
+            unique.append((mt, fid))
+    if len(unique) < 2:
+        # an album needs at least two items
+        for mt, fid in unique:
+            await _send_media(context, chat_id, {"media_type": mt, "media_file_id": fid})
+        return
+    await flush()
+    items = [InputMediaPhoto(fid) if mt == "photo" else InputMediaVideo(fid) for mt, fid in unique[:10]]
+    await context.bot.send_media_group(chat_id=chat_id, media=items)
+
+
 async def _send_catalog_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, cat_id: int) -> None:
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            "SELECT media_type, media_file_id FROM cats_catalog WHERE cat_id=? AND active=1",
-            (int(cat_id),),
-        )
-        r = await cur.fetchone()
-    finally:
-        await db.close()
-    if r is None:
+    c = await catalog.cat(cat_id)
+    if c is None:
         return
-    await _send_media(context, chat_id, {"media_type": r["media_type"], "media_file_id": r["media_file_id"]})
+    await _send_media(context, chat_id, {"media_type": c.media_type, "media_file_id": c.media_file_id})
 
 
 async def show_home(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -299,7 +322,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def verify_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.callback_query:
         await update.callback_query.answer()
-    if not await _check_join_gate(update, context):
+    # the user pressed Verify after joining: don't trust a cached "not a member"
+    if not await _check_join_gate(update, context, fresh=True):
         return
     await show_home(update, context)
 
@@ -307,8 +331,14 @@ async def verify_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 def _shop_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
-            [InlineKeyboardButton("Standard Box", callback_data="shop:std")],
-            [InlineKeyboardButton("Premium Box", callback_data="shop:prem")],
+            [
+                InlineKeyboardButton("Standard Box", callback_data="shop:std"),
+                InlineKeyboardButton("Open x10", callback_data="shop:std:x10"),
+            ],
+            [
+                InlineKeyboardButton("Premium Box", callback_data="shop:prem"),
+                InlineKeyboardButton("Open x10", callback_data="shop:prem:x10"),
+            ],
             [InlineKeyboardButton("Direct Purchase", callback_data="dshop:root")],
             [InlineKeyboardButton("Item Shop", callback_data="ishop:root")],
             [InlineKeyboardButton("Back", callback_data="nav:home")],
@@ -408,6 +438,60 @@ async def shop_prem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await _edit_or_reply(update, text, _shop_keyboard())
 
 
+async def shop_multi(update: Update, context: ContextTypes.DEFAULT_TYPE, box: str, n: int) -> None:
+    user_id = _user_id_from_update(update)
+    if user_id is None:
+        return
+    await _ensure_user(user_id)
+    await _touch_economy(user_id)
+
+    title = "Standard" if box == "standard" else "Premium"
+    res = await open_boxes(user_id, box, n)
+    if not res.ok:
+        msg = "Shop error."
+        if res.reason == "no_mp":
+            msg = "MP کافی نیست."
+        elif res.reason == "empty_pool":
+            msg = f"کاتالوگ برای {title} خالی است."
+        await _edit_or_reply(update, msg, _shop_keyboard())
+        return
+
+    if update.effective_chat:
+        await _send_media_group(
+            context,
+            update.effective_chat.id,
+            [{"media_type": c.media_type, "media_file_id": c.media_file_id} for c, _ in res.pulls],
+        )
+
+    # one line per cat, in the order they were first drawn
+    summary: Dict[int, dict] = {}
+    for cat, out in res.pulls:
+        row = summary.setdefault(cat.cat_id, {"cat": cat, "count": 0, "new": False, "level_ups": 0, "level": 1, "essence": 0})
+        row["count"] += 1
+        row["new"] = row["new"] or out.get("type") == "new"
+        row["level_ups"] += 1 if out.get("level_up") else 0
+        row["level"] = int(out.get("level") or row["level"])
+        row["essence"] += int(out.get("essence") or 0)
+
+    lines = [f"{title} Box x{len(res.pulls)} نتیجه:", ""]
+    for row in summary.values():
+        line = f"{row['cat'].name} ({row['cat'].rarity}) ×{row['count']}"
+        notes = []
+        if row["new"]:
+            notes.append("New cat!")
+        if row["level_ups"]:
+            notes.append(f"Level Up! (Lvl {row['level']})")
+        elif not row["new"]:
+            notes.append(f"Lvl {row['level']}")
+        if row["essence"]:
+            notes.append(f"+{row['essence']} Essence")
+        lines.append(line + " — " + ", ".join(notes))
+    lines.append("")
+    lines.append(f"MP: -{res.mp_spent}")
+
+    await _edit_or_reply(update, "\n".join(lines), _shop_keyboard())
+
+
 # --- Direct Purchase ---
 async def dshop_root(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     txt = await direct_shop_root_text()
@@ -432,19 +516,13 @@ async def dshop_list(update: Update, context: ContextTypes.DEFAULT_TYPE, rarity:
 
 
 async def dshop_buy_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int) -> None:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT name, rarity FROM cats_catalog WHERE cat_id=?", (int(cat_id),))
-        r = await cur.fetchone()
-    finally:
-        await db.close()
-
-    if r is None:
+    c = await catalog.cat(cat_id, active_only=False)
+    if c is None:
         await _edit_or_reply(update, "Not found.", direct_shop_root_kb())
         return
 
-    name = str(r["name"])
-    rarity = str(r["rarity"])
+    name = c.name
+    rarity = c.rarity
     if rarity not in DSHOP_RARITIES:
         await _edit_or_reply(update, "Not allowed.", direct_shop_root_kb())
         return
@@ -515,10 +593,7 @@ async def dshop_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if data.startswith("dshop:list:") and len(parts) == 4:
         rarity = parts[2]
-        try:
-            page = int(parts[3])
-        except Exception:
-            page = 0
+        page, _ = parse_page_cb(data, f"dshop:list:{rarity}")
         await dshop_list(update, context, rarity, page)
         return
 
@@ -603,10 +678,7 @@ async def ishop_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     if data.startswith("ishop:list:") and len(parts) == 3:
-        try:
-            page = int(parts[2])
-        except Exception:
-            page = 0
+        page, _ = parse_page_cb(data, "ishop:list")
         await ishop_list(update, context, page)
         return
 
@@ -715,7 +787,8 @@ async def eq_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     if data.startswith("eq:list:") and len(parts) == 4:
-        await eq_list(update, context, int(parts[2]), int(parts[3]))
+        page, _ = parse_page_cb(data, f"eq:list:{parts[2]}")
+        await eq_list(update, context, int(parts[2]), page)
         return
 
     if data.startswith("eq:eq:") and len(parts) == 4:
@@ -769,10 +842,7 @@ async def inv_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     parts = data.split(":")
 
     if data.startswith("inv:list:") and len(parts) == 3:
-        try:
-            page = int(parts[2])
-        except Exception:
-            page = 0
+        page, _ = parse_page_cb(data, "inv:list")
         await inv_list(update, context, page)
         return
 
@@ -830,6 +900,7 @@ async def meow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     res = await meow_try(user_id)
     if not res.ok:
+        await flush()
         if update.message:
             if res.reason == "cooldown":
                 await update.message.reply_text(f"Cooldown: {res.wait_sec}s")
@@ -856,6 +927,7 @@ async def meow_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     res = await meow_try(user_id)
     if not res.ok:
+        await flush()
         q = update.callback_query
         if q and q.message:
             if res.reason == "cooldown":
@@ -868,15 +940,21 @@ async def meow_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 # --- Cats ---
-async def my_cats_list(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0) -> None:
+async def my_cats_list(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    page: int = 0,
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+) -> None:
     user_id = _user_id_from_update(update)
     if user_id is None:
         return
     await _ensure_user(user_id)
     await _touch_economy(user_id)
 
-    rows, has_prev, has_next = await fetch_user_cats_page(user_id, int(page))
-    text = await render_user_cats_page_text(user_id, int(page))
+    rows, has_prev, has_next = await fetch_user_cats_page(user_id, int(page), after=after, before=before)
+    text = await render_user_cats_page_text(user_id, int(page), rows)
     kb = cats_list_keyboard(rows, int(page), has_prev, has_next)
     await _edit_or_reply(update, text, kb)
 
@@ -904,17 +982,16 @@ async def my_cat_feed(update: Update, context: ContextTypes.DEFAULT_TYPE, user_c
         return
     await _ensure_user(user_id)
     await _touch_economy(user_id)
+    await apply_survival(user_id)
 
     now = int(time.time())
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute(
             "UPDATE user_cats SET last_feed_at=? WHERE user_id=? AND id=? AND status='active'",
             (int(now), int(user_id), int(user_cat_id)),
         )
+        await refresh_deadlines(db, user_id=user_id, user_cat_id=user_cat_id)
         await db.commit()
-    finally:
-        await db.close()
 
     await my_cat_open(update, context, int(user_cat_id))
 
@@ -925,17 +1002,16 @@ async def my_cat_play(update: Update, context: ContextTypes.DEFAULT_TYPE, user_c
         return
     await _ensure_user(user_id)
     await _touch_economy(user_id)
+    await apply_survival(user_id)
 
     now = int(time.time())
-    db = await open_db()
-    try:
+    async with connect() as db:
         await db.execute(
             "UPDATE user_cats SET last_play_at=? WHERE user_id=? AND id=? AND status='active'",
             (int(now), int(user_id), int(user_cat_id)),
         )
+        await refresh_deadlines(db, user_id=user_id, user_cat_id=user_cat_id)
         await db.commit()
-    finally:
-        await db.close()
 
     await my_cat_open(update, context, int(user_cat_id))
 
@@ -950,12 +1026,16 @@ async def cats_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     data = update.callback_query.data if update.callback_query else ""
     parts = data.split(":")
 
-    if data.startswith("cat:list:") and len(parts) == 3:
-        try:
-            page = int(parts[2])
-        except Exception:
-            page = 0
-        await my_cats_list(update, context, page)
+    if data.startswith("cat:list:") and len(parts) in (3, 4):
+        # cat:list:<page>[:n<last id>|:p<first id>]
+        page, cursor = parse_page_cb(data, "cat:list")
+        after = before = None
+        if cursor and cursor[:1] in ("n", "p") and cursor[1:].isdigit():
+            if cursor[0] == "n":
+                after = int(cursor[1:])
+            else:
+                before = int(cursor[1:])
+        await my_cats_list(update, context, page, after=after, before=before)
         return
 
     if data.startswith("cat:open:") and len(parts) == 3:
@@ -1103,10 +1183,7 @@ async def ev_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     if data.startswith("ev:list:") and len(parts) == 3:
-        try:
-            page = int(parts[2])
-        except Exception:
-            page = 0
+        page, _ = parse_page_cb(data, "ev:list")
         await ev_list(update, context, page)
         return
 
@@ -1327,6 +1404,11 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await _edit_or_reply(update, txt, kb)
         return
 
+    if data == "admin:rates":
+        txt, kb = await admin_rebuild_rates(user_id)
+        await _edit_or_reply(update, txt, kb)
+        return
+
     if data.startswith("admin:logs:"):
         parts = data.split(":")
         page = 0
@@ -1475,18 +1557,101 @@ async def shop_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await shop_std(update, context)
     elif data == "shop:prem":
         await shop_prem(update, context)
+    elif data == "shop:std:x10":
+        await shop_multi(update, context, "standard", 10)
+    elif data == "shop:prem:x10":
+        await shop_multi(update, context, "premium", 10)
     else:
         await shop_view(update, context)
 
 
-def main() -> None:
-    if not BOT_TOKEN:
-        raise SystemExit("BOT_TOKEN is missing")
-
-    asyncio.run(init_db())
-
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+class _UpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs every update (handlers and error handlers) inside one unit of work,
+    at most `limit` at a time. Updates from the same user wait for each other
+    and run in arrival order, so one player's taps never race on their own
+    balance; different users proceed in parallel.
+    """
+
+    def __init__(self, limit: int) -> None:
+        limit = max(1, int(limit))
+        # PTB's semaphore only admits updates; queued taps of a busy user wait
+        # on their lock without taking one of the `limit` running slots
+        super().__init__(limit * 4)
+        self._running = asyncio.Semaphore(limit)
+        self._user_locks: Dict[int, List] = {}
+
+    @asynccontextmanager
+    async def _user_lock(self, user_id: Optional[int]) -> AsyncIterator[None]:
+        if user_id is None:
+            yield
+            return
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user_id = _user_id_from_update(update) if isinstance(update, Update) else None
+        async with self._user_lock(user_id):
+            async with self._running:
+                # backpressure from a full log buffer, before any write lock is held
+                await wait_for_log_room()
+                try:
+                    async with unit_of_work():
+                        await coroutine
+                except Exception:
+                    log.exception("unit of work failed")
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+async def _on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # handler failed: drop everything this update wrote
+    abort_unit_of_work()
+    log.error("update failed", exc_info=context.error)
+
+
+async def _post_init(app) -> None:
+    await bans.load()
+    await catalog.load()
+    start_log_sink()
+    start_sweeper()
+
+
+async def _post_shutdown(app) -> None:
+    await stop_sweeper()
+    await stop_rate_rebuild()
+    await stop_deadline_refresh()
+    # flush buffered economy_logs while the pool is still open
+    await stop_log_sink()
+    await close_pool()
+
+
+def build_application(bot: Bot | None = None) -> Application:
+    # bot is for tools that drive the handlers without Telegram (bench.py)
+    builder = (
+        ApplicationBuilder()
+        .concurrent_updates(_UpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    builder = builder.bot(bot) if bot is not None else builder.token(BOT_TOKEN)
+    app = builder.build()
+    app.add_error_handler(_on_error)
 
+    app.add_handler(ChatMemberHandler(group_member_cb, ChatMemberHandler.CHAT_MEMBER))
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("meow", meow_cmd))
     app.add_handler(CommandHandler("admin", admin_cmd))
@@ -1511,6 +1676,17 @@ def main() -> None:
     app.add_handler(CallbackQueryHandler(nav_cb, pattern=r"^nav:"))
 
     app.add_handler(CallbackQueryHandler(nav_cb))
+    return app
+
+
+def main() -> None:
+    if not BOT_TOKEN:
+        raise SystemExit("BOT_TOKEN is missing")
+
+    storage = asyncio.run(init_db())
+    log.info("storage: %s", ", ".join(f"{k}={v}" for k, v in storage.items()))
+
+    app = build_application()
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -0,0 +1,127 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from config import MEMBERSHIP_TTL_SEC, MEMBERSHIP_NEGATIVE_TTL_SEC, MEMBERSHIP_PERSIST
+from db import connect
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def is_member_status(status: Optional[str]) -> bool:
+    return str(status or "") in MEMBER_STATUSES
+
+
+class MembershipCache:
+    """
+    Join-gate answers for (chat_id, user_id), so get_chat_member is not called
+    on every update.
+
+    Members are trusted for ttl_sec, non-members for negative_ttl_sec (short,
+    so a user who just joined is let in soon even without a chat_member
+    update). record() is fed from chat_member updates and replaces the entry
+    immediately. With persist=True answers are also kept in group_members and
+    survive restarts.
+    """
+
+    def __init__(self, ttl_sec: int, negative_ttl_sec: int, persist: bool = False, max_entries: int = 50000) -> None:
+        self.ttl_sec = max(0, int(ttl_sec))
+        self.negative_ttl_sec = max(0, int(negative_ttl_sec))
+        self.persist = bool(persist)
+        self.max_entries = max(1, int(max_entries))
+        # (chat_id, user_id) -> (is_member, expires_at on time.monotonic())
+        self._entries: Dict[Tuple[int, int], Tuple[bool, float]] = {}
+
+    def _ttl(self, ok: bool) -> int:
+        return self.ttl_sec if ok else self.negative_ttl_sec
+
+    def _remember(self, chat_id: int, user_id: int, ok: bool, age: float = 0.0) -> None:
+        ttl = self._ttl(ok)
+        key = (int(chat_id), int(user_id))
+        if ttl <= 0 or age >= ttl:
+            self._entries.pop(key, None)
+            return
+        if len(self._entries) >= self.max_entries:
+            self._prune()
+        self._entries[key] = (ok, time.monotonic() + ttl - age)
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (_, exp) in self._entries.items() if exp <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            # still full of live entries: start over rather than grow without bound
+            self._entries.clear()
+
+    def cached(self, chat_id: int, user_id: int) -> Optional[bool]:
+        key = (int(chat_id), int(user_id))
+        hit = self._entries.get(key)
+        if hit is None:
+            return None
+        ok, expires_at = hit
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return ok
+
+    def invalidate(self, chat_id: Optional[int] = None, user_id: Optional[int] = None) -> None:
+        if chat_id is None and user_id is None:
+            self._entries.clear()
+            return
+        for key in list(self._entries):
+            if (chat_id is None or key[0] == int(chat_id)) and (user_id is None or key[1] == int(user_id)):
+                del self._entries[key]
+
+    async def _load(self, chat_id: int, user_id: int) -> Optional[bool]:
+        async with connect() as db:
+            cur = await db.execute(
+                "SELECT status, checked_at FROM group_members WHERE chat_id=? AND user_id=?",
+                (int(chat_id), int(user_id)),
+            )
+            row = await cur.fetchone()
+        if not row:
+            return None
+        ok = is_member_status(row["status"])
+        age = max(0, int(time.time()) - int(row["checked_at"]))
+        if age >= self._ttl(ok):
+            return None
+        self._remember(chat_id, user_id, ok, age=age)
+        return ok
+
+    async def _store(self, chat_id: int, user_id: int, status: str) -> None:
+        async with connect() as db:
+            await db.execute(
+                """
+                INSERT INTO group_members(chat_id, user_id, status, checked_at)
+                VALUES(?,?,?,?)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                  status=excluded.status,
+                  checked_at=excluded.checked_at
+                """,
+                (int(chat_id), int(user_id), str(status), int(time.time())),
+            )
+            await db.commit()
+
+    async def record(self, chat_id: int, user_id: int, status: Optional[str]) -> bool:
+        ok = is_member_status(status)
+        self._remember(chat_id, user_id, ok)
+        if self.persist:
+            await self._store(chat_id, user_id, str(status or ""))
+        return ok
+
+    async def is_member(self, bot, chat_id: int, user_id: int, fresh: bool = False) -> bool:
+        """
+        Cached membership check; fresh=True always asks Telegram (the Verify
+        button). TelegramError from get_chat_member is left to the caller and
+        nothing is cached for it.
+        """
+        if not fresh:
+            ok = self.cached(chat_id, user_id)
+            if ok is None and self.persist:
+                ok = await self._load(chat_id, user_id)
+            if ok is not None:
+                return ok
+        member = await bot.get_chat_member(int(chat_id), int(user_id))
+        return await self.record(chat_id, user_id, getattr(member, "status", None))
+
+
+membership = MembershipCache(MEMBERSHIP_TTL_SEC, MEMBERSHIP_NEGATIVE_TTL_SEC, persist=MEMBERSHIP_PERSIST)
@@ -0,0 +1,68 @@
+# bot/migrate.py
+"""
+Runs the schema migrations in db.MIGRATIONS against DB_PATH.
+
+The bot applies pending steps itself at startup (init_db); this is for
+checking a database first, or migrating it ahead of a deploy while the old
+process keeps serving. --dry-run writes nothing and prints the rows each
+pending step is expected to touch.
+
+    python bot/migrate.py --dry-run
+    python bot/migrate.py --batch 500 --pause-ms 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+from typing import List
+
+
+def _parse_args(argv: List[str]) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    p.add_argument("--dry-run", action="store_true", help="only report pending steps and estimated rows")
+    p.add_argument("--target", type=int, default=None, help="stop after this schema version")
+    p.add_argument("--batch", type=int, default=0, help="backfill rows per transaction (default MIGRATION_BATCH_ROWS)")
+    p.add_argument("--pause-ms", type=int, default=-1, help="sleep between backfill chunks (default MIGRATION_PAUSE_MS)")
+    p.add_argument("--db", default="", help="SQLite file (default DB_PATH)")
+    return p.parse_args(argv)
+
+
+async def _migrate(args: argparse.Namespace) -> None:
+    # imported here: config reads the environment prepared in main()
+    import db
+    from config import MIGRATION_BATCH_ROWS, MIGRATION_PAUSE_MS
+
+    conn = await db.open_db()
+    try:
+        before = await db.schema_version(conn)
+        reports = await db.migrate(
+            conn,
+            dry_run=args.dry_run,
+            target=args.target,
+            batch=args.batch if args.batch > 0 else MIGRATION_BATCH_ROWS,
+            pause_ms=args.pause_ms if args.pause_ms >= 0 else MIGRATION_PAUSE_MS,
+        )
+        after = await db.schema_version(conn)
+    finally:
+        await conn.close()
+
+    print(f"schema version: {before}" + ("" if after == before else f" -> {after}"))
+    if not reports:
+        print("nothing to do")
+    for r in reports:
+        if r.applied:
+            print(f"{r.version:>4}  {r.name:<32} {r.rows:>10} rows  {r.seconds:8.2f}s")
+        else:
+            print(f"{r.version:>4}  {r.name:<32} ~{r.rows:>9} rows  pending")
+
+
+def main(argv: List[str] | None = None) -> None:
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    if args.db:
+        os.environ["DB_PATH"] = args.db
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    asyncio.run(_migrate(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from typing import Any, List, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardButton
+
+# List callbacks are "<base>:<page>[:<cursor>]", where base is the list's own prefix and
+# scope ("inv:list", "eq:list:<user_cat_id>", "dshop:list:<rarity>"). The page number is
+# what the user sees; a cursor, when present, tells the list where to resume instead.
+
+
+def page_cb(base: str, page: int, cursor: Optional[str] = None) -> str:
+    data = f"{base}:{max(0, int(page))}"
+    return f"{data}:{cursor}" if cursor else data
+
+
+def parse_page_cb(data: str, base: str) -> Tuple[int, Optional[str]]:
+    """Page and cursor from a page_cb() string; page 0 for anything malformed."""
+    rest = data[len(base) + 1 :].split(":") if data.startswith(base + ":") else []
+    try:
+        page = max(0, int(rest[0]))
+    except (IndexError, ValueError):
+        return 0, None
+    return page, (rest[1] if len(rest) > 1 and rest[1] else None)
+
+
+def nav_row(
+    base: str,
+    page: int,
+    has_prev: bool,
+    has_next: bool,
+    back: InlineKeyboardButton,
+    prev_cursor: Optional[str] = None,
+    next_cursor: Optional[str] = None,
+) -> List[InlineKeyboardButton]:
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("Prev", callback_data=page_cb(base, page - 1, prev_cursor)))
+    nav.append(back)
+    if has_next:
+        nav.append(InlineKeyboardButton("Next", callback_data=page_cb(base, page + 1, next_cursor)))
+    return nav
+
+
+async def fetch_page(db, sql: str, params: Sequence[Any], page: int, page_size: int) -> Tuple[List[Any], bool, bool]:
+    """
+    Runs `sql` (ordered, without LIMIT) for one page: LIMIT page_size + 1
+    OFFSET page * page_size, where the extra row only answers has_next.
+    """
+    page = max(0, int(page))
+    cur = await db.execute(f"{sql}\nLIMIT ? OFFSET ?", (*params, page_size + 1, page * page_size))
+    rows = await cur.fetchall()
+    return list(rows[:page_size]), page > 0, len(rows) > page_size
+
+
+def slice_page(rows: Sequence[Any], page: int, page_size: int) -> Tuple[List[Any], bool, bool]:
+    """fetch_page() for lists that are already in memory (catalog.py)."""
+    page = max(0, int(page))
+    start = page * page_size
+    return list(rows[start : start + page_size]), page > 0, len(rows) > start + page_size
@@ -1,42 +1,27 @@
-import json
+import asyncio
+import contextvars
+import logging
 import time
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from db import open_db
-
-DEFAULT_PASSIVE_CAP_HOURS = 24
+from config_cache import config_cache
+from db import connect, current_session
+from logsink import log_economy, log_economy_many, log_row
 
+log = logging.getLogger("meowland.passive")
 
-async def _log(user_id: int, action: str, amount: int, meta: dict) -> None:
-    db = await open_db()
-    try:
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (user_id, action, amount, json.dumps(meta, ensure_ascii=False), int(time.time())),
-        )
-        await db.commit()
-    finally:
-        await db.close()
-
-
-async def _get_config_float(db, key: str, default: float) -> float:
-    cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-    row = await cur.fetchone()
-    if row is None:
-        return default
-    try:
-        return float(row["value"])
-    except Exception:
-        return default
+DEFAULT_PASSIVE_CAP_HOURS = 24
+DEFAULT_SETTLE_MIN_MP = 100
+DEFAULT_SETTLE_INTERVAL_SEC = 3600
+RATE_EPSILON = 1e-6
+# users per rebuild transaction
+RATE_REBUILD_BATCH = 500
 
 
-async def _get_rarity_mult_cache(db) -> Dict[str, float]:
-    cur = await db.execute("SELECT key, value FROM config WHERE key LIKE 'rarity_mult_%'")
-    rows = await cur.fetchall()
+async def _get_rarity_mult_cache() -> Dict[str, float]:
+    rows = await config_cache.get_prefix("rarity_mult_")
     out: Dict[str, float] = {}
-    for r in rows:
-        k = str(r["key"])
-        v = r["value"]
+    for k, v in rows.items():
         rarity = k.replace("rarity_mult_", "").strip().lower()
         try:
             out[rarity] = float(v)
@@ -45,9 +30,23 @@ async def _get_rarity_mult_cache(db) -> Dict[str, float]:
     return out
 
 
-async def get_total_passive_rate(user_id: int) -> float:
-    db = await open_db()
-    try:
+def _cat_rate(rarity: str, base_rate: float, level: int, level_bonus: float, rarity_mults: Dict[str, float]) -> float:
+    rarity_mult = float(rarity_mults.get(str(rarity or "").strip().lower(), 1.0))
+    level_mult = 1.0 + (level_bonus * max(0, int(level or 1) - 1))
+    item_mult = 1.0
+    return float(base_rate or 0.0) * rarity_mult * level_mult * item_mult  # MP/hour
+
+
+async def cat_passive_rate(rarity: str, base_rate: float, level: int) -> float:
+    """Contribution of one active cat to its owner's rate, in MP/hour."""
+    level_bonus = await config_cache.get_float("level_bonus", 0.0)
+    rarity_mults = await _get_rarity_mult_cache()
+    return _cat_rate(rarity, base_rate, level, level_bonus, rarity_mults)
+
+
+async def compute_passive_rate(user_id: int) -> float:
+    """Rate from scratch: joins every active cat with the catalog."""
+    async with connect() as db:
         cur = await db.execute(
             """
             SELECT cc.rarity, cc.base_passive_rate, uc.level
@@ -59,86 +58,305 @@ async def get_total_passive_rate(user_id: int) -> float:
         )
         rows = await cur.fetchall()
 
-        level_bonus = await _get_config_float(db, "level_bonus", 0.0)
-        rarity_mults = await _get_rarity_mult_cache(db)
+    level_bonus = await config_cache.get_float("level_bonus", 0.0)
+    rarity_mults = await _get_rarity_mult_cache()
 
-        total_rate_per_hour = 0.0
-        for r in rows:
-            rarity = str(r["rarity"] or "").strip()
-            base_rate = float(r["base_passive_rate"] or 0.0)  # MP/hour
-            level = int(r["level"] or 1)
+    total_rate_per_hour = 0.0
+    for r in rows:
+        total_rate_per_hour += _cat_rate(r["rarity"], r["base_passive_rate"], r["level"], level_bonus, rarity_mults)
 
-            rarity_mult = float(rarity_mults.get(rarity.lower(), 1.0))
-            level_mult = 1.0 + (level_bonus * max(0, level - 1))
-            item_mult = 1.0
+    return float(total_rate_per_hour)
 
-            total_rate_per_hour += base_rate * rarity_mult * level_mult * item_mult
 
-        return float(total_rate_per_hour)
-    finally:
-        await db.close()
+async def get_total_passive_rate(user_id: int) -> float:
+    async with connect() as db:
+        cur = await db.execute("SELECT passive_rate_cached FROM users WHERE user_id=?", (user_id,))
+        u = await cur.fetchone()
+        if u is not None and u["passive_rate_cached"] is not None:
+            return float(u["passive_rate_cached"])
+
+    rate = await compute_passive_rate(user_id)
+    if u is not None:
+        async with connect() as db:
+            await db.execute(
+                "UPDATE users SET passive_rate_cached=? WHERE user_id=? AND passive_rate_cached IS NULL",
+                (rate, user_id),
+            )
+            await db.commit()
+    return rate
 
 
-async def apply_passive(user_id: int) -> int:
-    now = int(time.time())
+async def adjust_passive_rate(db, user_id: int, delta: float) -> None:
+    """
+    Applies a change in one cat's contribution to the stored rate. Settle
+    first with apply_passive(force=True) so the old rate covers the time
+    before the change. A NULL rate stays NULL and is rebuilt on next read.
+    """
+    if delta == 0:
+        return
+    await db.execute(
+        "UPDATE users SET passive_rate_cached = MAX(0, passive_rate_cached + ?) WHERE user_id=?",
+        (float(delta), int(user_id)),
+    )
 
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            "SELECT last_passive_ts, passive_cap_hours FROM users WHERE user_id=?",
-            (user_id,),
-        )
-        u = await cur.fetchone()
-        if u is None:
-            return 0
 
-        last_ts = int(u["last_passive_ts"] or now)
-        cap_hours = u["passive_cap_hours"]
-        cap_hours = int(cap_hours) if cap_hours is not None else DEFAULT_PASSIVE_CAP_HOURS
-        cap_sec = max(0, cap_hours) * 3600
+async def _rebuild_chunk(db, ids: List[int], now: int, level_bonus: float, rarity_mults: Dict[str, float]) -> int:
+    # pay what accrued at the stored rates before they change
+    await settle_users(db, ids, now)
+    cur = await db.execute(
+        """
+        SELECT u.user_id, u.passive_rate_cached, cc.rarity, cc.base_passive_rate, uc.level
+        FROM users u
+        LEFT JOIN user_cats uc ON uc.user_id = u.user_id AND uc.status='active'
+        LEFT JOIN cats_catalog cc ON cc.cat_id = uc.cat_id
+        WHERE u.user_id BETWEEN ? AND ?
+        """,
+        (ids[0], ids[-1]),
+    )
+    rates: Dict[int, float] = {}
+    stored: Dict[int, Optional[float]] = {}
+    for r in await cur.fetchall():
+        uid = int(r["user_id"])
+        stored[uid] = r["passive_rate_cached"]
+        rates.setdefault(uid, 0.0)
+        if r["rarity"] is not None:
+            rates[uid] += _cat_rate(r["rarity"], r["base_passive_rate"], r["level"], level_bonus, rarity_mults)
 
-        dt = now - last_ts
-        if dt <= 0:
-            return 0
+    drifted = [
+        (rate, uid)
+        for uid, rate in rates.items()
+        if stored[uid] is None or abs(float(stored[uid]) - rate) > RATE_EPSILON
+    ]
+    if drifted:
+        await db.executemany("UPDATE users SET passive_rate_cached=? WHERE user_id=?", drifted)
+    return len(drifted)
 
-        used = dt if cap_sec == 0 else min(dt, cap_sec)
 
-        total_rate_per_hour = await get_total_passive_rate(user_id)
-        rate_per_sec = total_rate_per_hour / 3600.0
+async def rebuild_passive_rates(user_id: Optional[int] = None, batch: int = RATE_REBUILD_BATCH) -> Tuple[int, int]:
+    """
+    Recomputes passive_rate_cached from user_cats for one user or everyone.
+    Each chunk of users is settled at its stored rate first and committed on
+    its own, so other writers get the lock between chunks; run it outside a
+    unit of work (schedule_rate_rebuild()). Returns (users checked, users
+    whose stored rate had drifted).
+    """
+    level_bonus = await config_cache.get_float("level_bonus", 0.0)
+    rarity_mults = await _get_rarity_mult_cache()
 
-        if rate_per_sec <= 0:
-            await db.execute("UPDATE users SET last_passive_ts=? WHERE user_id=?", (now, user_id))
+    checked = fixed = 0
+    after = 0
+    while True:
+        async with connect() as db:
+            if user_id is None:
+                cur = await db.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (after, max(1, int(batch))),
+                )
+            else:
+                cur = await db.execute("SELECT user_id FROM users WHERE user_id=?", (int(user_id),))
+            ids = [int(r["user_id"]) for r in await cur.fetchall()]
+            if not ids:
+                break
+            fixed += await _rebuild_chunk(db, ids, int(time.time()), level_bonus, rarity_mults)
             await db.commit()
+        checked += len(ids)
+        if user_id is not None or len(ids) < batch:
+            break
+        after = ids[-1]
+        await asyncio.sleep(0)
+
+    return checked, fixed
+
+
+_rebuild_task: Optional[asyncio.Task] = None
+_rebuild_again = False
+
+
+async def _rebuild_loop() -> None:
+    global _rebuild_again
+    while True:
+        _rebuild_again = False
+        try:
+            checked, fixed = await rebuild_passive_rates()
+            log.info("passive rate rebuild: checked=%s fixed=%s", checked, fixed)
+        except Exception:
+            log.exception("passive rate rebuild failed")
+        if not _rebuild_again:
+            return
+
+
+def _start_rate_rebuild() -> None:
+    global _rebuild_task, _rebuild_again
+    if _rebuild_task is not None and not _rebuild_task.done():
+        # rates changed again mid-pass; users already done need the newer values too
+        _rebuild_again = True
+        return
+    # fresh context: never inherit the caller's unit of work
+    _rebuild_task = asyncio.get_running_loop().create_task(
+        _rebuild_loop(), name="passive-rate-rebuild", context=contextvars.Context()
+    )
+
+
+def schedule_rate_rebuild() -> None:
+    """Runs rebuild_passive_rates() in the background once the caller's unit of work commits."""
+    session = current_session()
+    if session is not None:
+        session.on_commit(_start_rate_rebuild)
+    else:
+        _start_rate_rebuild()
+
+
+async def stop_rate_rebuild() -> None:
+    global _rebuild_task
+    task, _rebuild_task = _rebuild_task, None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def _accrue(now: int, last_ts: int, cap_hours: int, rate_per_hour: float) -> Tuple[int, int, int]:
+    """(generated MP, new anchor ts, seconds counted) for the window since last_ts."""
+    cap_sec = max(0, cap_hours) * 3600
+
+    dt = now - last_ts
+    if dt <= 0:
+        return 0, last_ts, 0
+
+    used = dt if cap_sec == 0 else min(dt, cap_sec)
+
+    rate_per_sec = rate_per_hour / 3600.0
+    if rate_per_sec <= 0:
+        return 0, now, used
+
+    gen_float = used * rate_per_sec
+    gen_int = int(gen_float)
+
+    remainder = gen_float - gen_int
+    remainder_sec = int(remainder / rate_per_sec) if remainder > 0 else 0
+    return gen_int, now - remainder_sec, used
+
+
+async def _load_state(db, user_id: int):
+    cur = await db.execute(
+        "SELECT last_passive_ts, passive_cap_hours, passive_rate_cached FROM users WHERE user_id=?",
+        (user_id,),
+    )
+    return await cur.fetchone()
+
+
+async def _snapshot_rate(u, user_id: int) -> float:
+    rate = u["passive_rate_cached"]
+    if rate is None:
+        return await compute_passive_rate(user_id)
+    return float(rate)
+
+
+def _cap_hours(u) -> int:
+    cap_hours = u["passive_cap_hours"]
+    return int(cap_hours) if cap_hours is not None else DEFAULT_PASSIVE_CAP_HOURS
+
+
+async def pending_passive(user_id: int) -> int:
+    """
+    MP accrued since the last settlement but not yet written to mp_balance.
+    Read-only; shown on top of the stored balance.
+    """
+    now = int(time.time())
+    async with connect() as db:
+        u = await _load_state(db, user_id)
+    if u is None:
+        return 0
+    rate = await _snapshot_rate(u, user_id)
+    gen_int, _, _ = _accrue(now, int(u["last_passive_ts"] or now), _cap_hours(u), rate)
+    return gen_int
+
+
+def is_rate_config_key(key: str) -> bool:
+    return key == "level_bonus" or key.startswith("rarity_mult_")
+
+
+async def apply_passive(user_id: int, force: bool = False) -> int:
+    """
+    Moves pending MP into mp_balance. Without force this only writes once
+    enough MP has piled up (passive_settle_min_mp) or the anchor is older
+    than passive_settle_interval_sec, so plain browsing stays read-only.
+    Anything that spends MP or changes the rate must settle with force=True.
+    """
+    now = int(time.time())
+
+    async with connect() as db:
+        u = await _load_state(db, user_id)
+        if u is None:
             return 0
 
-        gen_float = used * rate_per_sec
-        gen_int = int(gen_float)
+        last_ts = int(u["last_passive_ts"] or now)
+        cap_hours = _cap_hours(u)
+        total_rate_per_hour = await _snapshot_rate(u, user_id)
 
-        remainder = gen_float - gen_int
-        remainder_sec = int(remainder / rate_per_sec) if remainder > 0 else 0
-        new_last_ts = now - remainder_sec
+        gen_int, new_last_ts, used = _accrue(now, last_ts, cap_hours, total_rate_per_hour)
 
-        if gen_int > 0:
-            await db.execute(
-                "UPDATE users SET mp_balance = mp_balance + ?, last_passive_ts=? WHERE user_id=?",
-                (gen_int, new_last_ts, user_id),
-            )
-        else:
-            await db.execute(
-                "UPDATE users SET last_passive_ts=? WHERE user_id=?",
-                (new_last_ts, user_id),
-            )
+        if not force and u["passive_rate_cached"] is not None and u["last_passive_ts"] is not None:
+            min_mp = await config_cache.get_int("passive_settle_min_mp", DEFAULT_SETTLE_MIN_MP)
+            interval = await config_cache.get_int("passive_settle_interval_sec", DEFAULT_SETTLE_INTERVAL_SEC)
+            if gen_int < max(1, min_mp) and (now - last_ts) < interval:
+                return 0
 
-        await db.commit()
+        if gen_int <= 0 and new_last_ts == last_ts and u["passive_rate_cached"] is not None:
+            return 0
 
+        await db.execute(
+            "UPDATE users SET mp_balance = mp_balance + ?, last_passive_ts=?, passive_rate_cached=? WHERE user_id=?",
+            (gen_int, new_last_ts, total_rate_per_hour, user_id),
+        )
         if gen_int > 0:
-            await _log(
+            await log_economy(
+                db,
                 user_id,
                 "passive_collect",
                 gen_int,
                 {"used_sec": used, "cap_hours": cap_hours, "rate_per_hour": total_rate_per_hour},
+                ts=now,
             )
+        await db.commit()
 
         return gen_int
-    finally:
-        await db.close()
+
+
+async def settle_users(db, user_ids: Iterable[int], now: int) -> None:
+    """
+    Forced settlement for many users at once, on the caller's connection and
+    without committing. Used by batch jobs right before they change rates.
+    """
+    ids = sorted({int(u) for u in user_ids})
+    updates: List[tuple] = []
+    logs: List[tuple] = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        cur = await db.execute(
+            f"SELECT user_id, last_passive_ts, passive_cap_hours, passive_rate_cached FROM users WHERE user_id IN ({marks})",
+            chunk,
+        )
+        for u in await cur.fetchall():
+            uid = int(u["user_id"])
+            last_ts = int(u["last_passive_ts"] or now)
+            cap_hours = _cap_hours(u)
+            rate = await _snapshot_rate(u, uid)
+            gen_int, new_last_ts, used = _accrue(now, last_ts, cap_hours, rate)
+            if gen_int <= 0 and new_last_ts == last_ts and u["passive_rate_cached"] is not None:
+                continue
+            updates.append((gen_int, new_last_ts, rate, uid))
+            if gen_int > 0:
+                meta = {"used_sec": used, "cap_hours": cap_hours, "rate_per_hour": rate}
+                logs.append(log_row(uid, "passive_collect", gen_int, meta, now))
+
+    if updates:
+        await db.executemany(
+            "UPDATE users SET mp_balance = mp_balance + ?, last_passive_ts=?, passive_rate_cached=? WHERE user_id=?",
+            updates,
+        )
+    await log_economy_many(db, logs)
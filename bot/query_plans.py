@@ -0,0 +1,325 @@
+# bot/query_plans.py
+"""
+Query plan check for the SQL in the bot modules.
+
+Collects every SQL string literal from bot/*.py, builds a fresh database
+with the real migrations (db.migrate) and runs EXPLAIN QUERY PLAN on each
+statement. A full SCAN of a table that grows with the user base, or a
+TEMP B-TREE (sort / DISTINCT / GROUP BY without an index) in a statement
+that reads one, is reported and makes the exit status 1 unless the
+enclosing function is listed in ALLOWED with a reason. Statements built
+with f-strings or str.format templates are planned once per set of field
+values listed in EXPANSIONS. One without expansions fails if it touches a
+HOT_TABLES table (unless allowed) and is otherwise only listed with -v.
+
+    python bot/query_plans.py
+    python bot/query_plans.py -v
+"""
+import argparse
+import ast
+import asyncio
+import os
+import re
+import sqlite3
+import string
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# tools, not bot code
+SKIP_FILES = {"bench.py", "migrate.py", "query_plans.py"}
+
+# the bot writes SQL keywords in upper case; this keeps log messages like "update failed" out
+SQL_START = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\s+\S")
+
+# str.format templates are filled in at runtime like f-strings
+TEMPLATE_FIELD = re.compile(r"\{\w+\}")
+
+# tables that grow with users / activity; small admin-managed tables may be scanned
+HOT_TABLES = {
+    "users",
+    "user_cats",
+    "user_items",
+    "resources",
+    "rate_limits",
+    "economy_logs",
+    "economy_daily",
+    "purchase_counters",
+    "user_pity",
+    "user_settings",
+    "group_members",
+    "admin_logs",
+}
+
+# (file, function) -> why its scans / sorts are expected
+ALLOWED: Dict[Tuple[str, str], str] = {
+    ("admin.py", "admin_logs_page"): "newest first by rowid; LIMIT ends the scan after one page",
+    ("cats_ui.py", "<module>"): "My Cats seeks idx_user_cats_list; only the name tie-break is sorted, per (rank, level) group",
+    ("db.py", "_backfill_purchase_counters"): "one-off migration, grouped per batch of users",
+    ("equip_ui.py", "fetch_equipable_items_page"): "sorted by catalog fields; one user's items",
+    ("items.py", "list_user_items_page"): "sorted by catalog fields; one user's items",
+}
+
+# (file, function) -> values of the {fields} in its runtime-built SQL; each dict is planned.
+# A field missing from a dict is an error, so new fields have to be listed here.
+_MARKS_1 = "?"
+_MARKS_500 = ",".join("?" * 500)
+_USER = " AND user_id=?"
+EXPANSIONS: Dict[Tuple[str, str], List[Dict[str, str]]] = {
+    ("counters.py", "counter_total"): [{"marks": _MARKS_1}, {"marks": ",".join("?" * 7)}],
+    ("counters.py", "bump_counter"): [
+        {"guard": ""},
+        {"guard": " WHERE purchase_counters.count + excluded.count <= ?"},
+    ],
+    # always scoped to a user or a cat; the per-rarity rewrite is refresh_rarity_deadlines
+    ("feedplay.py", "refresh_deadlines"): [
+        {"where": _USER},
+        {"where": " AND id=?"},
+        {"where": _USER + " AND id=?"},
+    ],
+    ("feedplay.py", "_transition"): [
+        {"status": status, "col": col, "deadline": deadline, "user_sql": user_sql}
+        for status, col, deadline in (
+            ("dead", "last_feed_at", "feed_deadline_at"),
+            ("runaway", "last_play_at", "play_deadline_at"),
+        )
+        for user_sql in ("", _USER)
+    ],
+    ("feedplay.py", "_purge"): [
+        {"status": status, "col": col, "user_sql": user_sql}
+        for status, col in (("runaway", "last_play_at"), ("dead", "last_feed_at"))
+        for user_sql in ("", _USER)
+    ],
+    ("passive.py", "settle_users"): [{"marks": _MARKS_1}, {"marks": _MARKS_500}],
+}
+
+# literal text, or the name of a field filled in at runtime
+Part = Union[str, Tuple[str]]
+
+
+@dataclass
+class Template:
+    path: str
+    line: int
+    func: str
+    parts: List[Part]
+
+    def literal(self) -> str:
+        return "".join(p for p in self.parts if isinstance(p, str))
+
+    def fields(self) -> List[str]:
+        return [p[0] for p in self.parts if isinstance(p, tuple)]
+
+    def render(self, values: Dict[str, str]) -> str:
+        return "".join(p if isinstance(p, str) else values[p[0]] for p in self.parts)
+
+
+@dataclass
+class Statement:
+    path: str
+    line: int
+    func: str
+    sql: str
+
+
+@dataclass
+class Finding:
+    stmt: Statement
+    problems: List[str]
+    plan: List[str]
+    allowed: Optional[str] = None
+
+
+@dataclass
+class Report:
+    checked: int = 0
+    # runtime-built statements without EXPANSIONS that read no hot table
+    dynamic: List[Tuple[str, int, str]] = field(default_factory=list)
+    errors: List[Tuple[Statement, str]] = field(default_factory=list)
+    findings: List[Finding] = field(default_factory=list)
+
+
+class _Collector(ast.NodeVisitor):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.funcs: List[str] = []
+        self.statements: List[Statement] = []
+        self.templates: List[Template] = []
+
+    def _func(self) -> str:
+        return self.funcs[-1] if self.funcs else "<module>"
+
+    def visit_FunctionDef(self, node) -> None:
+        self.funcs.append(node.name)
+        self.generic_visit(node)
+        self.funcs.pop()
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Constant(self, node: ast.Constant) -> None:
+        if isinstance(node.value, str) and SQL_START.match(node.value):
+            if TEMPLATE_FIELD.search(node.value):
+                parts: List[Part] = []
+                for text, name, _spec, _conv in string.Formatter().parse(node.value):
+                    parts.append(text)
+                    if name is not None:
+                        parts.append((name,))
+                self.templates.append(Template(self.path, node.lineno, self._func(), parts))
+            else:
+                self.statements.append(Statement(self.path, node.lineno, self._func(), node.value))
+
+    def visit_JoinedStr(self, node: ast.JoinedStr) -> None:
+        head = node.values[0] if node.values else None
+        if isinstance(head, ast.Constant) and isinstance(head.value, str) and SQL_START.match(head.value):
+            parts: List[Part] = []
+            for v in node.values:
+                if isinstance(v, ast.Constant):
+                    parts.append(str(v.value))
+                else:
+                    parts.append((ast.unparse(v.value),))
+            self.templates.append(Template(self.path, node.lineno, self._func(), parts))
+        # the literal parts of an f-string are not statements on their own
+
+
+def collect(root: str = HERE) -> Tuple[List[Statement], List[Template]]:
+    statements: List[Statement] = []
+    templates: List[Template] = []
+    for name in sorted(os.listdir(root)):
+        if not name.endswith(".py") or name in SKIP_FILES:
+            continue
+        with open(os.path.join(root, name), encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename=name)
+        c = _Collector(name)
+        c.visit(tree)
+        statements.extend(c.statements)
+        templates.extend(c.templates)
+    return statements, templates
+
+
+def _aliases(sql: str) -> Dict[str, str]:
+    # EXPLAIN QUERY PLAN names tables by their alias
+    out = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.IGNORECASE):
+        out[table.lower()] = table.lower()
+        if alias and alias.upper() not in ("WHERE", "JOIN", "LEFT", "INNER", "ON", "ORDER", "GROUP", "LIMIT", "SET", "USING"):
+            out[alias.lower()] = table.lower()
+    return out
+
+
+def _hot(sql: str) -> bool:
+    names = _aliases(sql)
+    return any(t in HOT_TABLES for t in names.values()) or any(
+        re.search(rf"\b{t}\b", sql, re.IGNORECASE) for t in HOT_TABLES
+    )
+
+
+def problems(sql: str, plan: List[str]) -> List[str]:
+    names = _aliases(sql)
+    hot = _hot(sql)
+    out = []
+    for line in plan:
+        m = re.match(r"SCAN (\w+)", line)
+        if m:
+            table = names.get(m.group(1).lower(), m.group(1).lower())
+            # "USING COVERING INDEX" without a constraint still reads the whole index
+            if table in HOT_TABLES:
+                out.append(line)
+        elif "USE TEMP B-TREE" in line and hot:
+            out.append(line)
+    return out
+
+
+async def _plan(db, sql: str) -> List[str]:
+    # parameters are bound to NULL, which is enough to plan
+    try:
+        cur = await db.execute(f"EXPLAIN QUERY PLAN {sql}")
+    except sqlite3.ProgrammingError as e:
+        m = re.search(r"uses (\d+)", str(e))
+        if m is None:
+            raise
+        cur = await db.execute(f"EXPLAIN QUERY PLAN {sql}", (None,) * int(m.group(1)))
+    return [str(r["detail"]) for r in await cur.fetchall()]
+
+
+async def check() -> Report:
+    import db as dbmod
+
+    statements, templates = collect()
+    report = Report()
+    for t in templates:
+        key = (t.path, t.func)
+        if key in EXPANSIONS:
+            for values in EXPANSIONS[key]:
+                missing = [f for f in t.fields() if f not in values]
+                if missing:
+                    report.errors.append(
+                        (Statement(t.path, t.line, t.func, t.literal()), f"no EXPANSIONS value for {', '.join(missing)}")
+                    )
+                    break
+                statements.append(Statement(t.path, t.line, t.func, t.render(values)))
+        elif _hot(t.literal()):
+            stmt = Statement(t.path, t.line, t.func, t.literal())
+            report.findings.append(Finding(stmt, ["built at runtime, not in EXPANSIONS"], [], ALLOWED.get(key)))
+        else:
+            report.dynamic.append((t.path, t.line, t.func))
+    conn = await dbmod.open_db()
+    try:
+        await dbmod.migrate(conn)
+        for stmt in statements:
+            try:
+                plan = await _plan(conn, stmt.sql)
+            except Exception as e:
+                report.errors.append((stmt, str(e)))
+                continue
+            report.checked += 1
+            bad = problems(stmt.sql, plan)
+            if bad:
+                report.findings.append(Finding(stmt, bad, plan, ALLOWED.get((stmt.path, stmt.func))))
+    finally:
+        await conn.close()
+    return report
+
+
+def _first_line(sql: str) -> str:
+    return " ".join(sql.split())[:100]
+
+
+def main(argv: List[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    p.add_argument("-v", "--verbose", action="store_true", help="also list allowed findings and skipped f-string statements")
+    args = p.parse_args(sys.argv[1:] if argv is None else argv)
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="meowland-plans-"), "plans.db")
+    sys.path.insert(0, HERE)
+    report = asyncio.run(check())
+
+    failed = [f for f in report.findings if f.allowed is None]
+    for f in report.findings:
+        if f.allowed is not None and not args.verbose:
+            continue
+        tag = "ALLOWED" if f.allowed is not None else "FAIL"
+        print(f"{tag} {f.stmt.path}:{f.stmt.line} {f.stmt.func}: {_first_line(f.stmt.sql)}")
+        for line in f.problems:
+            print(f"    {line}")
+        if f.allowed is not None:
+            print(f"    ({f.allowed})")
+    for stmt, err in report.errors:
+        print(f"ERROR {stmt.path}:{stmt.line} {stmt.func}: {err}: {_first_line(stmt.sql)}")
+    if args.verbose:
+        for path, line, func in report.dynamic:
+            print(f"SKIP {path}:{line} {func}: built at runtime")
+
+    allowed = len(report.findings) - len(failed)
+    print(
+        f"{report.checked} statements checked, {len(failed)} failing, {allowed} allowed, "
+        f"{len(report.errors)} errors, {len(report.dynamic)} runtime-built skipped (no hot tables)"
+    )
+    if failed or report.errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import time
+from typing import Awaitable, Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Reloadable(Generic[T]):
+    """
+    One value read from the database and kept in memory until invalidate(),
+    or, with ttl_sec > 0, until it is older than ttl_sec (only needed when
+    another process writes the same database). `expired` can end a value's
+    life earlier, e.g. at a time boundary it was built for.
+
+    Every invalidate() or update() bumps `gen`. A load that was running
+    across one still returns its rows but does not keep them, so a
+    concurrent write is never hidden behind an older copy.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], Awaitable[T]],
+        ttl_sec: int = 0,
+        expired: Optional[Callable[[T], bool]] = None,
+    ) -> None:
+        self.ttl_sec = max(0, int(ttl_sec))
+        self.gen = 0
+        self._load = load
+        self._expired = expired
+        self._value: Optional[T] = None
+        self._loaded_at = 0.0
+
+    def peek(self) -> Optional[T]:
+        return self._value
+
+    def invalidate(self) -> None:
+        self.gen += 1
+        self._value = None
+
+    def update(self, fn: Callable[[T], None]) -> None:
+        """Applies a committed change to the kept value in place, if one is loaded."""
+        self.gen += 1
+        if self._value is not None:
+            fn(self._value)
+
+    def _stale(self, value: T) -> bool:
+        if self._expired is not None and self._expired(value):
+            return True
+        return self.ttl_sec > 0 and (time.monotonic() - self._loaded_at) >= self.ttl_sec
+
+    async def reload(self) -> T:
+        gen = self.gen
+        value = await self._load()
+        if gen == self.gen:
+            self._value = value
+            self._loaded_at = time.monotonic()
+        return value
+
+    async def get(self) -> T:
+        value = self._value
+        if value is None or self._stale(value):
+            value = await self.reload()
+        return value
@@ -0,0 +1,192 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    LOG_RETENTION_DAYS,
+    LOG_RETENTION_RULES,
+    LOG_ARCHIVE_DIR,
+    LOG_RETENTION_BATCH,
+)
+from config_cache import config_cache
+from counters import day_key
+from db import connect
+
+MODES = ("rollup", "drop", "keep")
+
+# purchases and balance adjustments; kept raw unless a rule names them explicitly
+AUDIT_ACTIONS = ("admin_*", "direct_buy", "buy_item", "shelter_upgrade", "add_essence", "spend_essence")
+
+
+@dataclass
+class RetentionRule:
+    mode: str
+    days: int
+
+
+@dataclass
+class RetentionResult:
+    rolled_up: int = 0
+    dropped: int = 0
+    archived: int = 0
+    per_action: Dict[str, int] = field(default_factory=dict)
+    finished: bool = True
+
+
+def parse_rules(text: str, default_days: int) -> Dict[str, RetentionRule]:
+    """
+    "meow=rollup:7,passive_collect=drop:14,admin_*=keep" -> rules by action
+    pattern. mode defaults to rollup and days to default_days; "*" sets the
+    fallback for every other action. AUDIT_ACTIONS start out as keep.
+    """
+    rules: Dict[str, RetentionRule] = {"*": RetentionRule("rollup", max(1, int(default_days)))}
+    for name in AUDIT_ACTIONS:
+        rules[name] = RetentionRule("keep", max(1, int(default_days)))
+    for part in str(text or "").split(","):
+        name, _, spec = part.partition("=")
+        name = name.strip()
+        if not name:
+            continue
+        mode, _, days = spec.strip().partition(":")
+        mode = mode.strip().lower() or "rollup"
+        if mode not in MODES:
+            raise ValueError(f"bad retention mode for {name}: {mode}")
+        rules[name] = RetentionRule(mode, max(1, int(days)) if days.strip() else max(1, int(default_days)))
+    return rules
+
+
+def rule_for(rules: Dict[str, RetentionRule], action: str) -> RetentionRule:
+    if action in rules:
+        return rules[action]
+    # longest matching "prefix_*" wins
+    best: Optional[str] = None
+    for name in rules:
+        if name.endswith("*") and name != "*" and action.startswith(name[:-1]):
+            if best is None or len(name) > len(best):
+                best = name
+    return rules[best] if best is not None else rules["*"]
+
+
+async def load_rules() -> Dict[str, RetentionRule]:
+    days = await config_cache.get_int("log_retention_days", int(LOG_RETENTION_DAYS))
+    text = await config_cache.get("log_retention_rules", LOG_RETENTION_RULES)
+    return parse_rules(str(text or ""), days)
+
+
+async def _actions(db) -> List[str]:
+    # loose index scan over idx_economy_logs_action_ts: one seek per distinct action
+    cur = await db.execute(
+        """
+        WITH RECURSIVE a(action) AS (
+          SELECT MIN(action) FROM economy_logs
+          UNION ALL
+          SELECT (SELECT MIN(action) FROM economy_logs WHERE action > a.action) FROM a WHERE a.action IS NOT NULL
+        )
+        SELECT action FROM a WHERE action IS NOT NULL
+        """
+    )
+    return [str(r["action"]) for r in await cur.fetchall()]
+
+
+def _archive_rows(archive_dir: str, rows: List[dict]) -> None:
+    # one gzip member per batch appended to economy_logs-YYYY-MM.ndjson.gz; readers see one stream
+    by_month: Dict[str, List[dict]] = {}
+    for r in rows:
+        by_month.setdefault(time.strftime("%Y-%m", time.gmtime(int(r["ts"]))), []).append(r)
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, items in by_month.items():
+        path = os.path.join(archive_dir, f"economy_logs-{month}.ndjson.gz")
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for r in items:
+                f.write(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+async def _rollup(db, rows: List[dict]) -> None:
+    agg: Dict[Tuple[int, str, str], List[int]] = {}
+    for r in rows:
+        key = (int(r["user_id"] or 0), day_key(int(r["ts"])), str(r["action"]))
+        a = agg.setdefault(key, [0, 0])
+        a[0] += 1
+        a[1] += int(r["amount"] or 0)
+    await db.executemany(
+        """
+        INSERT INTO economy_daily(user_id, day, action, count, sum_amount)
+        VALUES(?,?,?,?,?)
+        ON CONFLICT(user_id, day, action) DO UPDATE SET
+          count = count + excluded.count,
+          sum_amount = sum_amount + excluded.sum_amount
+        """,
+        [(k[0], k[1], k[2], v[0], v[1]) for k, v in agg.items()],
+    )
+
+
+async def run_retention(
+    now: Optional[int] = None,
+    batch: int = LOG_RETENTION_BATCH,
+    max_run_ms: int = 0,
+    archive_dir: Optional[str] = None,
+) -> RetentionResult:
+    """
+    Moves economy_logs rows past their action's retention out of the hot DB,
+    `batch` rows per transaction: archive first (if archive_dir), then roll up
+    into economy_daily (mode rollup) and delete, committed together so a row
+    is never counted twice. A crash between archive and commit can repeat
+    rows in the archive; records carry their id for that reason.
+    max_run_ms > 0 stops early (finished=False); the next run continues.
+    """
+    now = int(time.time()) if now is None else int(now)
+    batch = max(1, int(batch))
+    archive_dir = LOG_ARCHIVE_DIR if archive_dir is None else archive_dir
+    deadline = time.monotonic() + max_run_ms / 1000.0 if max_run_ms > 0 else None
+    res = RetentionResult()
+    rules = await load_rules()
+
+    async with connect() as db:
+        actions = await _actions(db)
+
+    for action in actions:
+        rule = rule_for(rules, action)
+        if rule.mode == "keep":
+            continue
+        cutoff = now - rule.days * 86400
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                res.finished = False
+                return res
+            async with connect() as db:
+                cur = await db.execute(
+                    """
+                    SELECT id, user_id, action, amount, meta_json, ts
+                    FROM economy_logs
+                    WHERE action=? AND ts < ?
+                    ORDER BY ts
+                    LIMIT ?
+                    """,
+                    (action, cutoff, batch),
+                )
+                rows = [dict(r) for r in await cur.fetchall()]
+                if not rows:
+                    break
+                if archive_dir:
+                    await asyncio.to_thread(_archive_rows, archive_dir, rows)
+                    res.archived += len(rows)
+                if rule.mode == "rollup":
+                    await _rollup(db, rows)
+                    res.rolled_up += len(rows)
+                else:
+                    res.dropped += len(rows)
+                await db.execute(
+                    "DELETE FROM economy_logs WHERE id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([int(r["id"]) for r in rows]),),
+                )
+                await db.commit()
+            res.per_action[action] = res.per_action.get(action, 0) + len(rows)
+            if len(rows) < batch:
+                break
+            # let request handlers at the write lock between batches
+            await asyncio.sleep(0)
+    return res
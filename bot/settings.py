@@ -1,8 +1,7 @@
-import json
 import time
 from typing import Any, Dict
 
-from db import open_db
+from db import connect
 
 DEFAULT_SETTINGS: Dict[str, Any] = {
     "notify": 1,          # 1/0
@@ -15,10 +14,6 @@ def _now() -> int:
     return int(time.time())
 
 
-def _key(user_id: int) -> str:
-    return f"user_settings:{int(user_id)}"
-
-
 def _normalize(d: Dict[str, Any]) -> Dict[str, Any]:
     out = dict(DEFAULT_SETTINGS)
 
@@ -38,51 +33,43 @@ def _normalize(d: Dict[str, Any]) -> Dict[str, Any]:
     return out
 
 
-def _loads(value: str | None) -> Dict[str, Any]:
-    if not value:
+async def _read(db, user_id: int) -> Dict[str, Any]:
+    cur = await db.execute(
+        "SELECT notify, public_profile, lang FROM user_settings WHERE user_id=?",
+        (int(user_id),),
+    )
+    row = await cur.fetchone()
+    if row is None:
         return dict(DEFAULT_SETTINGS)
-    try:
-        obj = json.loads(value)
-        if isinstance(obj, dict):
-            return _normalize(obj)
-    except Exception:
-        pass
-    return dict(DEFAULT_SETTINGS)
+    return _normalize(dict(row))
 
 
 async def get_user_settings(user_id: int) -> Dict[str, Any]:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (_key(user_id),))
-        row = await cur.fetchone()
-        if row is None:
-            return dict(DEFAULT_SETTINGS)
-        return _loads(str(row["value"] or ""))
-    finally:
-        await db.close()
+    async with connect() as db:
+        return await _read(db, user_id)
 
 
 async def set_user_settings(user_id: int, updates: Dict[str, Any]) -> Dict[str, Any]:
     ts = _now()
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (_key(user_id),))
-        row = await cur.fetchone()
-        current = _loads("" if row is None else str(row["value"] or ""))
-
-        merged = dict(current)
+    async with connect() as db:
+        merged = await _read(db, user_id)
         merged.update(updates or {})
         merged = _normalize(merged)
 
         await db.execute(
-            "INSERT INTO config(key, value, updated_at) VALUES(?,?,?) "
-            "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
-            (_key(user_id), json.dumps(merged, ensure_ascii=False), ts),
+            """
+            INSERT INTO user_settings(user_id, notify, public_profile, lang, updated_at)
+            VALUES(?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+              notify=excluded.notify,
+              public_profile=excluded.public_profile,
+              lang=excluded.lang,
+              updated_at=excluded.updated_at
+            """,
+            (int(user_id), merged["notify"], merged["public_profile"], merged["lang"], ts),
         )
         await db.commit()
         return merged
-    finally:
-        await db.close()
 
 
 async def toggle_notify(user_id: int) -> Dict[str, Any]:
@@ -1,9 +1,10 @@
 # bot/shelter_ui.py
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from db import open_db
+from db import connect
 from essence import get_essence
 from shelter import get_shelter_state, get_next_upgrade_cost, upgrade_shelter
+from passive import pending_passive
 
 
 def shelter_kb(can_upgrade: bool = True) -> InlineKeyboardMarkup:
@@ -21,13 +22,11 @@ async def shelter_text(user_id: int) -> str:
 
     ess = await get_essence(user_id)
 
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT mp_balance FROM users WHERE user_id=?", (int(user_id),))
         u = await cur.fetchone()
         mp = 0 if u is None else int(u["mp_balance"] or 0)
-    finally:
-        await db.close()
+    mp += await pending_passive(user_id)
 
     cost = await get_next_upgrade_cost(user_id)
 
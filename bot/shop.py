@@ -1,9 +1,15 @@
-import json
 import time
 from dataclasses import dataclass
-from typing import Optional, Dict, Any, List
+from typing import Dict, Any, List, Tuple
 
-from db import open_db
+from catalog import catalog
+from config_cache import config_cache
+from counters import bump_counter, counter_total
+from db import connect
+from logsink import log_economy
+from paging import slice_page
+from passive import apply_passive, adjust_passive_rate, cat_passive_rate
+from feedplay import refresh_deadlines
 
 RARITY_ORDER = ["Common", "Uncommon", "Rare", "Epic"]
 
@@ -25,36 +31,6 @@ def _now() -> int:
     return int(time.time())
 
 
-async def _cfg_int(key: str, default: int) -> int:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-        row = await cur.fetchone()
-        if row is None:
-            return default
-        try:
-            return int(row["value"])
-        except Exception:
-            return default
-    finally:
-        await db.close()
-
-
-async def _cfg_json(key: str) -> Optional[dict]:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-        row = await cur.fetchone()
-        if row is None:
-            return None
-        try:
-            return json.loads(row["value"])
-        except Exception:
-            return None
-    finally:
-        await db.close()
-
-
 async def _week_key(now_ts: int) -> str:
     # ISO week key
     import datetime as _dt
@@ -77,110 +53,63 @@ class PurchaseResult:
     price: int = 0
 
 
-async def list_shop_cats_by_rarity(rarity: str) -> List[dict]:
-    now = _now()
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT cat_id, name, rarity, media_type, media_file_id
-            FROM cats_catalog
-            WHERE active=1
-              AND rarity=?
-              AND rarity != 'Divine'
-              AND (
-                available_from IS NULL OR available_from <= ?
-              )
-              AND (
-                available_until IS NULL OR available_until >= ?
-              )
-              AND (
-                ',' || pools_enabled || ',' LIKE '%,Shop,%'
-              )
-            ORDER BY name ASC
-            """,
-            (rarity, now, now),
-        )
-        rows = await cur.fetchall()
-        return [
+async def list_shop_cats_by_rarity(rarity: str, page: int, page_size: int) -> Tuple[List[dict], bool, bool]:
+    cats = [c for c in await catalog.pool_cats("Shop", _now(), rarity) if c.rarity != "Divine"]
+    cats.sort(key=lambda c: (c.name, c.cat_id))
+    chunk, has_prev, has_next = slice_page(cats, page, page_size)
+    return (
+        [
             {
-                "cat_id": int(r["cat_id"]),
-                "name": str(r["name"]),
-                "rarity": str(r["rarity"]),
-                "media_type": str(r["media_type"] or ""),
-                "media_file_id": str(r["media_file_id"] or ""),
+                "cat_id": c.cat_id,
+                "name": c.name,
+                "rarity": c.rarity,
+                "media_type": c.media_type,
+                "media_file_id": c.media_file_id,
             }
-            for r in rows
-        ]
-    finally:
-        await db.close()
+            for c in chunk
+        ],
+        has_prev,
+        has_next,
+    )
 
 
 async def _direct_price_for_rarity(rarity: str) -> int:
-    std_price = await _cfg_int("standard_price", DEFAULT_STANDARD_PRICE)
+    std_price = await config_cache.get_int("standard_price", DEFAULT_STANDARD_PRICE)
     mult = PRICE_MULTS.get(rarity, 60)
     return int(std_price * mult)
 
 
 async def _weekly_count(user_id: int, now_ts: int) -> int:
     wk = await _week_key(now_ts)
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT COUNT(1) AS c
-            FROM economy_logs
-            WHERE user_id=?
-              AND action='direct_buy'
-              AND meta_json LIKE ?
-            """,
-            (user_id, f'%\"week\":\"{wk}\"%'),
-        )
-        r = await cur.fetchone()
-        return 0 if r is None else int(r["c"] or 0)
-    finally:
-        await db.close()
+    async with connect() as db:
+        return await counter_total(db, user_id, "direct_buy", [wk])
 
 
 async def direct_buy(user_id: int, cat_id: int) -> PurchaseResult:
     now = _now()
     wk = await _week_key(now)
 
-    weekly_cap = await _cfg_int("direct_weekly_cap", DEFAULT_WEEKLY_CAP)
+    weekly_cap = await config_cache.get_int("direct_weekly_cap", DEFAULT_WEEKLY_CAP)
     used = await _weekly_count(user_id, now)
     if used >= weekly_cap:
         return PurchaseResult(False, "weekly_cap")
 
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT cat_id, name, description, rarity, base_passive_rate, media_type, media_file_id, active, pools_enabled,
-                   available_from, available_until
-            FROM cats_catalog
-            WHERE cat_id=? AND active=1
-            """,
-            (cat_id,),
-        )
-        cat = await cur.fetchone()
-        if cat is None:
-            return PurchaseResult(False, "not_found")
-
-        rarity = str(cat["rarity"])
-        if rarity not in RARITY_ORDER:
-            return PurchaseResult(False, "not_allowed")
+    cat = await catalog.cat(cat_id)
+    if cat is None:
+        return PurchaseResult(False, "not_found")
 
-        # must be in Shop pool and in time window
-        if ",Shop," not in f",{str(cat['pools_enabled'] or '')},":
-            return PurchaseResult(False, "not_in_pool")
+    rarity = cat.rarity
+    if rarity not in RARITY_ORDER:
+        return PurchaseResult(False, "not_allowed")
 
-        af = cat["available_from"]
-        au = cat["available_until"]
-        if af is not None and int(af) > now:
-            return PurchaseResult(False, "not_in_window")
-        if au is not None and int(au) < now:
-            return PurchaseResult(False, "not_in_window")
+    # must be in Shop pool and in time window
+    if not cat.in_pool("Shop"):
+        return PurchaseResult(False, "not_in_pool")
+    if not cat.available(now):
+        return PurchaseResult(False, "not_in_window")
 
+    await apply_passive(user_id, force=True)
+    async with connect() as db:
         price = await _direct_price_for_rarity(rarity)
 
         cur = await db.execute("SELECT mp_balance FROM users WHERE user_id=?", (user_id,))
@@ -189,25 +118,34 @@ async def direct_buy(user_id: int, cat_id: int) -> PurchaseResult:
         if mp < price:
             return PurchaseResult(False, "no_mp")
 
+        # checked again here so two quick purchases cannot both pass the cap
+        if not await bump_counter(db, user_id, "direct_buy", wk, cap=weekly_cap):
+            return PurchaseResult(False, "weekly_cap")
+
         await db.execute("UPDATE users SET mp_balance = mp_balance - ? WHERE user_id=?", (price, user_id))
 
         # add to user (new or dup)
         cur = await db.execute(
             "SELECT id, level, dup_counter, status FROM user_cats WHERE user_id=? AND cat_id=? ORDER BY id LIMIT 1",
-            (user_id, int(cat["cat_id"])),
+            (user_id, cat.cat_id),
         )
         owned = await cur.fetchone()
 
+        base_rate = cat.base_passive_rate
+        rate_delta = 0.0
+
         outcome: Dict[str, Any]
         if owned is None:
-            await db.execute(
+            cur = await db.execute(
                 """
-                INSERT INTO user_cats(user_id, cat_id, level, dup_counter, status, last_feed_at, last_play_at, obtained_at)
-                VALUES(?, ?, 1, 0, 'active', ?, ?, ?)
+                INSERT INTO user_cats(user_id, cat_id, level, dup_counter, status, last_feed_at, last_play_at, obtained_at, rarity_rank)
+                VALUES(?, ?, 1, 0, 'active', ?, ?, ?, (SELECT rarity_rank FROM cats_catalog WHERE cat_id=?2))
                 """,
-                (user_id, int(cat["cat_id"]), now, now, now),
+                (user_id, cat.cat_id, now, now, now),
             )
+            await refresh_deadlines(db, user_cat_id=cur.lastrowid, rarity=rarity)
             outcome = {"type": "new"}
+            rate_delta = await cat_passive_rate(rarity, base_rate, 1)
         else:
             level = int(owned["level"] or 1)
             dup = int(owned["dup_counter"] or 0)
@@ -215,12 +153,14 @@ async def direct_buy(user_id: int, cat_id: int) -> PurchaseResult:
             if status != "active":
                 status = "active"
 
-            max_level = await _cfg_int("max_level", 20)
+            max_level = await config_cache.get_int("max_level", 20)
             if level >= max_level:
                 outcome = {"type": "dup_max", "level": level}
             else:
                 # thresholds same as cats.py
                 th = {"Common": 25, "Uncommon": 15, "Rare": 8, "Epic": 4}.get(rarity, 25)
+                if str(owned["status"] or "active") == "active":
+                    rate_delta -= await cat_passive_rate(rarity, base_rate, level)
                 dup += 1
                 level_up = False
                 if dup >= th:
@@ -231,29 +171,25 @@ async def direct_buy(user_id: int, cat_id: int) -> PurchaseResult:
                     "UPDATE user_cats SET level=?, dup_counter=?, status=? WHERE id=?",
                     (level, dup, status, int(owned["id"])),
                 )
+                if str(owned["status"] or "active") != "active":
+                    await refresh_deadlines(db, user_cat_id=int(owned["id"]), rarity=rarity)
                 outcome = {"type": "dup", "level": level, "level_up": level_up, "dup": dup, "threshold": th}
+                rate_delta += await cat_passive_rate(rarity, base_rate, level)
+
+        await adjust_passive_rate(db, user_id, rate_delta)
 
-        await db.execute(
-            "INSERT INTO economy_logs(user_id, action, amount, meta_json, ts) VALUES(?,?,?,?,?)",
-            (
-                user_id,
-                "direct_buy",
-                -int(price),
-                json.dumps({"cat_id": int(cat["cat_id"]), "rarity": rarity, "week": wk}, ensure_ascii=False),
-                now,
-            ),
+        await log_economy(
+            db, user_id, "direct_buy", -int(price), {"cat_id": cat.cat_id, "rarity": rarity, "week": wk}, ts=now, audit=True
         )
         await db.commit()
 
         return PurchaseResult(
             True,
-            cat_id=int(cat["cat_id"]),
+            cat_id=cat.cat_id,
             rarity=rarity,
-            name=str(cat["name"]),
-            media_type=str(cat["media_type"] or ""),
-            media_file_id=str(cat["media_file_id"] or ""),
+            name=cat.name,
+            media_type=cat.media_type,
+            media_file_id=cat.media_file_id,
             outcome=outcome,
             price=price,
         )
-    finally:
-        await db.close()
@@ -2,7 +2,8 @@ from typing import List, Tuple
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from db import open_db
+from config_cache import config_cache
+from paging import nav_row
 from shop import list_shop_cats_by_rarity, PRICE_MULTS, DEFAULT_STANDARD_PRICE
 
 
@@ -10,23 +11,8 @@ PAGE_SIZE = 6
 RARITIES = ["Common", "Uncommon", "Rare", "Epic"]
 
 
-async def _cfg_int(key: str, default: int) -> int:
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-        row = await cur.fetchone()
-        if row is None:
-            return default
-        try:
-            return int(row["value"])
-        except Exception:
-            return default
-    finally:
-        await db.close()
-
-
 async def _direct_price_for_rarity(rarity: str) -> int:
-    std_price = await _cfg_int("standard_price", DEFAULT_STANDARD_PRICE)
+    std_price = await config_cache.get_int("standard_price", DEFAULT_STANDARD_PRICE)
     mult = PRICE_MULTS.get(rarity, 60)
     return int(std_price * mult)
 
@@ -43,18 +29,7 @@ async def direct_shop_root_text() -> str:
 
 async def fetch_direct_shop_page(rarity: str, page: int) -> Tuple[List[dict], bool, bool]:
     rarity = rarity if rarity in RARITIES else "Common"
-    all_cats = await list_shop_cats_by_rarity(rarity)
-
-    page = max(0, int(page))
-    start = page * PAGE_SIZE
-    end = start + PAGE_SIZE + 1
-    chunk = all_cats[start:end]
-
-    has_next = len(chunk) > PAGE_SIZE
-    chunk = chunk[:PAGE_SIZE]
-    has_prev = page > 0
-
-    return chunk, has_prev, has_next
+    return await list_shop_cats_by_rarity(rarity, page, PAGE_SIZE)
 
 
 async def direct_shop_list_text(rarity: str, page: int) -> str:
@@ -70,13 +45,8 @@ def direct_shop_list_kb(rarity: str, cats: List[dict], page: int, has_prev: bool
         name = str(c["name"])
         rows.append([InlineKeyboardButton(name, callback_data=f"dshop:buy:{cat_id}")])
 
-    nav = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("Prev", callback_data=f"dshop:list:{rarity}:{page-1}"))
-    nav.append(InlineKeyboardButton("Back", callback_data="dshop:root"))
-    if has_next:
-        nav.append(InlineKeyboardButton("Next", callback_data=f"dshop:list:{rarity}:{page+1}"))
-    rows.append(nav)
+    back = InlineKeyboardButton("Back", callback_data="dshop:root")
+    rows.append(nav_row(f"dshop:list:{rarity}", page, has_prev, has_next, back))
 
     return InlineKeyboardMarkup(rows)
 
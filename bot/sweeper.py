@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from config import SWEEP_INTERVAL_SEC, SWEEP_BATCH_SIZE, SWEEP_MAX_RUN_MS, LOG_RETENTION_INTERVAL_SEC
+from feedplay import sweep_survival
+from retention import run_retention
+
+log = logging.getLogger("meowland.sweeper")
+
+_task: Optional[asyncio.Task] = None
+
+
+async def _retention_tick(next_at: float) -> float:
+    # returns when the next retention pass is due; unfinished passes continue on the next tick
+    if time.monotonic() < next_at:
+        return next_at
+    try:
+        res = await run_retention(max_run_ms=SWEEP_MAX_RUN_MS)
+        if res.rolled_up or res.dropped:
+            log.info(
+                "log retention: rolled_up=%s dropped=%s archived=%s finished=%s",
+                res.rolled_up,
+                res.dropped,
+                res.archived,
+                res.finished,
+            )
+        if not res.finished:
+            return next_at
+    except Exception:
+        log.exception("log retention failed")
+    return time.monotonic() + max(1, LOG_RETENTION_INTERVAL_SEC)
+
+
+async def _run() -> None:
+    retention_at = 0.0
+    while True:
+        try:
+            res = await sweep_survival(batch=SWEEP_BATCH_SIZE, max_run_ms=SWEEP_MAX_RUN_MS)
+            if res.dead or res.runaway or res.purged:
+                log.info("survival sweep: dead=%s runaway=%s purged=%s", res.dead, res.runaway, res.purged)
+        except Exception:
+            log.exception("survival sweep failed")
+        if LOG_RETENTION_INTERVAL_SEC > 0:
+            retention_at = await _retention_tick(retention_at)
+        await asyncio.sleep(max(1, SWEEP_INTERVAL_SEC))
+
+
+def start_sweeper() -> None:
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_run(), name="survival-sweeper")
+
+
+async def stop_sweeper() -> None:
+    global _task
+    task, _task = _task, None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
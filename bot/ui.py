@@ -1,9 +1,9 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from db import open_db
+from db import connect
 from essence import get_essence
 from shelter import get_shelter_state
-from passive import get_total_passive_rate
+from passive import get_total_passive_rate, pending_passive
 
 
 def back_home_keyboard() -> InlineKeyboardMarkup:
@@ -28,17 +28,16 @@ def home_keyboard(user_id: int) -> InlineKeyboardMarkup:
 
 
 async def render_home_text(user_id: int) -> str:
-    db = await open_db()
-    try:
+    async with connect() as db:
         cur = await db.execute("SELECT mp_balance, last_passive_ts, passive_cap_hours, shelter_level FROM users WHERE user_id=?", (int(user_id),))
         u = await cur.fetchone()
         if u is None:
             return "Home\n\nNot found."
         mp = int(u["mp_balance"] or 0)
         cap = u["passive_cap_hours"]
-    finally:
-        await db.close()
 
+    # passive MP is settled lazily; show it as if it were already collected
+    mp += await pending_passive(user_id)
     ess = await get_essence(user_id)
     rate = await get_total_passive_rate(user_id)
 